@@ -1,16 +1,27 @@
-from .secretkey import SecretKey
 from .config import Config
+from .keyring import KeyRing
 from flask import Flask
 from flask_session import Session
+from .sessions import MeasuredSessionInterface
+from .metrics import Metrics
+from .tracing import Tracer
 
 app = Flask(__name__)
 app.config.from_object(Config)
-app.secret_key = SecretKey()
+# the same key in every process (see keyring.py); session cookies check
+# against the whole ring
+app.secret_key = KeyRing.active()
 
 sess = Session()
 sess.init_app(app)
+MeasuredSessionInterface.install(app)
+Metrics.install(app)
+# outside the metrics, so its spans cover everything they count
+Tracer.install(app)
 
-from . import views
+from . import views, cli
+if app.config['NEON_ASYNC_VIEWS']:
+    from . import aioviews
     
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
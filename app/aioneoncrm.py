@@ -0,0 +1,363 @@
+"""
+The asyncio twin of neoncrm.
+
+Everything in neoncrm blocks the thread that calls it until NeonCRM answers,
+so under a check-in rush each worker thread spends nearly all of its time
+waiting. Here the same operations are coroutines running on one event loop
+per process, sharing one pool of keep-alive connections, so a single process
+can have hundreds of NeonCRM requests in flight at once.
+
+Only the calls to NeonCRM itself are async. The session broker, the caches
+and the rate limiter are reused from neoncrm as they are, and since they
+talk to the shared store with blocking calls -- which, with REDIS_URL set,
+go over the network and retry with backoff when it misbehaves -- they run
+on the loop's own pool of NEON_ASYNC_STORE_THREADS threads, never on the
+loop itself. If Redis is slow, coroutines queue up for those threads (each
+call is bounded by REDIS_SOCKET_TIMEOUT and REDIS_RETRIES) while the loop
+carries on with everything else. The pool is kept well below
+REDIS_MAX_CONNECTIONS, which it shares with the request threads.
+
+Needs httpx (pip install techlahoma_checkin[async]).
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+import httpx
+
+from . import neoncrm
+from .breaker import CircuitBreaker, CircuitOpen
+from .metrics import Metrics
+from .mirror import Mirror
+from .tracing import Tracer
+from .ratelimit import RateLimited, RateLimiter
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import abort
+
+
+class EventLoop:
+    """
+    One long-lived event loop per process, running on its own thread.
+
+    Flask's default way of running an async view is to spin up a brand new
+    event loop for every request, which would throw away our connection pool
+    each time. Instead, every async view (and every coroutine below) runs on
+    this one loop, and the WSGI thread serving the request just waits for it.
+    """
+
+    # threads for the blocking store calls (asyncio.to_thread) made from the loop
+    STORE_THREADS = int(os.getenv("NEON_ASYNC_STORE_THREADS", "16"))
+
+    _loop = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def loop(cls) -> asyncio.AbstractEventLoop:
+        """RETURNS THIS PROCESS'S LOOP, STARTING ITS THREAD IF NEED BE"""
+        if cls._loop is None or cls._pid != os.getpid():
+            with cls._lock:
+                if cls._loop is None or cls._pid != os.getpid():
+                    loop = asyncio.new_event_loop()
+                    loop.set_default_executor(ThreadPoolExecutor(
+                        max_workers=cls.STORE_THREADS,
+                        thread_name_prefix='neoncrm-store'
+                    ))
+                    threading.Thread(
+                        target=loop.run_forever,
+                        name='neoncrm-loop',
+                        daemon=True
+                    ).start()
+                    cls._loop = loop
+                    cls._pid = os.getpid()
+        return cls._loop
+
+    @classmethod
+    def run(cls, coroutine):
+        """
+        Runs a coroutine on the loop and waits for its result. The coroutine
+        gets a copy of the caller's context, which is what carries Flask's
+        request, session and app context over to the loop's thread.
+        """
+        context = contextvars.copy_context()
+        result = Future()
+
+        def start():
+            task = cls.loop().create_task(coroutine, context=context)
+            task.add_done_callback(lambda done: cls._settle(done, result))
+
+        cls.loop().call_soon_threadsafe(start)
+        return result.result()
+
+    @staticmethod
+    def _settle(task, result) -> None:
+        """COPIES A FINISHED TASK'S OUTCOME OVER TO THE WAITING THREAD"""
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+
+    @classmethod
+    def async_to_sync(cls, func):
+        """A DROP-IN FOR Flask.async_to_sync THAT RUNS VIEWS ON OUR LOOP"""
+        def run_view(*args, **kwargs):
+            return cls.run(func(*args, **kwargs))
+        return run_view
+
+
+class AsyncClient:
+    """
+    The async counterpart of neoncrm.Client: one httpx.AsyncClient per
+    process (it belongs to EventLoop's loop), with the same per-operation
+    timeouts, able to keep up to MAX_CONNECTIONS requests in flight.
+    """
+
+    MAX_CONNECTIONS = int(os.getenv("NEON_ASYNC_MAX_CONNECTIONS", "200"))
+    FAILURES = neoncrm.Client.FAILURES + (httpx.HTTPError,)
+
+    _http = None
+    _pid = None
+
+    @classmethod
+    def http(cls) -> httpx.AsyncClient:
+        if cls._http is None or cls._pid != os.getpid():
+            cls._http = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=cls.MAX_CONNECTIONS,
+                    max_keepalive_connections=neoncrm.Client.POOL_SIZE
+                )
+            )
+            cls._pid = os.getpid()
+        return cls._http
+
+    @staticmethod
+    def timeout(operation) -> httpx.Timeout:
+        connect, read = neoncrm.Client.timeout(operation)
+        return httpx.Timeout(read, connect=connect)
+
+    @classmethod
+    async def request(cls, operation, method, url, **kwargs) -> httpx.Response:
+        """
+        Sends one request to NeonCRM over the shared async client, behind the
+        same circuit breakers, rate limit, metrics and tracing as
+        neoncrm.Client.request.
+        """
+        with Tracer.span('neon', operation=operation, method=method) as span:
+            kwargs.setdefault('timeout', cls.timeout(operation))
+            breaker = CircuitBreaker.of(operation)
+            try:
+                breaker.guard()
+            except CircuitOpen:
+                Metrics.neon_call(operation, 'circuit_open')
+                raise
+            try:
+                with Tracer.span('rate_limit', operation=operation):
+                    await RateLimiter.acquire_async(operation)
+            except RateLimited:
+                breaker.release()
+                Metrics.neon_call(operation, 'rate_limited')
+                raise
+            started = time.monotonic()
+            try:
+                response = await cls.http().request(method, url, **kwargs)
+            except httpx.HTTPError as error:
+                seconds = time.monotonic() - started
+                breaker.record(seconds, False)
+                Metrics.neon_call(operation, type(error).__name__, seconds)
+                raise
+            except BaseException:
+                breaker.release()
+                raise
+            seconds = time.monotonic() - started
+            breaker.record(seconds, neoncrm.Client.healthy(response))
+            Metrics.neon_call(operation, response.status_code, seconds, response.content)
+            span.set(status=response.status_code, bytes=len(response.content))
+            return response
+
+    @classmethod
+    async def get(cls, operation, url, **kwargs) -> httpx.Response:
+        return await cls.request(operation, 'GET', url, **kwargs)
+
+    @classmethod
+    async def post(cls, operation, url, **kwargs) -> httpx.Response:
+        return await cls.request(operation, 'POST', url, **kwargs)
+
+
+class API:
+    """ASYNC VERSIONS OF THE OPERATIONS IN neoncrm.API"""
+
+    @staticmethod
+    async def get_session_access(authorization) -> str:
+        """
+        Trades the authorization code for an access token representing the
+        constituent's account id, and returns it.
+        """
+        response = await AsyncClient.post(
+            'token',
+            neoncrm.API.ACCESS_TOKEN_URL,
+            data={
+                'client_id': os.getenv("CLIENT_ID"),
+                'client_secret': os.getenv("CLIENT_SECRET"),
+                'redirect_uri': os.getenv("REDIRECT_URI"),
+                'code': authorization,
+                'grant_type': 'authorization_code'
+            },
+            headers={'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        return response.json().get('access_token')
+
+    @staticmethod
+    async def retrieve_user_session_id() -> str:
+        """
+        The shared userSessionId from neoncrm.SessionBroker. Almost always
+        that's just a lookup, but when it's due for a refresh the broker logs
+        in and waits on other workers, so it runs on a thread.
+        """
+        return await asyncio.to_thread(neoncrm.SessionBroker.user_session_id)
+
+    @staticmethod
+    async def forget_expired_session(error, user_session_id) -> None:
+        """IF NEONCRM SAID IT DOESN'T KNOW user_session_id, DROPS IT FROM THE BROKER (ON A THREAD)"""
+        if error.codes & neoncrm.API.SESSION_ERRORS:
+            await asyncio.to_thread(neoncrm.SessionBroker.invalidate, user_session_id)
+
+
+class Constituent:
+    """ASYNC VERSIONS OF THE OPERATIONS IN neoncrm.Constituent"""
+
+    @classmethod
+    async def retrieve_login_bundle(cls, user_session_id, access_token) -> dict:
+        """Same as neoncrm.Constituent.retrieve_login_bundle, gathered on the loop"""
+        name, points_dict = await asyncio.gather(
+            cls.retrieve_constituent_name(user_session_id, access_token),
+            cls.get_points_dict(user_session_id, access_token),
+        )
+        return {
+            'constituent_name': name,
+            'points_dict': points_dict,
+        }
+
+    @classmethod
+    async def get_points_dict(cls, user_session_id, access_token):
+        """Same as neoncrm.Constituent.get_points_dict"""
+        version, points_dict = await asyncio.to_thread(
+            lambda: (neoncrm.PointsCache.version(access_token), neoncrm.PointsCache.get(access_token))
+        )
+        if points_dict is None:
+            points_dict = await cls.fresh_or_stale_points(user_session_id, access_token, version)
+        return points_dict
+
+    @classmethod
+    async def fresh_or_stale_points(cls, user_session_id, access_token, version):
+        """
+        Same as neoncrm.Constituent.fresh_or_stale_points; the background
+        revalidation is the threaded one, since it's only the odd trial call.
+        """
+        breaker = CircuitBreaker.of('points')
+        if not breaker.closed():
+            last_good = await asyncio.to_thread(neoncrm.PointsCache.last_good, access_token)
+            if last_good is not None:
+                if breaker.state() == 'half_open':
+                    neoncrm.Client.fanout().submit(
+                        neoncrm.Constituent.revalidate_points, user_session_id, access_token, version
+                    )
+                return last_good
+        try:
+            points_dict = await cls.retrieve_user_point_records_dictionary(user_session_id, access_token)
+        except AsyncClient.FAILURES:
+            last_good = await asyncio.to_thread(neoncrm.PointsCache.last_good, access_token)
+            if last_good is None:
+                raise
+            return last_good
+        await asyncio.to_thread(neoncrm.PointsCache.put, access_token, points_dict, version)
+        return points_dict
+
+    @staticmethod
+    async def retrieve_constituent_name(user_session_id, access_token):
+        constituent_info_response = await AsyncClient.get(
+            'account_info',
+            neoncrm.API.CONSTITUENT_INFO_URL.format(user_session_id, access_token)
+        )
+        try:
+            constituent_account_data = neoncrm.API.result(
+                constituent_info_response, 'retrieveIndividualAccountResponse',
+                "retrieving the constituent's account"
+            )['individualAccount']
+        except neoncrm.OperationFailed as error:
+            Tracer.log('account_fetch_failed', error=error, codes=sorted(error.codes), account=neoncrm.Constituent.fingerprint(access_token))
+            await API.forget_expired_session(error, user_session_id)
+            abort(500)
+        return constituent_account_data['primaryContact'].get('preferredName', constituent_account_data['primaryContact'].get('firstName'))
+
+    @classmethod
+    async def retrieve_user_point_records(cls, user_session_id, access_token):
+        """every one of a constituent's point records, parsed into events"""
+        return [event async for event in cls.iter_point_records(user_session_id, access_token)]
+
+    @classmethod
+    async def iter_point_records(cls, user_session_id, access_token):
+        """
+        Same as neoncrm.Constituent.iter_point_records, prefetching on the
+        loop. Reading from the local mirror happens on a thread, since it's
+        SQLite plus a (sync) call to NeonCRM for the newest records.
+        """
+        if await asyncio.to_thread(Mirror.fresh):
+            for event in await asyncio.to_thread(lambda: list(Mirror.point_events(access_token))):
+                yield event
+            return
+        page = await cls.fetch_point_records_page(user_session_id, access_token, 1)
+        total_pages = page.get("page", {}).get("totalPage", 1)
+        current_page = 1
+        while True:
+            upcoming = None
+            if current_page < total_pages:
+                upcoming = asyncio.ensure_future(cls.fetch_point_records_page(
+                    user_session_id, access_token, current_page + 1
+                ))
+            for event in neoncrm.Constituent.parse_point_records(page):
+                yield event
+            if upcoming is None:
+                return
+            page = await upcoming
+            current_page += 1
+
+    @staticmethod
+    async def fetch_point_records_page(user_session_id, access_token, page_number):
+        points_response = await AsyncClient.get(
+            'points',
+            neoncrm.API.POINTS_URL.format(user_session_id, access_token, page_number, neoncrm.API.POINTS_PAGE_SIZE)
+        )
+        try:
+            return neoncrm.API.result(
+                points_response, "listCustomObjectRecordsResponse", "listing Points_c records"
+            )
+        except neoncrm.OperationFailed as error:
+            Tracer.log('points_fetch_failed', error=error, codes=sorted(error.codes), account=neoncrm.Constituent.fingerprint(access_token))
+            await API.forget_expired_session(error, user_session_id)
+            raise
+
+    @staticmethod
+    async def get_incentives(user_session_id):
+        """
+        The incentives catalog, straight from the shared cache when it's
+        there. On the rare miss, the refill goes through the cache's own
+        single-flight locking on a thread, like any other worker's would.
+        """
+        incentives = await asyncio.to_thread(neoncrm.IncentivesCache.cached)
+        if incentives is None:
+            incentives = await asyncio.to_thread(
+                neoncrm.Constituent.get_incentives, user_session_id
+            )
+        return incentives
+
+    @classmethod
+    async def retrieve_user_point_records_dictionary(cls, user_session_id, access_token):
+        events, incentives = await asyncio.gather(
+            cls.retrieve_user_point_records(user_session_id, access_token),
+            cls.get_incentives(user_session_id),
+        )
+        return neoncrm.Constituent.summarize_points(events, incentives)
@@ -0,0 +1,67 @@
+"""
+Async versions of the views that talk to NeonCRM.
+
+When NEON_ASYNC_VIEWS is turned on these take over the '/authorize',
+'/dashboard' and '/my-points' routes from the ones in views.py, and all
+async views run on aioneoncrm's per-process event loop. Everything else
+(the landing page, logging out, the error pages) stays exactly as it is in
+views.py, and so does the rendering, which is shared with it.
+"""
+
+import asyncio
+
+from . import app, aioneoncrm
+from .views import CHECK_IN_OPTIONS, record_submission, render_dashboard
+from flask import render_template, session, request, redirect, url_for, abort
+
+app.async_to_sync = aioneoncrm.EventLoop.async_to_sync
+
+
+async def authorize():
+    session['access_token'] = await aioneoncrm.API.get_session_access(request.args.get('code'))
+    try:
+        user_session_id = await aioneoncrm.API.retrieve_user_session_id()
+    except ConnectionError:
+        abort(500)
+    # name, points records and incentives all at once
+    login_bundle = await aioneoncrm.Constituent.retrieve_login_bundle(user_session_id, session['access_token'])
+    constituent_name = login_bundle['constituent_name']
+    session['constituent_name'] = constituent_name
+    points_dict = login_bundle['points_dict']
+    if points_dict['eligible_for_checkin'] == True:
+        return render_template(
+            'check_in.html',
+            name=constituent_name,
+            check_in_options=CHECK_IN_OPTIONS
+        )
+    else:
+        return redirect(url_for('dashboard'))
+
+
+async def dashboard():
+    try:
+        user_session_id = await aioneoncrm.API.retrieve_user_session_id()
+    except ConnectionError:
+        abort(500)
+    incentives = await aioneoncrm.Constituent.get_incentives(user_session_id)
+    points_dict = await aioneoncrm.Constituent.get_points_dict(user_session_id, session['access_token'])
+    if request.method == 'POST':
+        # this only touches Redis, but that's still blocking
+        points_dict = await asyncio.to_thread(record_submission, points_dict, incentives)
+    return render_dashboard(points_dict, incentives)
+
+
+async def account_details():
+    try:
+        user_session_id = await aioneoncrm.API.retrieve_user_session_id()
+    except ConnectionError:
+        abort(500)
+    return render_template('account_details.html',
+    points_dict=await aioneoncrm.Constituent.get_points_dict(user_session_id, session['access_token']),
+    name=session['constituent_name'],
+    )
+
+
+app.view_functions['authorize'] = authorize
+app.view_functions['dashboard'] = dashboard
+app.view_functions['account_details'] = account_details
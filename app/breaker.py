@@ -0,0 +1,120 @@
+"""
+Circuit breakers for the calls we make to NeonCRM, one per operation.
+
+When NeonCRM is struggling, every dashboard used to sit on a call that was
+going to time out anyway, then show an error page, and then the whole room
+would reload at once and make it worse. Now each operation ('points',
+'incentives', ...) has a breaker that trips open after FAILURES failures in
+a row, where a call that takes longer than SLOW_CALL seconds counts as a
+failure too. While it's open, calls for that operation fail straight away
+with CircuitOpen (a ConnectionError), and the dashboards fall back on the
+last points and incentives we got successfully. After OPEN_SECONDS it lets
+a single trial call through (it's 'half open'); if that works the breaker
+closes again, and if it doesn't it stays open for another OPEN_SECONDS.
+
+Breakers are kept per process: each worker finds out for itself, which
+only ever costs it FAILURES calls.
+"""
+
+import os
+import threading
+import time
+
+from .tracing import Tracer
+
+
+class CircuitOpen(ConnectionError):
+    """RAISED INSTEAD OF MAKING A CALL WHILE ITS BREAKER IS OPEN"""
+
+
+class CircuitBreaker:
+
+    FAILURES = int(os.getenv("NEON_BREAKER_FAILURES", "5"))
+    SLOW_CALL = float(os.getenv("NEON_BREAKER_SLOW_SECONDS", "8"))
+    OPEN_SECONDS = float(os.getenv("NEON_BREAKER_OPEN_SECONDS", "30"))
+
+    _breakers = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def of(cls, operation) -> 'CircuitBreaker':
+        """THE BREAKER FOR AN OPERATION, MADE THE FIRST TIME IT'S ASKED FOR"""
+        breaker = cls._breakers.get(operation)
+        if breaker is None:
+            with cls._registry_lock:
+                breaker = cls._breakers.setdefault(operation, cls(operation))
+        return breaker
+
+    def state(self) -> str:
+        """'closed', 'open', or 'half_open' once it's been open for OPEN_SECONDS"""
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.OPEN_SECONDS:
+            return 'half_open'
+        return 'open'
+
+    def closed(self) -> bool:
+        return self.opened_at is None
+
+    def guard(self) -> None:
+        """
+        Lets a call through, or raises CircuitOpen. While half open, only
+        the first caller gets through, as the trial.
+        """
+        with self.lock:
+            state = self.state()
+            if state == 'closed':
+                return
+            if state == 'half_open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpen(f"the {self.operation} breaker is open")
+
+    def release(self) -> None:
+        """FOR A CALL THAT GOT THROUGH BUT NEVER WENT OUT: LETS SOMEBODY ELSE BE THE TRIAL"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record(self, seconds, succeeded) -> None:
+        """COUNTS THE OUTCOME OF A CALL THAT WENT OUT, OPENING OR CLOSING THE BREAKER"""
+        with self.lock:
+            if succeeded and seconds <= self.SLOW_CALL:
+                self.failures = 0
+                self.opened_at = None
+                self.trial_in_flight = False
+                return
+            self.failures += 1
+            opened = False
+            if self.trial_in_flight or (self.opened_at is None and self.failures >= self.FAILURES):
+                if self.opened_at is None:
+                    self.times_opened += 1
+                    opened = True
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+            failures = self.failures
+        # outside the lock, so nobody else's call waits on the log being written
+        if opened:
+            Tracer.log('breaker_opened', level='warning', operation=self.operation, failures=failures)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """EACH OPERATION'S BREAKER: ITS STATE, FAILURES IN A ROW, TIMES OPENED AND CALLS TURNED AWAY"""
+        return {
+            operation: {
+                'state': breaker.state(),
+                'failures': breaker.failures,
+                'times_opened': breaker.times_opened,
+                'rejected': breaker.rejected,
+            }
+            for operation, breaker in list(cls._breakers.items())
+        }
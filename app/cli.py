@@ -0,0 +1,127 @@
+"""
+Flask CLI commands for looking after the app, run as 'flask --app app <command>'.
+"""
+
+import time
+
+import click
+
+from . import app
+from .export import PointsExport
+from .keyring import KeyRing
+from .mirror import Mirror, Reports
+from .neoncrm import API, Constituent
+from .warmup import WarmUp
+
+
+@app.cli.command('rotate-secret-key')
+def rotate_secret_key():
+    """Brings in a new key for signing session cookies, keeping the old ones to check with."""
+    keys = KeyRing.rotate()
+    click.echo(
+        f"every worker accepts the new key within {KeyRing.RELOAD_INTERVAL:.0f}s and signs with it"
+        f" from {KeyRing.PROMOTE_AFTER:.0f}s from now; the current key and {len(keys) - 2} older one(s) stay accepted"
+    )
+
+
+@app.cli.command('warm-up')
+@click.option('--wait', is_flag=True, help="Sleep until WARMUP_LEAD_MINUTES before EVENT_START first.")
+def warm_up(wait):
+    """Logs in, loads the incentives and gets the shared store ready before an event."""
+    if wait:
+        WarmUp.wait_for_window()
+    # connections and templates would only be warm in this short-lived process
+    for step in WarmUp.run(local=False):
+        click.echo(
+            f"{step['step']:<18} {step['seconds'] * 1000:>9.1f}ms"
+            f"  {'ok' if step['ok'] else 'FAILED'}  {step['detail']}"
+        )
+
+
+@app.cli.command('export-points')
+@click.argument('output')
+@click.option('--format', 'output_format', type=click.Choice(sorted(PointsExport.OUTPUTS)), default='csv',
+              help="Parquet needs pyarrow, and makes OUTPUT a directory.")
+@click.option('--workers', type=int, default=PointsExport.WORKERS, help="How many pages to fetch at once.")
+@click.option('--page-size', type=int, default=PointsExport.PAGE_SIZE)
+@click.option('--restart', is_flag=True, help="Start from the first page even if an earlier run didn't finish.")
+def export_points(output, output_format, workers, page_size, restart):
+    """Writes every Points_c record in the org to OUTPUT, carrying on from where it was stopped."""
+    export = PointsExport(output, output_format, workers, page_size)
+
+    def progress(checkpoint):
+        click.echo(f"page {checkpoint['pages_done']} of {checkpoint['total_pages']}, {checkpoint['rows']} records")
+
+    try:
+        done = export.run(restart=restart, progress=progress)
+    except KeyboardInterrupt:
+        click.echo("stopped; run the same command again to carry on from the last page saved")
+        raise SystemExit(1)
+    click.echo(f"exported {done['rows']} records ({done['total_pages']} pages) to {output}")
+
+
+@app.cli.command('sync-mirror')
+@click.option('--full', is_flag=True, help="Fetch every record again instead of only the new ones.")
+@click.option('--every', type=int, default=None, is_flag=False, flag_value=Mirror.SYNC_INTERVAL,
+              help=f"Keep syncing, this many seconds apart ({Mirror.SYNC_INTERVAL} if no number's given).")
+@click.option('--workers', type=int, default=Mirror.WORKERS, help="How many pages to fetch at once.")
+def sync_mirror(full, every, workers):
+    """Brings the local SQLite mirror of Points_c and Data_Updates_c up to date."""
+    if not Mirror.enabled():
+        raise click.UsageError("set MIRROR_PATH to where the mirror should live")
+
+    def progress(object_name, page_number, total_pages):
+        if total_pages > 1:
+            click.echo(f"{object_name}: page {page_number} of {total_pages}")
+
+    while True:
+        started = time.monotonic()
+        try:
+            synced = Mirror.sync(full=full, workers=workers, progress=progress)
+        except Exception as error:
+            if every is None:
+                raise
+            # the next one will pick up from the same watermark
+            click.echo(f"sync failed: {error!r}")
+        else:
+            click.echo(
+                f"synced in {time.monotonic() - started:.1f}s: "
+                + ", ".join(f"{count} {object_name}" for object_name, count in synced.items())
+            )
+        if every is None:
+            return
+        full = False
+        time.sleep(max(0, every - (time.monotonic() - started)))
+
+
+@app.cli.command('mirror-report')
+@click.argument('report', type=click.Choice(Reports.NAMES))
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), help="The first day to count.")
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']), help="The last day to count.")
+@click.option('--group', help="Only this user group (attendance).")
+@click.option('--limit', type=int, help="Only this many members, most points first (rewards).")
+def mirror_report(report, since, until, group, limit):
+    """Answers a staff question out of the local mirror: attendance, data-updates or rewards."""
+    if not Mirror.fresh():
+        synced = Mirror.status().get('Points_c')
+        click.echo(
+            "warning: the mirror was last synced "
+            + (time.strftime('%Y-%m-%d %H:%M', time.localtime(synced['synced_at'])) if synced else "never"),
+            err=True
+        )
+    since = since and since.date()
+    until = until and until.date()
+    if report == 'attendance':
+        rows = Reports.attendance(since, until, group)
+    elif report == 'data-updates':
+        rows = Reports.data_updates(since, until)
+    else:
+        incentives = Constituent.get_incentives(API.retrieve_user_session_id())
+        rows = Reports.rewards(incentives, since, until, limit)
+    if not rows:
+        click.echo("nothing to report")
+        return
+    columns = [column for column in rows[0] if column != 'earned_rewards']
+    click.echo("\t".join(columns))
+    for row in rows:
+        click.echo("\t".join("" if row[column] is None else str(row[column]) for column in columns))
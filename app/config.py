@@ -9,11 +9,25 @@ reason we need to set keys in app.config so I wanted to have this here.
 I don't actually know if we will need to more keys than these ones.
 """
 
-import redislite
+import os
+
+from . import store
 
 class Config:
     # Configure Redis for storing the session data on the server-side
+    # (REDIS_URL, or embedded redislite without it -- see store.py)
     SESSION_TYPE = 'redis'
     SESSION_PERMANENT = False
     SESSION_USE_SIGNER = True
-    SESSION_REDIS = redislite.StrictRedis('/tmp/cache.db')
\ No newline at end of file
+    SESSION_REDIS = store.connect()
+    # The session only holds who somebody is, so a compact format is plenty
+    # ('msgpack' or 'json')
+    SESSION_SERIALIZATION_FORMAT = os.getenv("SESSION_SERIALIZATION_FORMAT", "msgpack")
+    # Log each request's session size and (de)serialization time
+    SESSION_REPORT = os.getenv("SESSION_REPORT", "") == "1"
+    # Complain about any session that grows past this many bytes
+    SESSION_WARN_BYTES = int(os.getenv("SESSION_WARN_BYTES", "2048"))
+
+    # Serve '/authorize', '/dashboard' and '/my-points' from the async views
+    # in aioviews.py (needs the 'async' extra installed)
+    NEON_ASYNC_VIEWS = os.getenv("NEON_ASYNC_VIEWS", "") == "1"
@@ -0,0 +1,318 @@
+"""
+Exporting every Points_c record in the org, for grant applications.
+
+The app only ever asks NeonCRM for one constituent's records at a time, so
+attendance reports used to mean clicking through NeonCRM's admin pages.
+'flask export-points' pages through all of them instead, several pages at
+once (but no faster than the 'export' rate budget allows), and writes them
+out as it goes: a page is parsed and written as soon as it and every page
+before it are in, and only a few pages are ever held in memory, however big
+the org gets.
+
+It can be stopped at any point and picks up where it left off the next time
+it's run with the same output, from the last page that made it safely to
+disk. That's kept track of in a checkpoint file next to the output, which
+goes away once the export finishes.
+
+The output is CSV, or Parquet if pyarrow is installed ('pip install
+.[export]'). A Parquet export is a directory of part files, each covering a
+run of pages and only put in place once it's complete, which is what lets
+it be resumed.
+"""
+
+import csv
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlencode
+
+from .neoncrm import API, Client
+from .tracing import Tracer
+
+
+class CustomObjectPages:
+    """
+    Every record of a custom object, org-wide, a page at a time. Pages are
+    sorted by record id, so page n is the same page whenever it's asked
+    for (as long as nothing's deleted), and new records only ever add pages
+    at the end.
+    """
+
+    URL = API.API_BASE + "/neonws/services/api/customObjectRecord/listCustomObjectRecords"
+    RETRIES = int(os.getenv("NEON_EXPORT_RETRIES", "5"))
+
+    def __init__(self, object_name, columns, criteria=(), page_size=200, operation='export', retries=RETRIES):
+        self.object_name = object_name
+        self.columns = tuple(columns)
+        # (field, operator, value) triples, all of which a record has to match
+        self.criteria = tuple(criteria)
+        self.page_size = page_size
+        self.operation = operation
+        # anything answering a request can't afford to back off for long
+        self.retries = retries
+
+    def url(self, user_session_id, page_number) -> str:
+        query = [('userSessionId', user_session_id), ('objectApiName', self.object_name)]
+        for field, operator, value in self.criteria:
+            query += [
+                ('customObjectSearchCriteriaList.customObjectSearchCriteria.criteriaField', field),
+                ('customObjectSearchCriteriaList.customObjectSearchCriteria.operator', operator),
+                ('customObjectSearchCriteriaList.customObjectSearchCriteria.value', value),
+            ]
+        for column in self.columns:
+            query += [
+                ('customObjectOutputFieldList.customObjectOutputField.label', column),
+                ('customObjectOutputFieldList.customObjectOutputField.columnName', column),
+            ]
+        query += [
+            ('page.currentPage', page_number),
+            ('page.pageSize', self.page_size),
+            ('page.sortColumn', 'id'),
+            ('page.sortDirection', 'ASC'),
+        ]
+        return self.URL + '?' + urlencode(query)
+
+    def fetch(self, page_number) -> tuple:
+        """
+        One page, as (its records as dicts of column to value, how many pages
+        there are now). Failures are tried again, backing off, up to retries
+        times; if NeonCRM has forgotten our userSessionId, we log in again.
+        """
+        for attempt in range(self.retries + 1):
+            user_session_id = API.retrieve_user_session_id()
+            try:
+                response = Client.get(self.operation, self.url(user_session_id, page_number))
+                listing = API.result(
+                    response, 'listCustomObjectRecordsResponse', f"listing {self.object_name}", user_session_id
+                )
+            except Client.FAILURES as error:
+                if attempt == self.retries:
+                    raise
+                wait = min(30, 2 ** attempt)
+                Tracer.log(
+                    'page_fetch_retry', level='warning', error=error,
+                    object=self.object_name, page=page_number, wait=wait
+                )
+                time.sleep(wait)
+                continue
+            records = [
+                {pair['name']: pair['value'] for pair in item['nameValuePair']}
+                for item in listing['searchResults']['nameValuePairs']
+            ]
+            return records, listing.get('page', {}).get('totalPage', 1)
+
+    def walk(self, first_page=1, workers=4):
+        """
+        Yields (page number, records, how many pages there are) for every
+        page from first_page on, in order, with up to workers pages being
+        fetched at once and no more than twice that many held at a time.
+        """
+        records, total_pages = self.fetch(first_page)
+        yield first_page, records, total_pages
+        pending = {}
+        next_to_fetch = next_to_yield = first_page + 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export') as pool:
+            try:
+                while next_to_yield <= total_pages:
+                    while next_to_fetch <= total_pages and len(pending) < workers * 2:
+                        pending[next_to_fetch] = pool.submit(self.fetch, next_to_fetch)
+                        next_to_fetch += 1
+                    records, _ = pending.pop(next_to_yield).result()
+                    yield next_to_yield, records, total_pages
+                    next_to_yield += 1
+            finally:
+                for future in pending.values():
+                    future.cancel()
+
+
+class CsvOutput:
+    """WRITES ROWS TO A CSV FILE, MAKING EVERY PAGE DURABLE BEFORE IT'S CHECKPOINTED"""
+
+    def __init__(self, path, header, checkpoint=None):
+        self.path = path
+        if checkpoint:
+            # anything after the checkpoint was written by a run that didn't
+            # get as far as recording it, so it's going to be written again
+            self.file = open(path, 'r+', newline='')
+            self.file.truncate(checkpoint['offset'])
+            self.file.seek(checkpoint['offset'])
+        else:
+            self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        if not checkpoint:
+            self.writer.writerow(header)
+
+    def write(self, page_number, rows) -> dict:
+        """WRITES A PAGE'S ROWS, AND RETURNS WHAT TO CHECKPOINT NOW THAT THEY'RE SAFE"""
+        self.writer.writerows(rows)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {'offset': self.file.tell()}
+
+    def close(self) -> dict:
+        self.file.close()
+        return {}
+
+
+class ParquetOutput:
+    """
+    Writes rows to a directory of Parquet files, a part file per
+    PAGES_PER_PART pages, named after the first page in it. A part is
+    written under a temporary name and only renamed into place once it's
+    complete, so it's only then that the pages in it can be checkpointed.
+    """
+
+    PAGES_PER_PART = 50
+
+    def __init__(self, path, header, checkpoint=None):
+        # only needed for Parquet exports, so only imported for them
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.path = path
+        self.header = header
+        os.makedirs(path, exist_ok=True)
+        pages_done = checkpoint['pages_done'] if checkpoint else 0
+        for name in os.listdir(path):
+            # anything we were in the middle of, or that starts after the
+            # checkpoint, is going to be written again
+            if name.startswith('part-') and (
+                name.endswith('.tmp') or int(name[5:11]) > pages_done
+            ):
+                os.remove(os.path.join(path, name))
+        self.rows = []
+        self.first_page = None
+        self.pages = 0
+
+    def write(self, page_number, rows):
+        """ADDS A PAGE'S ROWS TO THE PART, AND IF THAT FINISHES IT, RETURNS WHAT TO CHECKPOINT"""
+        if self.first_page is None:
+            self.first_page = page_number
+        self.rows.extend(rows)
+        self.pages += 1
+        if self.pages < self.PAGES_PER_PART:
+            return None
+        return self.flush()
+
+    def flush(self) -> dict:
+        """WRITES OUT THE PART THAT'S BEEN BUILDING UP, IF THERE IS ONE"""
+        if self.pages:
+            columns = list(zip(*self.rows)) or [[] for _ in self.header]
+            table = self.pyarrow.table(dict(zip(self.header, map(list, columns))))
+            final = os.path.join(self.path, f"part-{self.first_page:06d}.parquet")
+            self.parquet.write_table(table, final + '.tmp')
+            os.replace(final + '.tmp', final)
+            self.rows = []
+            self.first_page = None
+            self.pages = 0
+        return {}
+
+    def close(self) -> dict:
+        return self.flush()
+
+
+class PointsExport:
+
+    COLUMNS = ('id', 'Constituent_c', 'createTime', 'point_type_c', 'point_subtype_c', 'Points_Awarded_c', 'name')
+    HEADER = ('id', 'account', 'created', 'type', 'subtype', 'points', 'name')
+    PAGE_SIZE = int(os.getenv("NEON_EXPORT_PAGE_SIZE", "200"))
+    WORKERS = int(os.getenv("NEON_EXPORT_WORKERS", "4"))
+    OUTPUTS = {'csv': CsvOutput, 'parquet': ParquetOutput}
+
+    def __init__(self, path, output_format='csv', workers=WORKERS, page_size=PAGE_SIZE):
+        self.path = path
+        self.output_format = output_format
+        self.workers = workers
+        self.page_size = page_size
+        self.checkpoint_path = path.rstrip('/') + '.checkpoint.json'
+        self.pages = CustomObjectPages('Points_c', self.COLUMNS, page_size=page_size)
+
+    @staticmethod
+    def iso_time(value) -> str:
+        """NEONCRM'S "%m/%d/%Y %H:%M:%S" AS "%Y-%m-%d %H:%M:%S", WHICH SORTS AND IMPORTS BETTER"""
+        if len(value) == 19 and value[2] == '/' and value[5] == '/':
+            return f"{value[6:10]}-{value[0:2]}-{value[3:5]} {value[11:]}"
+        if not value:
+            return value
+        return datetime.strptime(value, "%m/%d/%Y %H:%M:%S").isoformat(sep=' ')
+
+    @classmethod
+    def rows(cls, records):
+        """EACH RECORD AS A ROW UNDER HEADER"""
+        for record in records:
+            yield (
+                int(record.get('id') or 0),
+                record.get('Constituent_c', ''),
+                cls.iso_time(record.get('createTime', '')),
+                record.get('point_type_c', ''),
+                record.get('point_subtype_c', ''),
+                int(record.get('Points_Awarded_c') or 0),
+                record.get('name', ''),
+            )
+
+    def load_checkpoint(self):
+        """WHERE AN EARLIER RUN INTO THE SAME OUTPUT GOT TO, IF IT DIDN'T FINISH"""
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if (checkpoint['format'], checkpoint['page_size']) != (self.output_format, self.page_size):
+            raise ValueError(
+                f"{self.checkpoint_path} is from a {checkpoint['format']} export with"
+                f" {checkpoint['page_size']} records a page; use the same, or start over"
+            )
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint) -> None:
+        """WRITES THE CHECKPOINT SO THAT IT'S EITHER THE OLD ONE OR THE NEW ONE, NEVER HALF OF EACH"""
+        with open(self.checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def discard_checkpoint(self) -> None:
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def run(self, restart=False, progress=None) -> dict:
+        """
+        Exports every Points_c record, carrying on from the checkpoint if
+        there is one (and not restart). progress, if given, is called with
+        the checkpoint after every page that's made it to disk. Returns the
+        final checkpoint.
+        """
+        if restart:
+            self.discard_checkpoint()
+        checkpoint = self.load_checkpoint()
+        output = self.OUTPUTS[self.output_format](self.path, self.HEADER, checkpoint)
+        if checkpoint is None:
+            checkpoint = {
+                'format': self.output_format,
+                'page_size': self.page_size,
+                'pages_done': 0,
+                'total_pages': None,
+                'rows': 0,
+                'started_at': datetime.now().isoformat(timespec='seconds'),
+            }
+        # rows written but not yet safe on disk, so not in the checkpoint yet
+        unsaved = 0
+        for page_number, records, total_pages in self.pages.walk(checkpoint['pages_done'] + 1, self.workers):
+            rows = list(self.rows(records))
+            unsaved += len(rows)
+            saved = output.write(page_number, rows)
+            checkpoint['total_pages'] = total_pages
+            if saved is not None:
+                checkpoint.update(saved, pages_done=page_number, rows=checkpoint['rows'] + unsaved)
+                unsaved = 0
+                self.save_checkpoint(checkpoint)
+                if progress:
+                    progress(checkpoint)
+        checkpoint.update(output.close(), rows=checkpoint['rows'] + unsaved)
+        checkpoint['pages_done'] = max(checkpoint['pages_done'], checkpoint['total_pages'] or 0)
+        self.discard_checkpoint()
+        return checkpoint
@@ -0,0 +1,123 @@
+"""
+The keys the session cookies are signed with, shared by every process.
+
+Each process used to make up its own random secret key, so a cookie signed
+by one worker was rejected by the next, and every restart logged everybody
+out. Now there's one ring of keys for the whole app: the first key signs new
+cookies and the rest are only used to check old ones, so a key can be
+rotated out without anybody's session breaking.
+
+The ring comes from SECRET_KEYS (comma separated, the signing key first) if
+that's set. Otherwise it lives in the shared store, where the first process
+to need it makes one up with SecretKey, and where rotate() brings in a new
+signing key without a restart. That happens in two steps, since each
+process only rereads the ring every RELOAD_INTERVAL seconds: first the new
+key is only accepted, and only once every process has had the chance to
+reread the ring (PROMOTE_AFTER seconds later) does it start signing, so no
+process ever gets a cookie signed with a key it doesn't know yet.
+"""
+
+import json
+import os
+import threading
+import time
+
+from . import store
+from .secretkey import SecretKey
+
+
+class KeyRing:
+
+    KEY = 'neoncrm:secret_keys'
+    # a key that's been rotated in but doesn't sign anything yet, and since when
+    PENDING_KEY = 'neoncrm:secret_keys:pending'
+    # how many retired keys are kept around to check older cookies with
+    VERIFICATION_KEYS = int(os.getenv("SECRET_KEY_VERIFICATION_KEYS", "2"))
+    # seconds between rereading the ring from the store
+    RELOAD_INTERVAL = float(os.getenv("SECRET_KEY_RELOAD_INTERVAL", "30"))
+    # seconds a rotated-in key is only accepted before it starts signing;
+    # anything over RELOAD_INTERVAL, with some slack for slow reloads
+    PROMOTE_AFTER = RELOAD_INTERVAL + 10
+    CONFIGURED = [key.strip() for key in os.getenv("SECRET_KEYS", "").split(",") if key.strip()]
+
+    _keys = None
+    _loaded_at = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def keys(cls) -> list:
+        """EVERY KEY ON THE RING, THE SIGNING KEY FIRST (AND A PENDING ONE LAST)"""
+        if cls.CONFIGURED:
+            return cls.CONFIGURED
+        if cls._keys is None or time.monotonic() - cls._loaded_at > cls.RELOAD_INTERVAL:
+            with cls._lock:
+                if cls._keys is None or time.monotonic() - cls._loaded_at > cls.RELOAD_INTERVAL:
+                    cls._keys = cls.load()
+                    cls._loaded_at = time.monotonic()
+        return cls._keys
+
+    @classmethod
+    def active(cls) -> str:
+        """THE KEY NEW COOKIES GET SIGNED WITH"""
+        return cls.keys()[0]
+
+    @classmethod
+    def load(cls) -> list:
+        """
+        Reads the ring from the shared store, making one if there isn't one
+        yet. If several processes start at once only the first one's ring is
+        kept, and the rest read that back. A pending key goes on the end,
+        where it's only used for checking cookies -- or, once it's been
+        pending for PROMOTE_AFTER seconds, gets promoted to signing.
+        """
+        keys = store.get_json(cls.KEY)
+        if not keys:
+            store.redis().set(cls.KEY, json.dumps([SecretKey().decode()]), nx=True)
+            keys = store.get_json(cls.KEY)
+        pending = store.get_json(cls.PENDING_KEY)
+        if pending is None:
+            return keys
+        if cls.now() - pending['added_at'] >= cls.PROMOTE_AFTER:
+            return cls.promote()
+        return keys + [pending['key']]
+
+    @staticmethod
+    def now() -> float:
+        """THE SHARED STORE'S CLOCK, SO EVERY HOST AGREES ON WHEN A KEY WAS ADDED"""
+        seconds, microseconds = store.redis().time()
+        return seconds + microseconds / 1e6
+
+    @classmethod
+    def promote(cls) -> list:
+        """MAKES THE PENDING KEY THE SIGNING KEY, IF NOBODY ELSE ALREADY HAS, AND RETURNS THE RING"""
+        with store.redis().lock(cls.KEY + ':lock', timeout=10, blocking_timeout=10):
+            keys = store.get_json(cls.KEY) or []
+            pending = store.get_json(cls.PENDING_KEY)
+            if pending is not None:
+                # whatever falls off the end past VERIFICATION_KEYS is forgotten
+                keys = ([pending['key']] + keys)[:1 + cls.VERIFICATION_KEYS]
+                pipe = store.redis().pipeline()
+                pipe.set(cls.KEY, json.dumps(keys))
+                pipe.delete(cls.PENDING_KEY)
+                pipe.execute()
+        return keys
+
+    @classmethod
+    def rotate(cls) -> list:
+        """
+        Adds a brand new key to the ring, pending: every process accepts
+        cookies signed with it from its next reload, and it becomes the
+        signing key PROMOTE_AFTER seconds from now. The old signing key
+        stays on to check cookies it signed. Rotating again before then
+        just replaces the pending key, which nothing has signed with yet.
+        Returns the ring as it is now.
+        """
+        if cls.CONFIGURED:
+            raise RuntimeError("the keys come from SECRET_KEYS, so rotate them there")
+        with store.redis().lock(cls.KEY + ':lock', timeout=10, blocking_timeout=10):
+            store.set_json(cls.PENDING_KEY, {'key': SecretKey().decode(), 'added_at': cls.now()})
+        keys = cls.load()
+        with cls._lock:
+            cls._keys = keys
+            cls._loaded_at = time.monotonic()
+        return keys
@@ -0,0 +1,320 @@
+"""
+Counting where the time goes, for Prometheus to scrape from /metrics.
+
+Every call to NeonCRM is counted by operation ('token', 'api_login',
+'account_info', 'points', 'incentives', 'checkin_create',
+'data_update_create'): what status it came back with (or what it failed
+with, including never going out because its breaker was open or there was
+no room in the rate limit), what NeonCRM said its operationResult and
+errorCode were, and a histogram of how long it took. Alongside those go how
+long each route took to answer, by status, and how long reading and
+writing the session took.
+
+The numbers are kept per process, in memory, and every PUBLISH_INTERVAL
+seconds (or so, since it happens on the way out of a request) each process
+writes a snapshot of them into one Redis hash, along with its rate limiter
+and circuit breaker numbers. /metrics adds every process's snapshot up, so
+it comes out the same whichever worker answers the scrape. A process that
+hasn't published for PROCESS_TTL seconds is assumed to be gone and dropped,
+which Prometheus sees as its counters going back down (a reset).
+"""
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from bisect import bisect_left
+
+from flask import request
+
+from . import store
+from .breaker import CircuitBreaker
+from .ratelimit import RateLimiter
+from .tracing import Tracer
+
+
+class Metrics:
+
+    KEY = 'neoncrm:metrics'
+    PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_SECONDS", "15"))
+    PROCESS_TTL = float(os.getenv("METRICS_PROCESS_TTL", "3600"))
+    # upper bounds of the latency histograms' buckets, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    # (type, help) for everything we expose
+    DESCRIPTIONS = {
+        'neon_requests_total': ('counter', "Calls to NeonCRM, by operation and HTTP status (or why it never got one)."),
+        'neon_request_seconds': ('histogram', "How long calls to NeonCRM took, by operation."),
+        'neon_operation_results_total': ('counter', "NeonCRM's operationResult for each call, with its errorCode if it failed."),
+        'http_requests_total': ('counter', "Requests answered, by route, method and status."),
+        'http_request_seconds': ('histogram', "How long requests took to answer, by route and method."),
+        'session_store_seconds': ('histogram', "How long reading or writing a session took in the store."),
+        'session_codec_seconds': ('histogram', "How long decoding or encoding a session took."),
+        'session_bytes_total': ('counter', "Session bytes read from and written to the store."),
+        'neon_rate_limit_granted_total': ('counter', "Calls the rate limit let through, by budget."),
+        'neon_rate_limit_delayed_total': ('counter', "Calls that had to wait for the rate limit, by budget."),
+        'neon_rate_limit_rejected_total': ('counter', "Calls that gave up waiting for the rate limit, by budget."),
+        'neon_rate_limit_wait_seconds_total': ('counter', "Time spent waiting for the rate limit, by budget."),
+        'neon_rate_limit_waiting': ('gauge', "Calls waiting for the rate limit right now, by budget."),
+        'neon_circuit_breaker_open': ('gauge', "How many processes have the operation's breaker open (or half open)."),
+        'neon_circuit_breaker_opened_total': ('counter', "Times the operation's breaker has opened."),
+        'neon_circuit_breaker_rejected_total': ('counter', "Calls turned away because the operation's breaker was open."),
+        'metrics_processes': ('gauge', "Worker processes whose numbers are included here."),
+    }
+
+    # NeonCRM puts operationResult first, so it's always near the start of
+    # the body; errorCode only turns up in (short) failed responses
+    OPERATION_RESULT = re.compile(rb'"operationResult"\s*:\s*"(\w+)"')
+    ERROR_CODE = re.compile(rb'"errorCode"\s*:\s*"?(\w+)')
+
+    _lock = threading.Lock()
+    _counters = {}
+    _histograms = {}
+    _pid = None
+    _published = 0.0
+
+    @classmethod
+    def install(cls, app) -> None:
+        """TIMES EVERY REQUEST app ANSWERS, AND LABELS IT WITH ITS ROUTE"""
+        app.wsgi_app = cls.timed(app.wsgi_app)
+
+        @app.before_request
+        def note_route():
+            # the rule, not the path, so that /static/<path:filename> is one route
+            request.environ['metrics.route'] = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    @classmethod
+    def timed(cls, wsgi_app):
+        """
+        Wraps the WSGI app so the time counted is the whole request, session
+        and all, and so requests that blew up still get counted.
+        """
+        def app(environ, start_response):
+            started = time.perf_counter()
+            statuses = []
+
+            def note_status(status, headers, *args):
+                statuses.append(status.split(' ', 1)[0])
+                return start_response(status, headers, *args)
+
+            try:
+                return wsgi_app(environ, note_status)
+            finally:
+                route = environ.get('metrics.route', 'unmatched')
+                method = environ.get('REQUEST_METHOD', '')
+                cls.count('http_requests_total', route=route, method=method,
+                          status=statuses[-1] if statuses else '500')
+                cls.observe('http_request_seconds', time.perf_counter() - started, route=route, method=method)
+                cls.publish_now_and_then()
+        return app
+
+    @classmethod
+    def registry(cls):
+        """
+        This process's (counters, histograms). A freshly forked worker
+        starts from nothing rather than counting its parent's numbers again.
+        """
+        if cls._pid != os.getpid():
+            with cls._lock:
+                if cls._pid != os.getpid():
+                    cls._counters = {}
+                    cls._histograms = {}
+                    cls._published = 0.0
+                    cls._pid = os.getpid()
+        return cls._counters, cls._histograms
+
+    @staticmethod
+    def labelled(name, labels) -> tuple:
+        return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+    @classmethod
+    def count(cls, name, amount=1, **labels) -> None:
+        counters, _ = cls.registry()
+        key = cls.labelled(name, labels)
+        with cls._lock:
+            counters[key] = counters.get(key, 0) + amount
+
+    @classmethod
+    def observe(cls, name, seconds, **labels) -> None:
+        """ADDS seconds TO A HISTOGRAM: ONE BUCKET'S COUNT, AND THE SUM"""
+        _, histograms = cls.registry()
+        key = cls.labelled(name, labels)
+        with cls._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                # a count for each bucket, one for +Inf, and the sum
+                histogram = histograms[key] = [0] * (len(cls.BUCKETS) + 1) + [0.0]
+            histogram[bisect_left(cls.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    @classmethod
+    def neon_call(cls, operation, status, seconds=None, body=None) -> None:
+        """
+        Counts one call to NeonCRM: status is its HTTP status, or the name
+        of whatever stopped it getting one. With the response body, what
+        NeonCRM said about the operation gets counted too.
+        """
+        cls.count('neon_requests_total', operation=operation, status=status)
+        if seconds is not None:
+            cls.observe('neon_request_seconds', seconds, operation=operation)
+        if body:
+            result = cls.OPERATION_RESULT.search(body, 0, 1024)
+            if result is not None:
+                result = result.group(1).decode()
+                error_code = ""
+                if result != 'SUCCESS':
+                    error = cls.ERROR_CODE.search(body, 0, 8192)
+                    error_code = error.group(1).decode() if error else ""
+                cls.count('neon_operation_results_total', operation=operation,
+                          result=result, error_code=error_code)
+
+    @classmethod
+    def session(cls, stats) -> None:
+        """COUNTS ONE REQUEST'S SESSION NUMBERS (SEE MeasuredSessionInterface.stats)"""
+        if stats['reads']:
+            cls.observe('session_store_seconds', stats['read_seconds'], operation='read')
+            if stats['read_bytes']:
+                cls.observe('session_codec_seconds', stats['decode_seconds'], operation='decode')
+                cls.count('session_bytes_total', stats['read_bytes'], operation='read')
+        if stats['writes']:
+            cls.observe('session_store_seconds', stats['write_seconds'], operation='write')
+            # every write encodes the whole session; only reads can come up empty
+            cls.observe('session_codec_seconds', stats['encode_seconds'], operation='encode')
+            cls.count('session_bytes_total', stats['write_bytes'], operation='write')
+
+    @staticmethod
+    def process() -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        """EVERYTHING THIS PROCESS HAS COUNTED, AS SOMETHING JSON CAN HOLD"""
+        counters, histograms = cls.registry()
+        with cls._lock:
+            return {
+                'at': time.time(),
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, list(value)] for (name, labels), value in histograms.items()],
+                'rate_limits': RateLimiter.stats(),
+                'circuit_breakers': CircuitBreaker.stats(),
+            }
+
+    @classmethod
+    def publish(cls) -> None:
+        """WRITES THIS PROCESS'S SNAPSHOT TO THE SHARED STORE"""
+        cls._published = time.monotonic()
+        store.redis().hset(cls.KEY, cls.process(), json.dumps(cls.snapshot()))
+
+    @classmethod
+    def publish_now_and_then(cls) -> None:
+        """PUBLISHES IF IT'S BEEN PUBLISH_INTERVAL SINCE THE LAST TIME, WITHOUT EVER GETTING IN THE WAY"""
+        if time.monotonic() - cls._published < cls.PUBLISH_INTERVAL:
+            return
+        try:
+            cls.publish()
+        except Exception as error:
+            Tracer.log('metrics_publish_failed', error=error)
+
+    @classmethod
+    def snapshots(cls) -> list:
+        """EVERY LIVE PROCESS'S LATEST SNAPSHOT, THIS ONE'S UP TO THE MOMENT, DROPPING ANY THAT HAVE GONE QUIET"""
+        cls.publish()
+        redis = store.redis()
+        now = time.time()
+        snapshots, gone = [], []
+        for process, stored in redis.hgetall(cls.KEY).items():
+            snapshot = json.loads(stored)
+            if now - snapshot['at'] > cls.PROCESS_TTL:
+                gone.append(process)
+            else:
+                snapshots.append(snapshot)
+        if gone:
+            redis.hdel(cls.KEY, *gone)
+        return snapshots
+
+    @classmethod
+    def combine(cls, snapshots) -> tuple:
+        """ADDS SNAPSHOTS UP INTO (counters, histograms), BOTH KEYED BY (name, labels)"""
+        counters, histograms = {}, {}
+
+        def add(name, value, **labels):
+            key = cls.labelled(name, labels)
+            counters[key] = counters.get(key, 0) + value
+
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if key in histograms:
+                    histograms[key] = [mine + theirs for mine, theirs in zip(histograms[key], value)]
+                else:
+                    histograms[key] = value
+            for budget, stats in snapshot['rate_limits'].items():
+                add('neon_rate_limit_granted_total', stats['granted'], budget=budget)
+                add('neon_rate_limit_delayed_total', stats['delayed'], budget=budget)
+                add('neon_rate_limit_rejected_total', stats['rejected'], budget=budget)
+                add('neon_rate_limit_wait_seconds_total', stats['wait_seconds'], budget=budget)
+                add('neon_rate_limit_waiting', stats['waiting'], budget=budget)
+            for operation, stats in snapshot['circuit_breakers'].items():
+                add('neon_circuit_breaker_open', int(stats['state'] != 'closed'), operation=operation)
+                add('neon_circuit_breaker_opened_total', stats['times_opened'], operation=operation)
+                add('neon_circuit_breaker_rejected_total', stats['rejected'], operation=operation)
+        add('metrics_processes', len(snapshots))
+        return counters, histograms
+
+    @classmethod
+    def exposition(cls, gauges=None) -> str:
+        """
+        Every process's numbers added up, in Prometheus's text format, plus
+        any gauges given as {name: (help, [(labels, value), ...])} for things
+        that are the same whichever process looks (like the write queue).
+        """
+        counters, histograms = cls.combine(cls.snapshots())
+        lines = []
+        for name in sorted({name for name, _ in counters} | {name for name, _ in histograms}):
+            kind, description = cls.DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{cls.format_labels(labels)} {cls.format_value(value)}")
+            for (metric, labels), value in sorted(histograms.items()):
+                if metric == name:
+                    lines.extend(cls.histogram_lines(name, labels, value))
+        for name, (description, samples) in (gauges or {}).items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{cls.format_labels(cls.labelled(name, labels)[1])} {cls.format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def histogram_lines(cls, name, labels, value) -> list:
+        """A HISTOGRAM'S _bucket LINES (WHICH PROMETHEUS WANTS CUMULATIVE), _sum AND _count"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(cls.BUCKETS + ('+Inf',), value):
+            cumulative += count
+            lines.append(f"{name}_bucket{cls.format_labels(labels + (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{name}_sum{cls.format_labels(labels)} {cls.format_value(value[-1])}")
+        lines.append(f"{name}_count{cls.format_labels(labels)} {cumulative}")
+        return lines
+
+    @staticmethod
+    def format_labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+    @staticmethod
+    def format_value(value) -> str:
+        return repr(float(value)) if isinstance(value, float) else str(value)
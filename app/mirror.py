@@ -0,0 +1,360 @@
+"""
+A local SQLite copy of every Points_c and Data_Updates_c record in the org.
+
+Whenever staff wanted to know something like "how many different people
+came to Pythonistas this quarter", the only way to find out was to pull
+every record out of NeonCRM again. The mirror keeps a copy of them in a
+SQLite file (MIRROR_PATH) with indexes on who, which user group and when,
+so questions like that are a query, not an export.
+
+'flask sync-mirror' brings it up to date. After the first sync, which pulls
+everything, it only asks NeonCRM for records created since the newest one
+it already has (less MIRROR_OVERLAP_SECONDS, in case some were slow to
+show up), so run every few minutes -- 'flask sync-mirror --every 300', or
+from cron -- it's a page or two each time. Records deleted in NeonCRM stay
+in the mirror until a 'flask sync-mirror --full' rebuilds it.
+
+With MIRROR_PATH set and a sync no older than MIRROR_MAX_AGE_SECONDS, a
+member's points are worked out from the mirror too, plus whatever NeonCRM
+has for them that's newer than the last sync -- usually one short page,
+however long their history is -- so a check-in from a minute ago still
+counts. Staff reports ('flask mirror-report', or /admin/reports/...) only
+read the mirror, so they're as fresh as the last sync.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from datetime import date, datetime, timedelta
+
+from .export import CustomObjectPages, PointsExport
+from .neoncrm import API, PointsEvent, RewardLadder
+from .tracing import Tracer
+
+
+def whole_number(value) -> int:
+    return int(value or 0)
+
+
+class Mirror:
+
+    PATH = os.getenv("MIRROR_PATH", "")
+    # how often 'flask sync-mirror --every' syncs, by default
+    SYNC_INTERVAL = int(os.getenv("MIRROR_SYNC_SECONDS", "300"))
+    # past this, the mirror's too far behind to work anybody's points out from
+    MAX_AGE = int(os.getenv("MIRROR_MAX_AGE_SECONDS", str(2 * SYNC_INTERVAL)))
+    OVERLAP = timedelta(seconds=int(os.getenv("MIRROR_OVERLAP_SECONDS", "300")))
+    PAGE_SIZE = int(os.getenv("MIRROR_PAGE_SIZE", "200"))
+    WORKERS = int(os.getenv("MIRROR_WORKERS", "4"))
+    NEON_TIME = "%m/%d/%Y %H:%M:%S"
+
+    # for each object: its table, and its (NeonCRM column, our column, how to
+    # convert it) -- the first three are always id, constituent and createTime.
+    # Data_Updates_c's LinkedIn URLs are left in NeonCRM, since no report needs them.
+    TABLES = {
+        'Points_c': ('points', (
+            ('id', 'id', whole_number),
+            ('Constituent_c', 'account', str),
+            ('createTime', 'created', PointsExport.iso_time),
+            ('point_type_c', 'type', str),
+            ('point_subtype_c', 'subtype', str),
+            ('Points_Awarded_c', 'points', whole_number),
+            ('name', 'name', str),
+        )),
+        'Data_Updates_c': ('data_updates', (
+            ('id', 'id', whole_number),
+            ('Constituent_c', 'account', str),
+            ('createTime', 'created', PointsExport.iso_time),
+            ('update_type_c', 'update_type', str),
+            ('name', 'name', str),
+        )),
+    }
+
+    # created is "%Y-%m-%d %H:%M:%S", in NeonCRM's time, so it sorts and
+    # compares as text. The user group index has account on the end so that
+    # counting different people only ever reads the index.
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS points (
+        id INTEGER PRIMARY KEY,
+        account TEXT NOT NULL,
+        created TEXT NOT NULL,
+        type TEXT NOT NULL,
+        subtype TEXT NOT NULL,
+        points INTEGER NOT NULL,
+        name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS points_by_account ON points (account, created);
+    CREATE INDEX IF NOT EXISTS points_by_group ON points (type, subtype, created, account);
+    CREATE INDEX IF NOT EXISTS points_by_created ON points (created);
+
+    CREATE TABLE IF NOT EXISTS data_updates (
+        id INTEGER PRIMARY KEY,
+        account TEXT NOT NULL,
+        created TEXT NOT NULL,
+        update_type TEXT NOT NULL,
+        name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS data_updates_by_account ON data_updates (account, created);
+    CREATE INDEX IF NOT EXISTS data_updates_by_type ON data_updates (update_type, created, account);
+
+    -- where each object's last finished sync got to
+    CREATE TABLE IF NOT EXISTS synced (
+        object TEXT PRIMARY KEY,
+        watermark TEXT,
+        synced_at REAL NOT NULL,
+        records INTEGER NOT NULL
+    );
+    """
+
+    # a connection per thread (sqlite3 won't share one), and none inherited
+    # across a fork
+    _local = threading.local()
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return bool(cls.PATH)
+
+    @classmethod
+    def connection(cls) -> sqlite3.Connection:
+        """
+        This thread's connection to the mirror, opened (and the schema made)
+        the first time it's asked for. It's in WAL mode, so the sync can
+        write while every worker reads, and in autocommit mode, so
+        transactions are only ever the ones we BEGIN ourselves.
+        """
+        local = cls._local
+        if getattr(local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(cls.PATH, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(cls.SCHEMA)
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    @classmethod
+    def sync(cls, full=False, workers=WORKERS, progress=None) -> dict:
+        """SYNCS EVERY MIRRORED OBJECT, RETURNING HOW MANY RECORDS EACH GOT"""
+        return {
+            object_name: cls.sync_object(object_name, full, workers, progress)
+            for object_name in cls.TABLES
+        }
+
+    @classmethod
+    def sync_object(cls, object_name, full=False, workers=WORKERS, progress=None) -> int:
+        """
+        Fetches an object's records created since its watermark (or all of
+        them, if full or it's never been synced) and puts them in the
+        mirror, a page per transaction. The watermark only moves once every
+        page is in, so a sync that doesn't finish is just done again next
+        time -- the records it did get are simply replaced. A full sync
+        replaces the whole table in one transaction, so readers see the old
+        copy until it's finished. progress, if given, is called with
+        (object, page number, how many pages) after every page.
+        """
+        table, columns = cls.TABLES[object_name]
+        connection = cls.connection()
+        row = connection.execute("SELECT watermark FROM synced WHERE object = ?", (object_name,)).fetchone()
+        watermark = None if full or row is None else row[0]
+        criteria = ()
+        if watermark:
+            since = datetime.fromisoformat(watermark) - cls.OVERLAP
+            criteria = (('createTime', 'GREATER_AND_EQUAL', since.strftime(cls.NEON_TIME)),)
+        pages = CustomObjectPages(object_name, [column for column, _, _ in columns], criteria, cls.PAGE_SIZE)
+        insert = (
+            f"INSERT OR REPLACE INTO {table} ({', '.join(name for _, name, _ in columns)})"
+            f" VALUES ({', '.join('?' for _ in columns)})"
+        )
+        records = 0
+        newest = watermark or ''
+        if full:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(f"DELETE FROM {table}")
+        try:
+            for page_number, page, total_pages in pages.walk(1, workers):
+                rows = [
+                    tuple(convert(record.get(column, '')) for column, _, convert in columns)
+                    for record in page
+                ]
+                if not full:
+                    connection.execute("BEGIN IMMEDIATE")
+                connection.executemany(insert, rows)
+                if not full:
+                    connection.execute("COMMIT")
+                records += len(rows)
+                newest = max([newest, *(row[2] for row in rows)])
+                if progress:
+                    progress(object_name, page_number, total_pages)
+            if not full:
+                connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT OR REPLACE INTO synced (object, watermark, synced_at, records)"
+                f" VALUES (?, ?, ?, (SELECT COUNT(*) FROM {table}))",
+                (object_name, newest or None, time.time())
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        return records
+
+    @classmethod
+    def status(cls) -> dict:
+        """FOR EACH OBJECT: ITS WATERMARK, WHEN IT WAS LAST SYNCED AND HOW MANY RECORDS IT HAS"""
+        if not cls.enabled():
+            return {}
+        return {
+            object_name: {'watermark': watermark, 'synced_at': synced_at, 'records': records}
+            for object_name, watermark, synced_at, records
+            in cls.connection().execute("SELECT object, watermark, synced_at, records FROM synced")
+        }
+
+    @classmethod
+    def fresh(cls, object_name='Points_c') -> bool:
+        """WHETHER THE MIRROR IS ON AND object_name WAS SYNCED RECENTLY ENOUGH TO USE"""
+        if not cls.enabled():
+            return False
+        try:
+            row = cls.connection().execute(
+                "SELECT synced_at FROM synced WHERE object = ?", (object_name,)
+            ).fetchone()
+        except sqlite3.Error as error:
+            # NeonCRM can still answer, so this shouldn't stop anybody
+            Tracer.log('mirror_read_failed', level='warning', error=error)
+            return False
+        return row is not None and time.time() - row[0] <= cls.MAX_AGE
+
+    @staticmethod
+    def stamp(created) -> int:
+        """A PointsEvent STAMP FROM ONE OF OUR "%Y-%m-%d %H:%M:%S" TIMES"""
+        return (
+            date(int(created[0:4]), int(created[5:7]), int(created[8:10])).toordinal() * 86400
+            + int(created[11:13]) * 3600 + int(created[14:16]) * 60 + int(created[17:19])
+        )
+
+    @classmethod
+    def point_events(cls, account):
+        """
+        Yields every one of a member's Points_c records as a PointsEvent:
+        the ones in the mirror, then any NeonCRM has that are newer than
+        the last sync. Only call it when the mirror's fresh().
+        """
+        connection = cls.connection()
+        # one snapshot, so the records and the watermark go together
+        connection.execute("BEGIN")
+        try:
+            rows = connection.execute(
+                "SELECT id, created, type, subtype, points FROM points WHERE account = ?", (str(account),)
+            ).fetchall()
+            watermark = connection.execute(
+                "SELECT watermark FROM synced WHERE object = 'Points_c'"
+            ).fetchone()[0]
+        finally:
+            connection.execute("COMMIT")
+        seen = set()
+        for record_id, created, point_type, point_subtype, awarded in rows:
+            seen.add(record_id)
+            yield PointsEvent(cls.stamp(created), point_type, point_subtype, awarded)
+
+        criteria = [('Constituent_c', 'EQUAL', str(account))]
+        if watermark:
+            since = datetime.fromisoformat(watermark) - cls.OVERLAP
+            criteria.append(('createTime', 'GREATER_AND_EQUAL', since.strftime(cls.NEON_TIME)))
+        newer = CustomObjectPages(
+            'Points_c', ('id', 'createTime', 'point_type_c', 'point_subtype_c', 'Points_Awarded_c'),
+            criteria, API.POINTS_PAGE_SIZE, operation='points', retries=0
+        )
+        page_number = total_pages = 1
+        while page_number <= total_pages:
+            records, total_pages = newer.fetch(page_number)
+            for record in records:
+                if whole_number(record.get('id')) not in seen:
+                    yield PointsEvent(
+                        PointsEvent.parse_timestamp(record['createTime']),
+                        record.get('point_type_c', ''),
+                        record.get('point_subtype_c', ''),
+                        whole_number(record.get('Points_Awarded_c')),
+                    )
+            page_number += 1
+
+
+class Reports:
+    """
+    Staff reports, straight out of the mirror. Every one takes since and
+    until as dates (either can be None, for no limit; until is the last day
+    included) and returns a list of dicts, biggest first.
+    """
+
+    CHECK_IN = 'check-in'
+    NAMES = ('attendance', 'data-updates', 'rewards')
+
+    @staticmethod
+    def between(since, until) -> tuple:
+        """A WHERE CLAUSE (AND ITS PARAMETERS) FOR created FALLING BETWEEN since AND until"""
+        clauses, parameters = [], []
+        if since:
+            clauses.append("created >= ?")
+            parameters.append(since.isoformat())
+        if until:
+            clauses.append("created < ?")
+            parameters.append((until + timedelta(days=1)).isoformat())
+        return clauses, parameters
+
+    @classmethod
+    def attendance(cls, since=None, until=None, group=None) -> list:
+        """FOR EACH USER GROUP: HOW MANY CHECK-INS, AND HOW MANY DIFFERENT PEOPLE THEY WERE"""
+        clauses, parameters = cls.between(since, until)
+        clauses.insert(0, "type = ?")
+        parameters.insert(0, cls.CHECK_IN)
+        if group:
+            clauses.insert(1, "subtype = ?")
+            parameters.insert(1, group)
+        return [
+            {'group': subtype, 'check_ins': check_ins, 'people': people}
+            for subtype, check_ins, people in Mirror.connection().execute(
+                "SELECT subtype, COUNT(*), COUNT(DISTINCT account) FROM points"
+                f" WHERE {' AND '.join(clauses)}"
+                " GROUP BY subtype ORDER BY 3 DESC, 2 DESC, 1",
+                parameters
+            )
+        ]
+
+    @classmethod
+    def data_updates(cls, since=None, until=None) -> list:
+        """FOR EACH KIND OF DATA UPDATE: HOW MANY, AND FROM HOW MANY DIFFERENT PEOPLE"""
+        clauses, parameters = cls.between(since, until)
+        return [
+            {'update_type': update_type, 'updates': updates, 'people': people}
+            for update_type, updates, people in Mirror.connection().execute(
+                "SELECT update_type, COUNT(*), COUNT(DISTINCT account) FROM data_updates"
+                f" WHERE {' AND '.join(clauses) or '1'}"
+                " GROUP BY update_type ORDER BY 2 DESC, 1",
+                parameters
+            )
+        ]
+
+    @classmethod
+    def rewards(cls, incentives, since=None, until=None, limit=None) -> list:
+        """
+        Every member's points (earned between since and until), with the
+        rewards that's worth and what's next, most points first -- for
+        working out who's owed what.
+        """
+        clauses, parameters = cls.between(since, until)
+        query = (
+            "SELECT account, SUM(points) AS total FROM points"
+            f" WHERE {' AND '.join(clauses) or '1'}"
+            " GROUP BY account ORDER BY total DESC, account"
+        )
+        if limit:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        members = Mirror.connection().execute(query, parameters).fetchall()
+        rewards = RewardLadder.of(incentives).evaluate([total for _, total in members])
+        return [
+            {'account': account, 'points': total, **earned}
+            for (account, total), earned in zip(members, rewards)
+        ]
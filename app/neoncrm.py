@@ -8,30 +8,226 @@ ultimately we want to be able to access th url to get an oath token with
 breadcrums leading us back to where it's defined in the source code.
 """
 
+import hashlib
+import json
 import os
 import requests
 import random
+import threading
+import time
 
-from . import timezones
-from datetime import datetime
+from . import store, timezones
+from .breaker import CircuitBreaker, CircuitOpen
+from .metrics import Metrics
+from .tracing import Tracer, TracedPool
+from .ratelimit import RateLimited, RateLimiter
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from bisect import bisect_right
+from datetime import date, datetime
+from functools import lru_cache
+from operator import attrgetter
 from flask import session, abort
+from redis.exceptions import LockError
+from requests.adapters import HTTPAdapter
+from typing import NamedTuple
+
+
+class OperationFailed(ConnectionError):
+    """
+    NeonCRM answered, but not with what we asked for: anything but a 200,
+    or a 200 whose operationResult isn't SUCCESS. codes are the errorCodes
+    it gave (see API.ERROR_CODE_DESCRIPTION).
+    """
+
+    def __init__(self, message, codes=()):
+        super().__init__(message)
+        self.codes = set(codes)
+
+class Client:
+    """
+    The one door every request to NeonCRM walks through.
+
+    Each worker process keeps a single requests.Session whose adapter holds a
+    pool of keep-alive connections, so a login that makes half a dozen calls
+    to api.neoncrm.com only pays for the TCP+TLS handshake once. Every call is
+    named after the operation it performs ('points', 'incentives', ...) and
+    that name picks its (connect, read) timeout out of TIMEOUTS.
+    """
+
+    POOL_SIZE = int(os.getenv("NEON_POOL_SIZE", "10"))
+    CONNECT_TIMEOUT = float(os.getenv("NEON_CONNECT_TIMEOUT", "3.05"))
+    READ_TIMEOUT = float(os.getenv("NEON_READ_TIMEOUT", "15"))
+    FANOUT_WORKERS = int(os.getenv("NEON_FANOUT_WORKERS", "8"))
+    # (connect, read) timeouts per operation; anything not listed here gets
+    # the defaults above. Listing every points record can take a while for
+    # our most active members, so it gets the most generous read timeout.
+    TIMEOUTS = {
+        'token': (CONNECT_TIMEOUT, 10),
+        'api_login': (CONNECT_TIMEOUT, 10),
+        'account_info': (CONNECT_TIMEOUT, 10),
+        'points': (CONNECT_TIMEOUT, 20),
+        'incentives': (CONNECT_TIMEOUT, 10),
+        'checkin_create': (CONNECT_TIMEOUT, 15),
+        'data_update_create': (CONNECT_TIMEOUT, 15),
+        # only ever opening connections ahead of an event (see warmup.py)
+        'warmup': (CONNECT_TIMEOUT, 5),
+        # org-wide pages of records for staff (see export.py)
+        'export': (CONNECT_TIMEOUT, 30),
+    }
+
+    # everything a call to NeonCRM can fail with once it's been given up on
+    FAILURES = (ConnectionError, requests.RequestException)
+
+    _session = None
+    _pid = None
+    _pool = None
+    _pool_pid = None
+    _prefetch = None
+    _prefetch_pid = None
+
+    @classmethod
+    def http(cls) -> requests.Session:
+        """
+        Returns this process's pooled session, building it the first time
+        it's asked for. Gunicorn forks workers after import, and a forked
+        child must never share sockets with its parent, so the session is
+        rebuilt whenever the process id changes.
+        """
+        if cls._session is None or cls._pid != os.getpid():
+            http = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=2,
+                pool_maxsize=cls.POOL_SIZE,
+            )
+            http.mount('https://', adapter)
+            http.mount('http://', adapter)
+            cls._session = http
+            cls._pid = os.getpid()
+        return cls._session
+
+    @classmethod
+    def fanout(cls) -> ThreadPoolExecutor:
+        """
+        Returns this process's bounded pool of threads for running
+        independent NeonCRM calls side by side. Like the session, it's
+        rebuilt in a freshly forked worker.
+        """
+        if cls._pool is None or cls._pool_pid != os.getpid():
+            cls._pool = TracedPool(
+                max_workers=cls.FANOUT_WORKERS,
+                thread_name_prefix='neoncrm'
+            )
+            cls._pool_pid = os.getpid()
+        return cls._pool
+
+    @classmethod
+    def prefetch(cls) -> ThreadPoolExecutor:
+        """
+        Returns this process's pool for fetching the next page of something
+        while the current one is being worked on. It's kept apart from the
+        fanout pool because paging often happens inside a fanout task, and a
+        task waiting on its own (full) pool would wait forever.
+        """
+        if cls._prefetch is None or cls._prefetch_pid != os.getpid():
+            cls._prefetch = TracedPool(
+                max_workers=cls.FANOUT_WORKERS,
+                thread_name_prefix='neoncrm-prefetch'
+            )
+            cls._prefetch_pid = os.getpid()
+        return cls._prefetch
+
+    @classmethod
+    def timeout(cls, operation) -> tuple:
+        """LOOKS UP THE (connect, read) TIMEOUT FOR A NAMED OPERATION"""
+        return cls.TIMEOUTS.get(
+            operation, (cls.CONNECT_TIMEOUT, cls.READ_TIMEOUT)
+        )
+
+    @classmethod
+    def request(cls, operation, method, url, **kwargs) -> requests.Response:
+        """
+        Sends one request to NeonCRM over the pooled session, as long as the
+        operation's circuit breaker is closed and once the shared rate limit
+        lets it through. How it went is counted against the breaker, in the
+        metrics, and as a span of the request's trace.
+        """
+        with Tracer.span('neon', operation=operation, method=method) as span:
+            kwargs.setdefault('timeout', cls.timeout(operation))
+            breaker = CircuitBreaker.of(operation)
+            try:
+                breaker.guard()
+            except CircuitOpen:
+                Metrics.neon_call(operation, 'circuit_open')
+                raise
+            try:
+                with Tracer.span('rate_limit', operation=operation):
+                    RateLimiter.acquire(operation)
+            except RateLimited:
+                breaker.release()
+                Metrics.neon_call(operation, 'rate_limited')
+                raise
+            started = time.monotonic()
+            try:
+                response = cls.http().request(method, url, **kwargs)
+            except requests.RequestException as error:
+                seconds = time.monotonic() - started
+                breaker.record(seconds, False)
+                Metrics.neon_call(operation, type(error).__name__, seconds)
+                raise
+            except BaseException:
+                breaker.release()
+                raise
+            seconds = time.monotonic() - started
+            breaker.record(seconds, cls.healthy(response))
+            Metrics.neon_call(operation, response.status_code, seconds, response.content)
+            span.set(status=response.status_code, bytes=len(response.content))
+            return response
+
+    @staticmethod
+    def healthy(response) -> bool:
+        """
+        Whether a response counts as a success for the breaker. NeonCRM
+        answers 200 even when the operation failed (error codes 1-5), so a
+        200 only counts if its operationResult, when it has one, is SUCCESS.
+        Works on requests' and httpx's responses alike.
+        """
+        if response.status_code >= 500 or response.status_code == 429:
+            return False
+        result = Metrics.OPERATION_RESULT.search(response.content, 0, 1024)
+        return result is None or result.group(1) == b'SUCCESS'
+
+    @classmethod
+    def get(cls, operation, url, **kwargs) -> requests.Response:
+        return cls.request(operation, 'GET', url, **kwargs)
+
+    @classmethod
+    def post(cls, operation, url, **kwargs) -> requests.Response:
+        return cls.request(operation, 'POST', url, **kwargs)
 
 class API:
     """INTERFACE CLASS REPRESENTING NEONCRM AND HOW WE INTERACT WITH IT"""
 
+    # Where NeonCRM lives. Both can be pointed somewhere else, like the fake
+    # NeonCRM in tools/fakeneon.py, for testing.
+    API_BASE = os.getenv("NEON_API_BASE", "https://api.neoncrm.com").rstrip('/')
+    OAUTH_BASE = os.getenv("NEON_OAUTH_BASE", "https://app.neoncrm.com").rstrip('/')
+
     LOGIN_URL = "https://{}.app.neoncrm.com/np/oauth/auth?response_type=code&client_id={}&redirect_uri={}"
-    ACCESS_TOKEN_URL = 'https://app.neoncrm.com/np/oauth/token'
-    API_LOGIN_URL = "https://api.neoncrm.com/neonws/services/api/common/login?login.apiKey={}&login.orgid={}"
-    CONSTITUENT_INFO_URL = "https://api.neoncrm.com/neonws/services/api/account/retrieveIndividualAccount?userSessionId={}&accountId={}"
+    ACCESS_TOKEN_URL = OAUTH_BASE + '/np/oauth/token'
+    API_LOGIN_URL = API_BASE + "/neonws/services/api/common/login?login.apiKey={}&login.orgid={}"
+    CONSTITUENT_INFO_URL = API_BASE + "/neonws/services/api/account/retrieveIndividualAccount?userSessionId={}&accountId={}"
     # incentives url takes user_session_id
-    INCENTIVES_URL = "https://api.neoncrm.com/neonws/services/api/customObjectRecord/listCustomObjectRecords?userSessionId={}&objectApiName=Incentives_c&customObjectOutputFieldList.customObjectOutputField.label=Incentive&customObjectOutputFieldList.customObjectOutputField.columnName=name&customObjectOutputFieldList.customObjectOutputField.label=Points Needed&customObjectOutputFieldList.customObjectOutputField.columnName=Points_Needed_c"
-    POINTS_URL = "https://api.neoncrm.com/neonws/services/api/customObjectRecord/listCustomObjectRecords?userSessionId={}&objectApiName=Points_c&customObjectSearchCriteriaList.customObjectSearchCriteria.criteriaField=Constituent_c&customObjectSearchCriteriaList.customObjectSearchCriteria.operator=EQUAL&customObjectSearchCriteriaList.customObjectSearchCriteria.value={}&customObjectOutputFieldList.customObjectOutputField.label=Points Activity&customObjectOutputFieldList.customObjectOutputField.columnName=name&customObjectOutputFieldList.customObjectOutputField.label=Created on&customObjectOutputFieldList.customObjectOutputField.columnName=createTime&customObjectOutputFieldList.customObjectOutputField.label=point_type&customObjectOutputFieldList.customObjectOutputField.columnName=point_type_c&customObjectOutputFieldList.customObjectOutputField.label=point_subtype&customObjectOutputFieldList.customObjectOutputField.columnName=point_subtype_c&customObjectOutputFieldList.customObjectOutputField.label=Points Awarded&customObjectOutputFieldList.customObjectOutputField.columnName=Points_Awarded_c&page.pageSize=200"
+    INCENTIVES_URL = API_BASE + "/neonws/services/api/customObjectRecord/listCustomObjectRecords?userSessionId={}&objectApiName=Incentives_c&customObjectOutputFieldList.customObjectOutputField.label=Incentive&customObjectOutputFieldList.customObjectOutputField.columnName=name&customObjectOutputFieldList.customObjectOutputField.label=Points Needed&customObjectOutputFieldList.customObjectOutputField.columnName=Points_Needed_c"
+    POINTS_URL = API_BASE + "/neonws/services/api/customObjectRecord/listCustomObjectRecords?userSessionId={}&objectApiName=Points_c&customObjectSearchCriteriaList.customObjectSearchCriteria.criteriaField=Constituent_c&customObjectSearchCriteriaList.customObjectSearchCriteria.operator=EQUAL&customObjectSearchCriteriaList.customObjectSearchCriteria.value={}&customObjectOutputFieldList.customObjectOutputField.label=Points Activity&customObjectOutputFieldList.customObjectOutputField.columnName=name&customObjectOutputFieldList.customObjectOutputField.label=Created on&customObjectOutputFieldList.customObjectOutputField.columnName=createTime&customObjectOutputFieldList.customObjectOutputField.label=point_type&customObjectOutputFieldList.customObjectOutputField.columnName=point_type_c&customObjectOutputFieldList.customObjectOutputField.label=point_subtype&customObjectOutputFieldList.customObjectOutputField.columnName=point_subtype_c&customObjectOutputFieldList.customObjectOutputField.label=Points Awarded&customObjectOutputFieldList.customObjectOutputField.columnName=Points_Awarded_c&page.currentPage={}&page.pageSize={}"
+    # Points_c comes back a page at a time; POINTS_URL takes the page number and this
+    POINTS_PAGE_SIZE = 200
     # event checkin url requires these arguments: user_session_id, access_token, selected_group, checkin_record_name
-    EVENT_CHECKIN_URL = "https://api.neoncrm.com/neonws/services/api/customObjectRecord/createCustomObjectRecord?userSessionId={}&customObjectRecord.objectApiName=Points_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=Constituent_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=type_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value=check-in&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=subtype_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=name&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}"
+    EVENT_CHECKIN_URL = API_BASE + "/neonws/services/api/customObjectRecord/createCustomObjectRecord?userSessionId={}&customObjectRecord.objectApiName=Points_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=Constituent_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=type_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value=check-in&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=subtype_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=name&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}"
     # event checkin url requires these arguments: user_session_id, access_token, data update subtype, record name
-    DATA_UPDATE_POINTS_OBJECT_URL = "https://api.neoncrm.com/neonws/services/api/customObjectRecord/createCustomObjectRecord?userSessionId={}&customObjectRecord.objectApiName=Points_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=Constituent_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=type_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value=data update&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=subtype_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=name&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}"
+    DATA_UPDATE_POINTS_OBJECT_URL = API_BASE + "/neonws/services/api/customObjectRecord/createCustomObjectRecord?userSessionId={}&customObjectRecord.objectApiName=Points_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=Constituent_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=type_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value=data update&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=subtype_for_api_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=name&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}"
     # linkedin data update custom object creation url requires these arguments: user_session_id, access_token, linkedin username/url, record name, update subtype
-    DATA_UPDATE_DATA_UPDATE_RECORD_CREATION_LINKEDIN_URL = "https://api.neoncrm.com/neonws/services/api/customObjectRecord/createCustomObjectRecord?userSessionId={}&customObjectRecord.objectApiName=Data_Updates_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=Constituent_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=linkedin_URL_or_username_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=name&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=update_type_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}"
+    DATA_UPDATE_DATA_UPDATE_RECORD_CREATION_LINKEDIN_URL = API_BASE + "/neonws/services/api/customObjectRecord/createCustomObjectRecord?userSessionId={}&customObjectRecord.objectApiName=Data_Updates_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=Constituent_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=linkedin_URL_or_username_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=name&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}&customObjectRecord.customObjectRecordDataList.customObjectRecordData.name=update_type_c&customObjectRecord.customObjectRecordDataList.customObjectRecordData.value={}"
     ERROR_CODE_DESCRIPTION = {
         '1': "An unknown system error. Often, these are generated due to a badly formed API request or a problem in NeonCRM.",
         '2': "Indicates a temporary problem with NeonCRM's servers.",
@@ -52,7 +248,8 @@ class API:
         }
         request_headers = {'Content-Type': 'application/x-www-form-urlencoded'}
 
-        response = requests.post(
+        response = Client.post(
+            'token',
             cls.ACCESS_TOKEN_URL,
             data=request_payload,
             headers=request_headers
@@ -63,72 +260,729 @@ class API:
 
     @classmethod
     def get_consituent_info(cls):
-        cls.attempt_api_login()
-
-        if (cls.login_sucessful()):
+        if (cls.login_sucessful(cls.attempt_api_login())):
             pass
 
     @classmethod
-    def attempt_api_login(cls) -> None:
+    def attempt_api_login(cls) -> dict:
         """
-        Attempts to login to the api and stores whatever login response was
-        given as a key in the server's cache. It's extremely important to save
-        the entire response and then just get the parts of it we want as we need
-        them.
+        Attempts to login to the api as our org's API user and returns
+        whatever loginResponse was given. If the login didn't work we print
+        out everything NeonCRM told us about why and raise a ConnectionError.
         """
-        api_response = requests.get(
+        api_response = Client.get(
+            'api_login',
             cls.API_LOGIN_URL.format(
                 os.getenv("API_KEY"),
                 os.getenv("ORG_ID")
             )
         )
-        if (api_response.status_code == 200):
-            session["login_response"] = (
-                api_response.json().get(
-                    'loginResponse', {}
-                )
-            )
-        else:
+        if (api_response.status_code != 200):
+            # if the HTTP request itself to the API failed to connect,
+            # we'll admit our problem and print our the status code:
+            print('Sadly, could not even connect to the api...', api_response.status_code)
             raise ConnectionError()
+        # For context, a successful loginResponse would look something like:
+        # "loginResponse": {
+        #     "operationResult": "SUCCESS",
+        #     "responseMessage": "User logged in.",
+        #     "responseDateTime": "2012-12-25T21:26:41.981-06:00",
+        #     "userSessionId": "T1356492402097"
+        # }
+        login_response = api_response.json().get('loginResponse', {})
+        if not cls.login_sucessful(login_response):
+            print("I am mortified to admit that the api login failed. Maybe someone canceled the atlas user account? The system replied: ", login_response.get('operationResult'))
+            # if there are specific errors provided, we'll print them out too
+            for error in login_response.get('errors', {}).get('error', []):
+                error_code = str(error['errorCode'])
+                error_description = cls.ERROR_CODE_DESCRIPTION.get(error_code, "No description available.")
+                print(f"Error code: {error_code}, Message: {error['errorMessage']}. Description: {error_description}")
+            raise ConnectionError()
+        if not login_response.get('userSessionId'):
+            print("login failed. No user session ID received.")
+            raise ConnectionError()
+        return login_response
 
     @staticmethod
-    def login_sucessful():
-        """VERIFIES THAT THE ATTEMPT TO LOGIN THE USER WAS SUCESSFUL"""
+    def operation_succeeded(response) -> bool:
+        """
+        VERIFIES THAT NEONCRM NOT ONLY ANSWERED, BUT ALSO SAYS THE OPERATION
+        (e.g. createCustomObjectRecordResponse) WAS A SUCCESS
+        """
+        if response.status_code != 200:
+            return False
+        return all(
+            value.get('operationResult', 'SUCCESS') == 'SUCCESS'
+            for value in response.json().values()
+            if isinstance(value, dict)
+        )
+
+    # NeonCRM's error codes for a userSessionId it doesn't know (any more)
+    SESSION_ERRORS = {'3', '4'}
+
+    @classmethod
+    def result(cls, response, response_name, what, user_session_id=None) -> dict:
+        """
+        The response_name part of one of NeonCRM's answers, like
+        listCustomObjectRecordsResponse, or OperationFailed if it's anything
+        but a 200 saying SUCCESS. If NeonCRM has forgotten user_session_id,
+        it's dropped from the SessionBroker too, so the next call logs in
+        again rather than making the same mistake.
+        """
+        if response.status_code != 200:
+            raise OperationFailed(f"{what} failed with {response.status_code}")
+        answer = response.json().get(response_name, {})
+        if answer.get('operationResult') != 'SUCCESS':
+            codes = {str(error.get('errorCode')) for error in answer.get('errors', {}).get('error', [])}
+            if user_session_id and codes & cls.SESSION_ERRORS:
+                SessionBroker.invalidate(user_session_id)
+            raise OperationFailed(f"{what} failed with error code(s) {sorted(codes)}", codes)
+        return answer
+
+    @staticmethod
+    def login_sucessful(login_response):
+        """VERIFIES THAT THE ATTEMPT TO LOGIN THE API USER WAS SUCESSFUL"""
         return (
-            session.get('loginResponse', {})
-                .get('operationResult', "") == 'SUCCESS'
+            login_response.get('operationResult', "") == 'SUCCESS'
         )
 
     @staticmethod
     def retrieve_user_session_id():
         """
-        Retrieves the value of userSessionId from the last login response
-        stored in the server cache. Will eventually perform the check to see
-        if ten minutes have passed and ask for a new one.
+        Retrieves the userSessionId every request should use to talk to
+        NeonCRM. It's the same one for everybody, and SessionBroker takes care
+        of asking for a new one before the old one's ten minutes are up.
         """
-        return (
-            session.get("login_response", {})
-                .get('userSessionId', "")
-        )
+        return SessionBroker.user_session_id()
+
+class SessionBroker:
+    """
+    Keeps the one API userSessionId the whole app shares.
+
+    Logging in as the API user used to happen on every single constituent
+    login. Now the ID lives in the shared Redis store where every worker can
+    see it, plus a copy in each process so most requests don't even have to
+    ask Redis. NeonCRM forgets a userSessionId after ten minutes, so once an
+    ID gets within REFRESH_MARGIN seconds of that, whichever worker notices
+    first logs in again on a background thread while everybody (the request
+    that noticed included) keeps using the old, still good, one. Only when
+    an ID has actually expired does anybody have to wait.
+    """
+
+    KEY = 'neoncrm:api_session'
+    LOCK_KEY = 'neoncrm:api_session:lock'
+    LIFETIME = int(os.getenv("NEON_SESSION_LIFETIME", "600"))
+    REFRESH_MARGIN = int(os.getenv("NEON_SESSION_REFRESH_MARGIN", "120"))
+
+    _cached = None
+    _lock = threading.Lock()
+    # the process that's refreshing in the background right now, if any
+    _refreshing = None
+
+    @classmethod
+    def user_session_id(cls) -> str:
+        """
+        Hands out the shared userSessionId. One that's only due for a
+        refresh is still handed out straight away, with the refresh left to
+        a background thread, so nobody waits on a login unless there's no
+        ID that still works.
+        """
+        cached = cls._cached
+        if cached and time.time() < cached['refresh_at']:
+            return cached['id']
+        shared = store.get_json(cls.KEY)
+        if shared and time.time() < shared['refresh_at']:
+            cls._cached = shared
+            return shared['id']
+        still_good = [
+            candidate for candidate in (shared, cached)
+            if candidate and time.time() < candidate['expires_at']
+        ]
+        if still_good:
+            cls.refresh_in_background()
+            return still_good[0]['id']
+        with cls._lock:
+            # whoever had the lock before us may have just logged in
+            cached = cls._cached
+            if cached and time.time() < cached['expires_at']:
+                return cached['id']
+            fresh = cls.refresh(blocking=True)
+            if fresh is None:
+                # we waited as long as we were willing to on another worker's
+                # login; see if it finished, and give up if it didn't
+                fresh = store.get_json(cls.KEY)
+                if not fresh:
+                    raise ConnectionError()
+            cls._cached = fresh
+            return fresh['id']
+
+    @classmethod
+    def refresh_in_background(cls) -> None:
+        """STARTS A REFRESH ON A THREAD OF ITS OWN, UNLESS THIS PROCESS ALREADY HAS ONE GOING"""
+        with cls._lock:
+            if cls._refreshing == os.getpid():
+                return
+            cls._refreshing = os.getpid()
+
+        def refresh():
+            try:
+                # if another worker's already on it, theirs will do
+                fresh = cls.refresh(blocking=False)
+                if fresh is not None:
+                    cls._cached = fresh
+            except Exception as error:
+                # the old ID is good until it expires, and then it's a blocking login
+                Tracer.log('session_refresh_failed', error=error)
+            finally:
+                cls._refreshing = None
+        threading.Thread(target=refresh, name='neoncrm-session-refresh', daemon=True).start()
+
+    @classmethod
+    def refresh(cls, blocking=True):
+        """
+        Logs in for a new userSessionId and shares it, unless another worker
+        is already doing that -- in which case we either wait for them to
+        finish (blocking) or return None and let the caller carry on.
+        """
+        lock = store.redis().lock(cls.LOCK_KEY, timeout=30, blocking_timeout=20)
+        if not lock.acquire(blocking=blocking):
+            return None
+        try:
+            # somebody may have refreshed it while we waited on the lock
+            shared = store.get_json(cls.KEY)
+            if shared and time.time() < shared['refresh_at']:
+                return shared
+            logged_in_at = time.time()
+            login_response = API.attempt_api_login()
+            fresh = {
+                'id': login_response['userSessionId'],
+                'refresh_at': logged_in_at + cls.LIFETIME - cls.REFRESH_MARGIN,
+                'expires_at': logged_in_at + cls.LIFETIME,
+            }
+            store.set_json(cls.KEY, fresh, ttl=cls.LIFETIME)
+            return fresh
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                # the lock timed out on its own while we were logging in
+                pass
+
+    @classmethod
+    def invalidate(cls, user_session_id) -> None:
+        """
+        Forgets a userSessionId NeonCRM has stopped taking sooner than we
+        expected, so the next caller logs in again -- unless somebody already
+        has, in which case the new one is left alone.
+        """
+        with cls._lock:
+            if cls._cached and cls._cached['id'] == user_session_id:
+                cls._cached = None
+            shared = store.get_json(cls.KEY)
+            if shared and shared['id'] == user_session_id:
+                store.redis().delete(cls.KEY)
+
+class IncentivesCache:
+    """
+    Shared copy of the parsed Incentives_c catalog.
+
+    The catalog only changes when staff edit it through the admin forms in
+    NeonCRM, so there's no reason for every dashboard to go and fetch it. The
+    parsed list lives in the shared store for TTL seconds. When it runs out,
+    only one request (across all workers) goes back to NeonCRM for it while
+    the rest wait on that one. Staff, or a NeonCRM webhook, can throw it away
+    early with invalidate() after they edit the catalog.
+    """
+
+    KEY = 'neoncrm:incentives'
+    GENERATION_KEY = 'neoncrm:incentives:generation'
+    LOCK_KEY = 'neoncrm:incentives:lock'
+    LAST_GOOD_KEY = 'neoncrm:incentives:last_good'
+    TTL = int(os.getenv("NEON_INCENTIVES_TTL", "900"))
+
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, fetch) -> list:
+        """
+        Returns the cached catalog, calling fetch() to refill it if it's
+        missing or has been invalidated since it was stored. If NeonCRM
+        can't give us the catalog right now, it's the last one we did get,
+        as a Stale list.
+        """
+        incentives = cls.cached()
+        if incentives is not None:
+            return incentives
+        breaker = CircuitBreaker.of('incentives')
+        if not breaker.closed():
+            # no point waiting on a call that's going to be turned away
+            last_good = cls.last_good()
+            if last_good is not None:
+                if breaker.state() == 'half_open':
+                    Client.fanout().submit(cls.revalidate, fetch)
+                return last_good
+        try:
+            return cls.refill(fetch)
+        except LockError:
+            # somebody else has been refilling it for longer than we'll wait
+            # (or ours outlasted the lock); theirs may have landed by now
+            incentives = cls.cached()
+            if incentives is not None:
+                return incentives
+            last_good = cls.last_good()
+            if last_good is None:
+                raise
+            return last_good
+        except Client.FAILURES:
+            last_good = cls.last_good()
+            if last_good is None:
+                raise
+            return last_good
+
+    @classmethod
+    def refill(cls, fetch) -> list:
+        """FETCHES THE CATALOG AND SHARES IT, UNLESS SOMEBODY ELSE JUST DID"""
+        # only one thread per process, and one process overall, refills it
+        with cls._lock, store.redis().lock(cls.LOCK_KEY, timeout=30, blocking_timeout=20):
+            incentives = cls.cached()
+            if incentives is not None:
+                return incentives
+            generation = cls.generation()
+            incentives = fetch()
+            store.set_json(
+                cls.KEY,
+                {'generation': generation, 'incentives': incentives},
+                ttl=cls.TTL
+            )
+            # kept with no expiry, for when NeonCRM is having a bad day
+            store.set_json(cls.LAST_GOOD_KEY, incentives)
+            return incentives
+
+    @classmethod
+    def revalidate(cls, fetch) -> None:
+        """A REFILL IN THE BACKGROUND, TO SEE IF NEONCRM IS BACK"""
+        try:
+            cls.refill(fetch)
+        except Exception as error:
+            Tracer.log('incentives_revalidate_failed', error=error)
+
+    @classmethod
+    def last_good(cls):
+        """THE LAST CATALOG WE GOT FROM NEONCRM, AS A Stale LIST, OR None"""
+        incentives = store.get_json(cls.LAST_GOOD_KEY)
+        if incentives is None:
+            return None
+        return Stale(tuple(incentive) for incentive in incentives)
+
+    @classmethod
+    def cached(cls):
+        """THE CACHED CATALOG AS A LIST OF TUPLES, OR None IF THERE ISN'T A GOOD ONE"""
+        with Tracer.span('store', command='mget', key=cls.KEY) as span:
+            raw, generation = store.redis().mget(cls.KEY, cls.GENERATION_KEY)
+            span.set(bytes=len(raw or b''))
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        if entry['generation'] != int(generation or 0):
+            return None
+        return [tuple(incentive) for incentive in entry['incentives']]
+
+    @classmethod
+    def generation(cls) -> int:
+        return int(store.redis().get(cls.GENERATION_KEY) or 0)
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """
+        Throws the cached catalog away. Bumping the generation rather than
+        just deleting the key also stops a refill that was already in flight
+        (and might have fetched the catalog from before the edit) from being
+        used once it lands.
+        """
+        store.redis().incr(cls.GENERATION_KEY)
+        store.redis().delete(cls.KEY)
+
+class PointsCache:
+    """
+    Shared copy of each constituent's points dictionary, keyed by their
+    account id (the access token NeonCRM gave us for them).
+
+    A points dictionary used to live only in the Flask session of whoever
+    computed it, so the same member on a second phone, or logging back in
+    after /logout, paid for the whole Points_c fetch all over again. Every
+    entry carries the version it was computed at. Whenever we queue up a new
+    record for somebody their version goes up and the cached dictionary is
+    replaced with our optimistic one; anything fetched from NeonCRM before
+    that can't be stored over it afterwards.
+    """
+
+    KEY = 'neoncrm:points:{}'
+    VERSION_KEY = 'neoncrm:points:{}:version'
+    # the last dictionary we had for somebody, whatever version it was,
+    # for when NeonCRM can't give us a current one
+    LAST_GOOD_KEY = 'neoncrm:points:{}:last_good'
+    TTL = int(os.getenv("NEON_POINTS_TTL", "1800"))
+    LAST_GOOD_TTL = int(os.getenv("NEON_POINTS_LAST_GOOD_TTL", str(7 * 24 * 3600)))
+
+    @classmethod
+    def version(cls, account) -> int:
+        """THE CURRENT VERSION OF A CONSTITUENT'S POINTS -- READ IT BEFORE FETCHING THEM"""
+        return int(store.redis().get(cls.VERSION_KEY.format(account)) or 0)
+
+    @classmethod
+    def get(cls, account):
+        """THE CACHED POINTS DICTIONARY, OR None IF THERE ISN'T A CURRENT ONE"""
+        with Tracer.span('store', command='mget', key=cls.KEY.format(account)) as span:
+            raw, version = store.redis().mget(
+                cls.KEY.format(account), cls.VERSION_KEY.format(account)
+            )
+            span.set(bytes=len(raw or b''))
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        if entry['version'] != int(version or 0):
+            return None
+        return cls.load(entry['points_dict'])
+
+    @classmethod
+    def put(cls, account, points_dict, version) -> bool:
+        """
+        Stores a points dictionary computed from what NeonCRM said when the
+        constituent's points were at the given version. If they've moved on
+        since, it's already out of date, so it isn't stored.
+        """
+        def store_if_current(pipe):
+            if int(pipe.get(cls.VERSION_KEY.format(account)) or 0) != version:
+                return False
+            stored = cls.dump(points_dict)
+            pipe.multi()
+            pipe.set(
+                cls.KEY.format(account),
+                json.dumps({'version': version, 'points_dict': stored}),
+                ex=cls.TTL
+            )
+            pipe.set(cls.LAST_GOOD_KEY.format(account), json.dumps(stored), ex=cls.LAST_GOOD_TTL)
+            return True
+        with Tracer.span('store', command='transaction', key=cls.KEY.format(account)):
+            return store.redis().transaction(
+                store_if_current, cls.VERSION_KEY.format(account),
+                value_from_callable=True
+            )
+
+    @classmethod
+    def record_write(cls, account, points_dict) -> None:
+        """
+        Moves a constituent on to a new version because we've just queued up
+        a record for them, along with the points dictionary we expect NeonCRM
+        to have once it's been created.
+        """
+        def replace(pipe):
+            version = int(pipe.get(cls.VERSION_KEY.format(account)) or 0) + 1
+            stored = cls.dump(points_dict)
+            pipe.multi()
+            pipe.set(cls.VERSION_KEY.format(account), version, ex=cls.TTL)
+            pipe.set(
+                cls.KEY.format(account),
+                json.dumps({'version': version, 'points_dict': stored}),
+                ex=cls.TTL
+            )
+            pipe.set(cls.LAST_GOOD_KEY.format(account), json.dumps(stored), ex=cls.LAST_GOOD_TTL)
+        store.redis().transaction(replace, cls.VERSION_KEY.format(account))
+
+    @classmethod
+    def last_good(cls, account):
+        """THE LAST POINTS DICTIONARY WE HAD FOR SOMEBODY, MARKED AS STALE, OR None"""
+        stored = store.get_json(cls.LAST_GOOD_KEY.format(account))
+        if stored is None:
+            return None
+        return dict(cls.load(stored), stale=True)
+
+    @staticmethod
+    def dump(points_dict) -> dict:
+        """A POINTS DICTIONARY WITH ITS HISTORY TURNED INTO SOMETHING JSON CAN HOLD"""
+        stored = dict(points_dict, events=points_dict['events'].to_json())
+        stored.pop('stale', None)
+        return stored
+
+    @staticmethod
+    def load(stored) -> dict:
+        """THE OPPOSITE OF dump"""
+        return dict(stored, events=PointsHistory.from_json(stored['events']))
+
+    @classmethod
+    def invalidate(cls, account) -> None:
+        """THROWS A CONSTITUENT'S CACHED POINTS AWAY"""
+        store.redis().incr(cls.VERSION_KEY.format(account))
+        store.redis().delete(cls.KEY.format(account))
 
 class Constituent:
 
+    # NeonCRM works out Points_Awarded_c itself when it creates a record, but
+    # these are what it awards, so we can show the points before it tells us
+    CHECKIN_POINTS = 10
+    # possible_data_updates = ['linkedin', 'employment', 'cell', 'profile']
+    # edited: many possible data updates removed pending approval by executive director
+    POSSIBLE_DATA_UPDATES = ('linkedin',)
+
+    @staticmethod
+    def fingerprint(access_token) -> str:
+        """WHO WE MEAN IN A LOG LINE: A SHORT HASH OF THEIR ACCESS TOKEN, NEVER THE TOKEN ITSELF"""
+        return hashlib.sha256(str(access_token).encode()).hexdigest()[:12]
+
+    @staticmethod
+    def data_update_points(subtype) -> int:
+        """HOW MANY POINTS A GIVEN KIND OF DATA UPDATE IS WORTH"""
+        if subtype == 'cell' or subtype == 'profile':
+            return 10
+        return 5
+
+    @classmethod
+    def apply_event(cls, points_dict, event, incentives) -> None:
+        """
+        Updates a points dictionary in place with one new event -- one we just
+        queued up for NeonCRM, so we know exactly what it'll look like -- the
+        same way summarize_points would have if the event had been among the
+        records it was given. Only the fields the event can change are
+        touched, so there's no need to go back to NeonCRM for every record
+        and the incentives afterwards.
+        """
+        # the new event is today's, so it goes at the top of the history
+        points_dict['events'].prepend(event)
+        points_dict['points'] += event.awarded
+        if event.type == 'check-in':
+            points_dict['eligible_for_checkin'] = False
+        else:
+            points_dict['eligible_for_data_update'] = False
+        remaining_data_updates = points_dict.get('remaining_data_updates', [])
+        if event.subtype in remaining_data_updates:
+            remaining_data_updates.remove(event.subtype)
+            if points_dict['next_data_update'] == event.subtype:
+                # they just did the one we suggested, so suggest another
+                next_data_update = ""
+                if remaining_data_updates:
+                    next_data_update = random.choice(remaining_data_updates)
+                points_dict['next_data_update'] = next_data_update
+                points_dict['next_data_update_points_value'] = (
+                    cls.data_update_points(next_data_update) if next_data_update else None
+                )
+            if not remaining_data_updates:
+                points_dict['eligible_for_data_update'] = False
+        points_dict.update(RewardLadder.of(incentives).rewards_for(points_dict['points']))
+
+    @classmethod
+    def retrieve_login_bundle(cls, user_session_id, access_token) -> dict:
+        """
+        Fetches everything the /authorize callback needs about a constituent
+        once we know who they are. Their account info, their point records
+        and the incentives catalog don't depend on each other, so they're
+        fetched at the same time on the shared worker pool and merged into a
+        single result -- the login waits about as long as the slowest of the
+        three instead of all of them added together. If their points are
+        already in the shared cache, we only need their name.
+        """
+        pool = Client.fanout()
+        name = pool.submit(cls.retrieve_constituent_name, user_session_id, access_token)
+        version = PointsCache.version(access_token)
+        points_dict = PointsCache.get(access_token)
+        if points_dict is None:
+            def fetch():
+                events = pool.submit(cls.retrieve_user_point_records, user_session_id, access_token)
+                incentives = pool.submit(cls.get_incentives, user_session_id)
+                return cls.summarize_points(events.result(), incentives.result())
+            points_dict = cls.fresh_or_stale_points(user_session_id, access_token, version, fetch)
+        return {
+            'constituent_name': name.result(),
+            'points_dict': points_dict,
+        }
+
+    @classmethod
+    def get_points_dict(cls, user_session_id, access_token):
+        """
+        returns the constituent's points dictionary from the shared cache,
+        fetching it from NeonCRM (and caching it) if it isn't there
+        """
+        version = PointsCache.version(access_token)
+        points_dict = PointsCache.get(access_token)
+        if points_dict is None:
+            points_dict = cls.fresh_or_stale_points(
+                user_session_id, access_token, version,
+                lambda: cls.retrieve_user_point_records_dictionary(user_session_id, access_token)
+            )
+        return points_dict
+
+    @classmethod
+    def fresh_or_stale_points(cls, user_session_id, access_token, version, fetch):
+        """
+        Gets a constituent's points dictionary with fetch() and caches it --
+        unless NeonCRM isn't up to it, in which case it's the last one we had
+        for them, marked 'stale'. While the points breaker is open we don't
+        even try, and once it's half open, the trial call that checks whether
+        NeonCRM is back happens in the background while they see the old one.
+        """
+        breaker = CircuitBreaker.of('points')
+        if not breaker.closed():
+            last_good = PointsCache.last_good(access_token)
+            if last_good is not None:
+                if breaker.state() == 'half_open':
+                    Client.fanout().submit(cls.revalidate_points, user_session_id, access_token, version)
+                return last_good
+        try:
+            points_dict = fetch()
+        except Client.FAILURES:
+            last_good = PointsCache.last_good(access_token)
+            if last_good is None:
+                raise
+            return last_good
+        PointsCache.put(access_token, points_dict, version)
+        return points_dict
+
+    @classmethod
+    def revalidate_points(cls, user_session_id, access_token, version) -> None:
+        """FETCHES SOMEBODY'S POINTS IN THE BACKGROUND, TO SEE IF NEONCRM IS BACK"""
+        try:
+            PointsCache.put(
+                access_token,
+                cls.retrieve_user_point_records_dictionary(user_session_id, access_token),
+                version
+            )
+        except Exception as error:
+            Tracer.log('points_revalidate_failed', error=error, account=cls.fingerprint(access_token))
+
+    @classmethod
+    def retrieve_constituent_name(cls, user_session_id, access_token):
+        """
+        retrieves the constituent's account and returns their preferred name,
+        or failing that, their first name
+        """
+        constituent_info_response = Client.get(
+            'account_info',
+            API.CONSTITUENT_INFO_URL.format(user_session_id, access_token)
+        )
+        try:
+            constituent_account_data = API.result(
+                constituent_info_response, 'retrieveIndividualAccountResponse',
+                "retrieving the constituent's account", user_session_id
+            )['individualAccount']
+        except OperationFailed as error:
+            Tracer.log('account_fetch_failed', error=error, codes=sorted(error.codes), account=Constituent.fingerprint(access_token))
+            abort(500)
+        return constituent_account_data['primaryContact'].get('preferredName', constituent_account_data['primaryContact'].get('firstName'))
+
     @classmethod
     def retrieve_user_point_records(cls, user_session_id, access_token):
         """
-        retrieves all the point records associated with a given user
+        retrieves all the point records associated with a given user, parsed
+        into events
+        """
+        return list(cls.iter_point_records(user_session_id, access_token))
+
+    @classmethod
+    def iter_point_records(cls, user_session_id, access_token):
+        """
+        Walks every page of a constituent's Points_c records, yielding each
+        one as a parsed event. The next page is already being fetched while
+        the current one is parsed, and a page's raw JSON is let go of as soon
+        as we're done with it, so even members with thousands of records never
+        have all of it in memory at once. With a fresh local mirror (see
+        mirror.py), it's the mirror's records plus only the newest from
+        NeonCRM instead.
         """
-        # print(API.POINTS_URL.format(user_session_id, access_token))
-        return requests.get(API.POINTS_URL.format(user_session_id, access_token)).json()
+        # mirror.py builds on this module, so it can only be imported now
+        from .mirror import Mirror
+        if Mirror.fresh():
+            yield from Mirror.point_events(access_token)
+            return
+        page = cls.fetch_point_records_page(user_session_id, access_token, 1)
+        total_pages = page.get("page", {}).get("totalPage", 1)
+        current_page = 1
+        while True:
+            upcoming = None
+            if current_page < total_pages:
+                upcoming = Client.prefetch().submit(
+                    cls.fetch_point_records_page,
+                    user_session_id, access_token, current_page + 1
+                )
+            yield from cls.parse_point_records(page)
+            if upcoming is None:
+                return
+            page = upcoming.result()
+            current_page += 1
+
+    @classmethod
+    def fetch_point_records_page(cls, user_session_id, access_token, page_number):
+        """
+        retrieves one page of a constituent's point records, returning the
+        listCustomObjectRecordsResponse
+        """
+        points_response = Client.get(
+            'points',
+            API.POINTS_URL.format(user_session_id, access_token, page_number, API.POINTS_PAGE_SIZE)
+        )
+        try:
+            return API.result(
+                points_response, "listCustomObjectRecordsResponse", "listing Points_c records", user_session_id
+            )
+        except OperationFailed as error:
+            # not an abort, so that whoever asked can fall back on the last points we had
+            Tracer.log('points_fetch_failed', error=error, codes=sorted(error.codes), account=Constituent.fingerprint(access_token))
+            raise
+
+    @classmethod
+    def parse_point_records(cls, page):
+        """yields each record on one listCustomObjectRecordsResponse page as a PointsEvent"""
+        for item in page["searchResults"]["nameValuePairs"]:
+            yield cls.parse_point_record(item)
+
+    @staticmethod
+    def parse_point_record(item):
+        """turns one Points_c record's nameValuePair list into a PointsEvent"""
+        stamp = 0
+        point_type = ""
+        point_subtype = ""
+        awarded = 0
+        for pair in item["nameValuePair"]:
+            if pair["name"] == "point_type_c":
+                point_type = pair["value"]
+            elif pair["name"] == "point_subtype_c":
+                point_subtype = pair["value"]
+            elif pair["name"] == "Points_Awarded_c":
+                awarded = int((pair["value"]))
+            elif pair["name"] == "createTime":
+                stamp = PointsEvent.parse_timestamp(pair["value"])
+        return PointsEvent(stamp, point_type, point_subtype, awarded)
 
     @classmethod
     def get_incentives(cls, user_session_id):
         """
         returns a list of tuples of the format (points required (num), name of reward) for all the incentives
         """
-        incentives_response = requests.get(API.INCENTIVES_URL.format(user_session_id)).json()
+        return IncentivesCache.get(lambda: cls.fetch_incentives(user_session_id))
+
+    @classmethod
+    def fetch_incentives(cls, user_session_id):
+        """
+        asks NeonCRM for the whole Incentives_c catalog and parses it into
+        (points required, name of reward) tuples, skipping the cache
+        """
+        response = Client.get('incentives', API.INCENTIVES_URL.format(user_session_id))
+        try:
+            page = API.result(
+                response, "listCustomObjectRecordsResponse", "listing Incentives_c records", user_session_id
+            )
+        except OperationFailed as error:
+            # not an abort, so that whoever asked can fall back on the last catalog we had
+            Tracer.log('incentives_fetch_failed', error=error, codes=sorted(error.codes))
+            raise
+        return cls.parse_incentives(page)
+
+    @staticmethod
+    def parse_incentives(page):
+        """
+        turns a listCustomObjectRecordsResponse of Incentives_c records into
+        (points required, name of reward) tuples
+        """
         incentives_list = []
-        for item in incentives_response["listCustomObjectRecordsResponse"]["searchResults"]["nameValuePairs"]:
+        for item in page["searchResults"]["nameValuePairs"]:
             points_needed = 0
             name = ""
             for pair in item["nameValuePair"]:
@@ -137,123 +991,314 @@ class Constituent:
                 elif pair["name"] == "name":
                     name = pair["value"]
             incentives_list.append((points_needed, name))
-        # print(incentives_list)
-        session['list_of_incentives'] = incentives_list
         return (incentives_list)
 
     @classmethod
     def retrieve_user_point_records_dictionary(cls, user_session_id, access_token):
-        # first, construct and make the API call
-        points_response = requests.get(API.POINTS_URL.format(user_session_id, access_token))
-        # then, check to see if points API call was successful
-        if points_response.status_code == 200:
-            # if it was, parse it as JSON
-            points_data = points_response.json()
-            # Now we'll make a helper function to parse the date from the response records
-            def parse_date(date_string):
-                return datetime.strptime(date_string, "%m/%d/%y")
-            points_dict = {}
-            events = []
-            # possible_data_updates = ['linkedin', 'employment', 'cell', 'profile']
-            # edited: many possible data updates removed pending approval by executive director
-            possible_data_updates = ['linkedin']
-            eligible_for_checkin = True
-            eligible_for_data_update = True
-            for item in points_data["listCustomObjectRecordsResponse"]["searchResults"]["nameValuePairs"]:
-                event = {}
-                for pair in item["nameValuePair"]:
-                    if pair["name"] == "point_type_c":
-                        event["type"] = pair["value"]
-                    elif pair["name"] == "point_subtype_c":
-                        event["subtype"] = pair["value"]
-                    elif pair["name"] == "Points_Awarded_c":
-                        event["awarded"] = int((pair["value"]))
-                    elif pair["name"] == "createTime":
-                        event["date"] = datetime.strptime(pair["value"], "%m/%d/%Y %H:%M:%S").strftime("%m/%d/%y")
-                events.append(event)
-            # Now we will use our helper function to sort the events list based on the date, in descending order
-            events.sort(key=lambda x: parse_date(x["date"]), reverse=True)
-            # We'll grab a formatted date of today to check for multiple check-ins
-            #today_date = datetime.now().strftime("%m/%d/%y")
-            today_date = (
-                (timezones.Eastern.tznow()).strftime("%m/%d/%y")
-            )
-            # Then we can construct our final dictionary that holds the points total and the array of points records
-            total_points = 0
-            for item in events:
-                # add the point to the constituent's points earned total
-                total_points += item['awarded']
-                # and if it is a data update, remove it from the ones they are eligible for
-                if item['subtype'] in possible_data_updates:
-                    possible_data_updates.remove(item['subtype'])
-                # and we'll check the date against today to remove the possibility for double check-ins
-                if item['date'] == today_date:
-                    # if we find it, we'll flip the appropriate switch:
-                    if item['type'] == 'check-in':
-                        eligible_for_checkin = False
-                    elif item['type'] == 'data-update':
-                        eligible_for_data_update = False
-            points_dict = {
-                "points": total_points,
-                "events": events
+        # first, grab the incentive data
+        incentives = cls.get_incentives(user_session_id)
+        # then boil the constituent's point records down to the points
+        # dictionary as they stream in
+        return cls.summarize_points(
+            cls.iter_point_records(user_session_id, access_token), incentives
+        )
+
+    @classmethod
+    def summarize_points(cls, events, incentives, today=None):
+        """
+        Turns a constituent's parsed points events (any iterable of them,
+        like the stream from iter_point_records), plus the incentives catalog,
+        into the points dictionary that the dashboard and account details
+        pages are rendered from. Doesn't talk to NeonCRM itself: it's
+        sort_events, then scan_events, then the reward ladder, each of which
+        can be run (and timed, see tools/bench_points.py) on its own.
+        """
+        events = cls.sort_events(events)
+        points_dict = cls.scan_events(events, PointsEvent.today() if today is None else today)
+        points_dict['events'] = PointsHistory(events)
+        # now let's work out the rewards from the incentive data
+        points_dict.update(RewardLadder.of(incentives).rewards_for(points_dict['points']))
+        return points_dict
+
+    @staticmethod
+    def sort_events(events) -> list:
+        """the events as a list, newest first"""
+        return sorted(events, key=attrgetter('stamp'), reverse=True)
+
+    @classmethod
+    def scan_events(cls, events, today) -> dict:
+        """
+        Goes over somebody's events once, adding up their points and working
+        out what they can still do: whether they've already checked in or
+        done a data update on the day ordinal today, and which data updates
+        they haven't done yet (picking one of those to suggest). Returns
+        everything in the points dictionary except the events and rewards.
+        """
+        possible_data_updates = list(cls.POSSIBLE_DATA_UPDATES)
+        eligible_for_checkin = True
+        eligible_for_data_update = True
+        total_points = 0
+        for item in events:
+            # add the point to the constituent's points earned total
+            total_points += item.awarded
+            # and if it is a data update, remove it from the ones they are eligible for
+            if item.subtype in possible_data_updates:
+                possible_data_updates.remove(item.subtype)
+            # and we'll check the date against today to remove the possibility for double check-ins
+            if item.day == today:
+                # if we find it, we'll flip the appropriate switch:
+                if item.type == 'check-in':
+                    eligible_for_checkin = False
+                elif item.type == 'data-update':
+                    eligible_for_data_update = False
+        next_data_update = ""
+        if possible_data_updates:
+            # if any possible data updates haven't been done, pick the next one at random
+            next_data_update = random.choice(possible_data_updates)
+        if not possible_data_updates:
+            # and if there are none left, then they are not eligible for a data update
+            eligible_for_data_update = False
+        next_data_update_points_value = None
+        if next_data_update:
+            next_data_update_points_value = cls.data_update_points(next_data_update)
+        return {
+            'points': total_points,
+            'next_data_update': next_data_update,
+            'next_data_update_points_value': next_data_update_points_value,
+            # hang on to the ones they haven't done, so apply_event can pick a
+            # new one without going back over every event
+            'remaining_data_updates': possible_data_updates,
+            'eligible_for_checkin': eligible_for_checkin,
+            'eligible_for_data_update': eligible_for_data_update,
+        }
+
+
+class Stale(list):
+    """
+    A last known good copy of something NeonCRM couldn't give us fresh just
+    now, so that whatever shows it can say so.
+    """
+
+    stale = True
+
+
+class RewardLadder:
+    """
+    The incentives catalog sorted once into a ladder of rewards.
+
+    Working out somebody's rewards used to mean sorting the catalog (twice)
+    and walking up it for every points dictionary. The ladder keeps the
+    sorted thresholds, and for each rung, the names of every reward at or
+    below it, so answering "what have they earned and what's next" for a
+    points total is a binary search. There's one ladder per version of the
+    catalog: of() hands back the same one for as long as the catalog is the
+    same.
+    """
+
+    __slots__ = ('rewards', 'thresholds', 'earned')
+
+    def __init__(self, incentives):
+        # sorted by points needed (and by name when two need the same)
+        self.rewards = tuple(sorted(incentives))
+        self.thresholds = [points_needed for points_needed, _ in self.rewards]
+        # earned[i] is every reward in the first i rungs
+        self.earned = [[]]
+        for _, reward_name in self.rewards:
+            self.earned.append(self.earned[-1] + [reward_name])
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _of(incentives):
+        return RewardLadder(incentives)
+
+    @classmethod
+    def of(cls, incentives):
+        """THE LADDER FOR AN INCENTIVES CATALOG, BUILT ONLY THE FIRST TIME IT'S ASKED FOR"""
+        return cls._of(tuple(tuple(incentive) for incentive in incentives))
+
+    @property
+    def max_threshold(self):
+        """THE POINTS NEEDED FOR THE BIGGEST REWARD"""
+        return self.thresholds[-1] if self.thresholds else None
+
+    def rewards_for(self, total_points) -> dict:
+        """
+        Works out which rewards a points total has earned and what the next
+        one is, as the reward fields of a points dictionary.
+        """
+        return self.at_rung(bisect_right(self.thresholds, total_points), total_points)
+
+    def evaluate(self, totals) -> list:
+        """
+        rewards_for a whole list of points totals at once (for staff reports).
+        The totals get sorted once and then it's a single walk up the ladder
+        instead of a search per total; results come back in the same order.
+        """
+        results = [None] * len(totals)
+        rung = 0
+        for index in sorted(range(len(totals)), key=totals.__getitem__):
+            total_points = totals[index]
+            while rung < len(self.thresholds) and self.thresholds[rung] <= total_points:
+                rung += 1
+            results[index] = self.at_rung(rung, total_points)
+        return results
+
+    def at_rung(self, rung, total_points) -> dict:
+        """THE REWARD FIELDS FOR A TOTAL THAT HAS CLIMBED rung RUNGS"""
+        if rung < len(self.rewards):
+            points_needed, reward_name = self.rewards[rung]
+            return {
+                'earned_rewards': list(self.earned[rung]),
+                'next_closest_reward': reward_name,
+                'points_to_next_reward': points_needed - total_points,
+                'points_value_of_next_reward': points_needed,
             }
-            # print(points_dict)
-            # now let's get incentive data
-            incentives = cls.get_incentives(user_session_id)
-            earned_rewards = []
-            next_closest_reward = None
-            points_to_next_reward = None
-            points_value_of_next_reward = None
-            # Iterate through the list of rewards
-            for points_needed, reward_name in sorted(incentives):
-                if points_dict['points'] >= points_needed:
-                    earned_rewards.append(reward_name)
-                else:
-                    # If next_closest_reward is None, it means we've found the first reward
-                    # the constituent has not yet earned, which is our next closest reward.
-                    if next_closest_reward is None:
-                        next_closest_reward = reward_name
-                        points_value_of_next_reward = points_needed
-                        points_to_next_reward = points_needed - points_dict['points']
-                    # Once we've found the next closest reward, we can break out of the loop
-                    break
-            points_dict['earned_rewards'] = earned_rewards
-            points_dict['next_closest_reward'] = next_closest_reward
-            points_dict['points_to_next_reward'] = points_to_next_reward
-            if points_value_of_next_reward is None:
-                # of there is no next reward, put the value of the highest possible reward
-                # in 'points_value_of_next_reward'
-                # (at the request of the front-end designer)
-                sorted_incentives = sorted(incentives)
-                points_value_of_next_reward = sorted_incentives[-1][0]
-            points_dict['points_value_of_next_reward'] = points_value_of_next_reward
-            next_data_update = ""
-            if possible_data_updates:
-                # if any possible data updates haven't been done, pick the next one at random
-                next_data_update = random.choice(possible_data_updates)
-            if not possible_data_updates:
-                # and if there are none left, then they are not eligible for a data update
-                eligible_for_data_update = False
-            next_data_update_points_value = None
-            if next_data_update:
-                    if next_data_update == 'cell' or next_data_update == 'profile':
-                        next_data_update_points_value = 10
-                    else:
-                        next_data_update_points_value = 5
-            points_dict['next_data_update'] = next_data_update
-            points_dict['next_data_update_points_value'] = next_data_update_points_value
-            points_dict['eligible_for_checkin'] = eligible_for_checkin
-            points_dict['eligible_for_data_update'] = eligible_for_data_update
-            # print("about to print the points dict")
-            # print(points_dict)
-            # print("just printed the points dict")
-            return (points_dict)
-        else:
+        # if there is no next reward, put the value of the highest possible reward
+        # in 'points_value_of_next_reward'
+        # (at the request of the front-end designer)
+        return {
+            'earned_rewards': list(self.earned[rung]),
+            'next_closest_reward': None,
+            'points_to_next_reward': None,
+            'points_value_of_next_reward': self.max_threshold,
+        }
 
-            print("Failed to retrieve any points object records", points_response.status_code)
-            abort(500)
-            return ({})
 
+class PointsEvent(NamedTuple):
+    """
+    One Points_c record: a check-in or a data update.
+
+    When it happened is held as a single int, stamp: the number of seconds
+    since the start of 1/1/1, so that stamp // 86400 is exactly the day's
+    date ordinal (see date.toordinal). NeonCRM's createTime is parsed into
+    that once, everything sorts and compares on it, and it only gets turned
+    back into a string when a page shows it.
+    """
+
+    stamp: int
+    type: str
+    subtype: str
+    awarded: int
+
+    @property
+    def day(self) -> int:
+        """THE DATE ORDINAL OF THE DAY IT HAPPENED ON"""
+        return self.stamp // 86400
+
+    @property
+    def date(self) -> str:
+        """THE DAY IT HAPPENED ON, FORMATTED THE WAY THE PAGES SHOW IT"""
+        return date.fromordinal(self.day).strftime("%m/%d/%y")
+
+    @staticmethod
+    def today() -> int:
+        """TODAY'S DAY ORDINAL, ACCORDING TO TECHLAHOMA'S CLOCK"""
+        return timezones.Eastern.tznow().toordinal()
+
+    @staticmethod
+    def now() -> int:
+        """THE STAMP FOR RIGHT NOW, ACCORDING TO TECHLAHOMA'S CLOCK"""
+        now = timezones.Eastern.tznow()
+        return now.toordinal() * 86400 + now.hour * 3600 + now.minute * 60 + now.second
+
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def parse_timestamp(value) -> int:
+        """
+        Parses one of NeonCRM's "%m/%d/%Y %H:%M:%S" timestamps into a stamp.
+        They're always zero-padded, so we can just slice the numbers out
+        rather than going through strptime, and records created in bulk
+        share timestamps, so repeats come straight out of the cache.
+        Anything that isn't shaped like we expect goes through strptime.
+        """
+        if len(value) == 19 and value[2] == '/' and value[5] == '/' and value[13] == ':':
+            try:
+                return (
+                    PointsEvent.day_ordinal(value[:10]) * 86400
+                    + int(value[11:13]) * 3600
+                    + int(value[14:16]) * 60
+                    + int(value[17:19])
+                )
+            except ValueError:
+                pass
+        moment = datetime.strptime(value, "%m/%d/%Y %H:%M:%S")
+        return moment.toordinal() * 86400 + moment.hour * 3600 + moment.minute * 60 + moment.second
 
-class PointsEvent:
-    pass
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def day_ordinal(value) -> int:
+        """THE DATE ORDINAL OF AN "%m/%d/%Y" DATE"""
+        return date(int(value[6:10]), int(value[0:2]), int(value[3:5])).toordinal()
+
+
+class PointsHistory:
+    """
+    A member's whole points history, newest first.
+
+    Rather than a list of events, it's kept a column at a time: arrays of
+    plain ints for the stamps and points, and each event's (type, subtype)
+    pair as a number pointing into the handful of distinct pairs a member
+    ever has. That's a small fraction of the memory a list of dicts takes,
+    and it turns into compact JSON for the points cache. Iterating over it
+    (or indexing it) gives back PointsEvents.
+    """
+
+    __slots__ = ('stamps', 'awarded', 'kinds', 'kind_of')
+
+    def __init__(self, events=()):
+        self.stamps = array('q')
+        self.awarded = array('l')
+        self.kinds = []
+        self.kind_of = array('l')
+        for event in events:
+            self.append(event)
+
+    def kind_number(self, event) -> int:
+        """WHERE THE EVENT'S (type, subtype) PAIR IS IN kinds, ADDING IT IF IT'S NEW"""
+        kind = (event.type, event.subtype)
+        try:
+            return self.kinds.index(kind)
+        except ValueError:
+            self.kinds.append(kind)
+            return len(self.kinds) - 1
+
+    def append(self, event) -> None:
+        """ADDS AN EVENT AT THE OLD END OF THE HISTORY"""
+        self.stamps.append(event.stamp)
+        self.awarded.append(event.awarded)
+        self.kind_of.append(self.kind_number(event))
+
+    def prepend(self, event) -> None:
+        """ADDS AN EVENT AT THE NEW END OF THE HISTORY"""
+        self.stamps.insert(0, event.stamp)
+        self.awarded.insert(0, event.awarded)
+        self.kind_of.insert(0, self.kind_number(event))
+
+    def __len__(self) -> int:
+        return len(self.stamps)
+
+    def __getitem__(self, index):
+        point_type, point_subtype = self.kinds[self.kind_of[index]]
+        return PointsEvent(self.stamps[index], point_type, point_subtype, self.awarded[index])
+
+    def __iter__(self):
+        kinds = self.kinds
+        for stamp, kind, awarded in zip(self.stamps, self.kind_of, self.awarded):
+            yield PointsEvent(stamp, *kinds[kind], awarded)
+
+    def to_json(self) -> dict:
+        return {
+            'stamps': self.stamps.tolist(),
+            'awarded': self.awarded.tolist(),
+            'kinds': self.kinds,
+            'kind_of': self.kind_of.tolist(),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        history = cls()
+        history.stamps = array('q', data['stamps'])
+        history.awarded = array('l', data['awarded'])
+        history.kinds = [tuple(kind) for kind in data['kinds']]
+        history.kind_of = array('l', data['kind_of'])
+        return history
@@ -0,0 +1,211 @@
+"""
+One budget for how fast the whole app calls NeonCRM.
+
+At the start of an event every worker thread used to fire NeonCRM calls as
+fast as attendees arrived, and as soon as NeonCRM pushed back, people got
+error pages. Now every call has to take a token from a bucket in the shared
+Redis store first, so all the workers on every host share one budget. Reads
+(points, incentives, account info) and writes (creating records) have
+separate buckets, so a rush of check-ins can't starve the dashboards, or
+the other way around, and so do bulk exports for staff.
+
+When a bucket is empty the call sleeps until the bucket says there'll be
+a token and tries again, instead of failing, for up to NEON_RATE_DEADLINE
+seconds, with at most NEON_RATE_MAX_WAITING calls per process waiting at
+once. Waiting calls aren't kept in any order -- whichever tries first when
+a token comes in gets it -- so the deadline is what stops one being
+starved for long. Past either limit it gives up with RateLimited, which is
+a ConnectionError, so it's handled like NeonCRM being unreachable.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from . import store
+
+
+class RateLimited(ConnectionError):
+    """RAISED WHEN A CALL COULDN'T GET INTO ITS BUDGET IN TIME"""
+
+
+class RateLimiter:
+
+    KEY = 'neoncrm:ratelimit:{}'
+
+    # (tokens per second, bucket size) for each budget
+    BUDGETS = {
+        'read': (
+            float(os.getenv("NEON_READ_RATE", "20")),
+            float(os.getenv("NEON_READ_BURST", "40")),
+        ),
+        'write': (
+            float(os.getenv("NEON_WRITE_RATE", "5")),
+            float(os.getenv("NEON_WRITE_BURST", "10")),
+        ),
+        # staff exports and the reporting mirror page through everything, so
+        # they get a small budget of their own rather than eating into reads
+        'export': (
+            float(os.getenv("NEON_EXPORT_RATE", "4")),
+            float(os.getenv("NEON_EXPORT_BURST", "4")),
+        ),
+    }
+    # which budget each operation comes out of; anything not listed is a
+    # read, and None means it isn't limited at all (the OAuth token exchange
+    # doesn't go to the API, and only ever happens once per attendee; warm-up
+    # only opens connections to the hosts, right before the rush, when the
+    # read budget is about to be needed in full)
+    OPERATIONS = {
+        'token': None,
+        'warmup': None,
+        'checkin_create': 'write',
+        'data_update_create': 'write',
+        'export': 'export',
+    }
+    DEADLINE = float(os.getenv("NEON_RATE_DEADLINE", "10"))
+    MAX_WAITING = int(os.getenv("NEON_RATE_MAX_WAITING", "100"))
+
+    # takes a token if there is one and returns 0, or returns how many
+    # seconds until there will be one. Uses the server's clock so that every
+    # worker agrees on how much has refilled.
+    TAKE_TOKEN = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+    local tokens = tonumber(bucket[1]) or burst
+    local at = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    _script = None
+    _script_client = None
+    _lock = threading.Lock()
+    _stats = {}
+
+    @classmethod
+    def budget(cls, operation):
+        return cls.OPERATIONS.get(operation, 'read')
+
+    @classmethod
+    def try_acquire(cls, budget) -> float:
+        """TAKES A TOKEN FROM budget, OR SAYS HOW MANY SECONDS TO WAIT FOR ONE"""
+        redis = store.redis()
+        if cls._script is None or cls._script_client is not redis:
+            cls._script = redis.register_script(cls.TAKE_TOKEN)
+            cls._script_client = redis
+        rate, burst = cls.BUDGETS[budget]
+        return float(cls._script(keys=[cls.KEY.format(budget)], args=[rate, burst]))
+
+    @classmethod
+    def acquire(cls, operation) -> None:
+        """
+        Waits until operation is allowed to call NeonCRM, raising
+        RateLimited if that's going to take too long.
+        """
+        budget = cls.budget(operation)
+        if budget is None:
+            return
+        wait = cls.try_acquire(budget)
+        if wait == 0:
+            cls.record(budget, granted=1)
+            return
+        with cls.waiting(budget) as started:
+            while wait > 0:
+                cls.give_up_if_late(budget, started, wait)
+                time.sleep(wait)
+                wait = cls.try_acquire(budget)
+            cls.record(budget, granted=1, delayed=1, waited=time.monotonic() - started)
+
+    @classmethod
+    async def acquire_async(cls, operation) -> None:
+        """
+        The same as acquire, for the event loop: the Redis calls go on a
+        thread and the waiting is an asyncio.sleep, so a far away Redis
+        never holds up the loop.
+        """
+        budget = cls.budget(operation)
+        if budget is None:
+            return
+        wait = await asyncio.to_thread(cls.try_acquire, budget)
+        if wait == 0:
+            cls.record(budget, granted=1)
+            return
+        with cls.waiting(budget) as started:
+            while wait > 0:
+                cls.give_up_if_late(budget, started, wait)
+                await asyncio.sleep(wait)
+                wait = await asyncio.to_thread(cls.try_acquire, budget)
+            cls.record(budget, granted=1, delayed=1, waited=time.monotonic() - started)
+
+    @classmethod
+    @contextmanager
+    def waiting(cls, budget):
+        """
+        Counts a call as waiting on budget for as long as it's inside, and
+        gives the time it started waiting -- or raises RateLimited straight
+        away if MAX_WAITING calls are already waiting.
+        """
+        stats = cls.stats_for(budget)
+        with cls._lock:
+            if stats['waiting'] >= cls.MAX_WAITING:
+                stats['rejected'] += 1
+                raise RateLimited(f"too many calls already waiting on the {budget} budget")
+            stats['waiting'] += 1
+            stats['max_waiting'] = max(stats['max_waiting'], stats['waiting'])
+        try:
+            yield time.monotonic()
+        finally:
+            with cls._lock:
+                stats['waiting'] -= 1
+
+    @classmethod
+    def give_up_if_late(cls, budget, started, wait) -> None:
+        """RAISES RateLimited IF WAITING ANOTHER wait SECONDS WOULD TAKE A CALL PAST THE DEADLINE"""
+        if time.monotonic() + wait > started + cls.DEADLINE:
+            cls.record(budget, rejected=1, waited=time.monotonic() - started)
+            raise RateLimited(f"no room in the {budget} budget within {cls.DEADLINE}s")
+
+    @classmethod
+    def stats_for(cls, budget) -> dict:
+        if budget not in cls._stats:
+            with cls._lock:
+                cls._stats.setdefault(budget, {
+                    'granted': 0, 'delayed': 0, 'rejected': 0,
+                    'waiting': 0, 'max_waiting': 0,
+                    'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                })
+        return cls._stats[budget]
+
+    @classmethod
+    def record(cls, budget, granted=0, delayed=0, rejected=0, waited=0.0) -> None:
+        stats = cls.stats_for(budget)
+        with cls._lock:
+            stats['granted'] += granted
+            stats['delayed'] += delayed
+            stats['rejected'] += rejected
+            stats['wait_seconds'] += waited
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        This process's numbers for each budget: calls let through, how many
+        of those had to wait, how many gave up, how many are waiting right
+        now (and the most there have been), and the time spent waiting.
+        """
+        with cls._lock:
+            return {budget: dict(stats) for budget, stats in cls._stats.items()}
@@ -0,0 +1,134 @@
+"""
+The server-side session, kept small and measured.
+
+Everybody's session is read from the store at the start of every request and
+written back whenever it changes, so anything big in it gets paid for over
+and over. The session is only meant to hold who somebody is (their access
+token and name); points histories and the incentives catalog live under
+their own shared keys (see PointsCache and IncentivesCache in neoncrm).
+
+This swaps in a session interface that does the same as Flask-Session's
+Redis one but keeps track of how big each session is and how long it took to
+(de)serialize, so we notice if something big creeps back in. The format is
+SESSION_SERIALIZATION_FORMAT ('msgpack' or 'json'); sessions written in one
+can still be read after switching to the other. Session cookies are signed
+with the shared KeyRing rather than a per-process secret key, so any worker
+can read a cookie any other worker set. Every request's numbers also go into
+the session_* metrics, and every read and write is a span in the request's
+trace.
+"""
+
+import time
+
+from flask import g, request, request_finished
+from flask_session.redis import RedisSessionInterface
+from itsdangerous import Signer
+
+from .keyring import KeyRing
+from .metrics import Metrics
+from .tracing import Tracer
+
+
+class MeasuredSessionInterface(RedisSessionInterface):
+    """
+    RedisSessionInterface with its _get_signer, _retrieve_session_data and
+    _upsert_session swapped out. Those are Flask-Session's own (private)
+    hooks, which can change in any release, so pyproject.toml pins it to
+    the 0.8 series this was written against.
+    """
+
+    def __init__(self, app, report=False, warn_bytes=None, **kwargs):
+        super().__init__(app, **kwargs)
+        self.report = report
+        self.warn_bytes = warn_bytes
+        request_finished.connect(self.finished, app, weak=False)
+
+    @classmethod
+    def install(cls, app) -> None:
+        """REPLACES THE SESSION INTERFACE Flask-Session SET UP FOR app WITH A MEASURED ONE"""
+        current = app.session_interface
+        app.session_interface = cls(
+            app,
+            report=app.config['SESSION_REPORT'],
+            warn_bytes=app.config['SESSION_WARN_BYTES'],
+            client=current.client,
+            key_prefix=current.key_prefix,
+            use_signer=current.use_signer,
+            permanent=current.permanent,
+            sid_length=current.sid_length,
+            serialization_format=app.config['SESSION_SERIALIZATION_FORMAT'],
+        )
+
+    @staticmethod
+    def stats() -> dict:
+        """THIS REQUEST'S SESSION NUMBERS, FILLED IN AS THE SESSION IS READ AND WRITTEN"""
+        if 'session_stats' not in g:
+            g.session_stats = {
+                'reads': 0, 'read_bytes': 0, 'read_seconds': 0.0, 'decode_seconds': 0.0,
+                'writes': 0, 'write_bytes': 0, 'write_seconds': 0.0, 'encode_seconds': 0.0,
+            }
+        return g.session_stats
+
+    def _get_signer(self, app) -> Signer:
+        """SIGNS WITH THE RING'S ACTIVE KEY, AND ACCEPTS COOKIES SIGNED WITH ANY OF ITS KEYS"""
+        # itsdangerous signs with the last key in the list
+        return Signer(
+            list(reversed(KeyRing.keys())), salt="flask-session", key_derivation="hmac"
+        )
+
+    def _retrieve_session_data(self, store_id):
+        stats = self.stats()
+        started = time.perf_counter()
+        with Tracer.span('session', command='get') as span:
+            serialized_session_data = self.client.get(store_id)
+            span.set(bytes=len(serialized_session_data or b''))
+        decoding = time.perf_counter()
+        stats['reads'] += 1
+        stats['read_seconds'] += decoding - started
+        if not serialized_session_data:
+            return None
+        session_data = self.serializer.decode(serialized_session_data)
+        stats['decode_seconds'] += time.perf_counter() - decoding
+        stats['read_bytes'] = len(serialized_session_data)
+        return session_data
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        stats = self.stats()
+        stats['writes'] += 1
+        started = time.perf_counter()
+        serialized_session_data = self.serializer.encode(session)
+        writing = time.perf_counter()
+        stats['encode_seconds'] += writing - started
+        with Tracer.span('session', command='set', bytes=len(serialized_session_data)):
+            self.client.set(
+                name=store_id,
+                value=serialized_session_data,
+                ex=int(session_lifetime.total_seconds()),
+            )
+        stats['write_seconds'] += time.perf_counter() - writing
+        stats['write_bytes'] = len(serialized_session_data)
+        if self.warn_bytes and stats['write_bytes'] > self.warn_bytes:
+            # is something big being kept in it?
+            Tracer.log(
+                'session_too_big', level='warning',
+                bytes=stats['write_bytes'], keys=sorted(session.keys())
+            )
+
+    def finished(self, sender, response, **extra) -> None:
+        """COUNTS (AND MAYBE REPORTS) THE SESSION NUMBERS ONCE THE SESSION HAS BEEN SAVED"""
+        if 'session_stats' not in g:
+            return
+        stats = g.session_stats
+        Metrics.session(stats)
+        if not self.report:
+            return
+        Tracer.log(
+            'session_report', level='info',
+            method=request.method, path=request.path,
+            read_bytes=stats['read_bytes'],
+            read_ms=round(stats['read_seconds'] * 1000, 2),
+            decode_ms=round(stats['decode_seconds'] * 1000, 3),
+            write_bytes=stats['write_bytes'],
+            encode_ms=round(stats['encode_seconds'] * 1000, 3),
+            write_ms=round(stats['write_seconds'] * 1000, 2),
+        )
@@ -0,0 +1,98 @@
+"""
+Helpers for the shared Redis store.
+
+Flask-Session already keeps a Redis server around to hold everybody's session
+data, and every worker process talks to the same one. That makes it the
+natural place for anything the whole app should share -- like the one API
+userSessionId we log in for -- instead of each attendee's session carrying
+its own copy.
+
+Where that Redis is comes from the environment. With REDIS_URL set we talk
+to that server (any redis-server: local, or one shared by several hosts
+behind a load balancer) over a connection pool shared by every thread in
+the process, checking idle connections before reusing them and reconnecting
+with backoff when a connection drops. Without it we fall back on an embedded
+redislite server in a local file, which is all development needs, but which
+only the processes on one host can share.
+"""
+
+import json
+import os
+
+import redis as redis_py
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+from . import config
+from .tracing import Tracer
+from flask import current_app, has_app_context
+
+REDIS_URL = os.getenv("REDIS_URL")
+REDISLITE_PATH = os.getenv("REDISLITE_PATH", "/tmp/cache.db")
+# shared by every thread in the process (the write queue's worker, the
+# fan-out pools and the request threads)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+# idle connections get a PING before being reused after this many seconds
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "2"))
+# has to outlast the longest blocking command we send (the write queue
+# blocks for 5 seconds at a time waiting for work)
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "10"))
+REDIS_RETRIES = int(os.getenv("REDIS_RETRIES", "3"))
+
+
+def connect(url=REDIS_URL):
+    """
+    Makes the Redis client the sessions and everything else shared live in:
+    a pooled client for url if there is one, or embedded redislite if not.
+    Neither connects until it's first used, apart from redislite having to
+    start its server. The pool notices when it's been inherited across a
+    fork and starts afresh in the child, so every Gunicorn worker gets its
+    own connections.
+    """
+    if not url:
+        # only needed for development, so only imported for it
+        import redislite
+        return redislite.StrictRedis(REDISLITE_PATH)
+    pool = redis_py.ConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_keepalive=True,
+        retry=Retry(ExponentialBackoff(cap=1, base=0.05), REDIS_RETRIES),
+        retry_on_error=[redis_py.ConnectionError, redis_py.TimeoutError],
+    )
+    return redis_py.Redis(connection_pool=pool)
+
+
+def redis():
+    """
+    Returns the Redis client the sessions live in. Inside a request we use
+    whatever the app was configured with; outside of one (background threads,
+    worker pools) we fall back on the Config class it was configured from.
+    """
+    if has_app_context():
+        return current_app.config['SESSION_REDIS']
+    return config.Config.SESSION_REDIS
+
+
+def get_json(key):
+    """READS A JSON VALUE FROM THE SHARED STORE, OR None IF IT ISN'T THERE"""
+    with Tracer.span('store', command='get', key=key) as span:
+        raw = redis().get(key)
+        span.set(bytes=len(raw or b''))
+    if raw is None:
+        return None
+    return json.loads(raw)
+
+
+def set_json(key, value, ttl=None) -> None:
+    """WRITES A JSON VALUE TO THE SHARED STORE, EXPIRING AFTER ttl SECONDS"""
+    raw = json.dumps(value)
+    with Tracer.span('store', command='set', key=key, bytes=len(raw)):
+        redis().set(
+            key, raw,
+            ex=None if ttl is None else max(1, int(ttl))
+        )
@@ -0,0 +1,322 @@
+"""
+Tracing requests, for finding out where a slow login spent its time.
+
+Every request gets a trace id: the X-Request-ID it came in with (from a
+load balancer, say), or a new one, and it goes back out in the response's
+X-Request-ID header. Inside the request, every call to NeonCRM, every
+session read and write and every read and write of the shared store is a
+span -- timed, named after what it did, with its status and how many bytes
+it moved -- and spans started while another one is open are its children.
+Work handed off to the fanout and prefetch pools is traced under the
+request that handed it off.
+
+A finished trace is written out as JSON lines, one per span and one for the
+request itself, all with the trace id, to TRACE_PATH (or stdout). Errors
+(and the odd warning) are written there too, as they happen, by log(): a
+JSON line saying what went wrong, with the trace id and span it happened
+under, whether or not the request is being traced -- and if it is, an
+error makes sure its trace gets written, so the two can be read together. Which
+traces get written is up to TRACE_SAMPLE_RATE (the fraction of requests,
+0 by default, so nothing) and TRACE_SLOW_SECONDS (any request slower than
+that gets written whether it was sampled or not). The writing happens on a
+background thread, and if it can't keep up, traces get dropped rather than
+making requests wait, so it's safe to turn on in the middle of an event.
+"""
+
+import contextvars
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class Trace:
+    """ONE REQUEST'S TRACE: WHO IT IS AND THE SPANS IT'S FINISHED SO FAR"""
+
+    __slots__ = ('trace_id', 'sampled', 'errored', 'spans', 'span_ids', 'finished')
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        # something logged an error while it was going on
+        self.errored = False
+        self.spans = []
+        # spans get started on more than one thread at once
+        self.span_ids = itertools.count(1)
+        self.finished = False
+
+
+class Span:
+    """
+    One timed piece of work in a trace, used as a context manager. Whatever
+    it learns along the way (a status, a size) goes in with set(); if it's
+    left by an exception, the exception's name is noted as its error.
+    """
+
+    __slots__ = ('trace', 'name', 'attributes', 'span_id', 'parent_id', 'started', 'wall', 'token')
+
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.span_id = next(self.trace.span_ids)
+        self.parent_id = Tracer._span.get()
+        self.token = Tracer._span.set(self.span_id)
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        seconds = time.perf_counter() - self.started
+        Tracer._span.reset(self.token)
+        if error is not None:
+            self.attributes.setdefault('error', kind.__name__)
+        # the request's own span always goes in, however many came before it
+        if not self.trace.finished and (len(self.trace.spans) < Tracer.MAX_SPANS or self.parent_id is None):
+            self.trace.spans.append({
+                'trace_id': self.trace.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'start': round(self.wall, 6),
+                'ms': round(seconds * 1000, 3),
+                **self.attributes,
+            })
+        return False
+
+
+class NoSpan:
+    """STANDS IN FOR A SPAN WHEN NOTHING'S BEING TRACED"""
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        return False
+
+
+class Tracer:
+
+    SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+    # 0 means only sampled requests get written
+    SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "0"))
+    PATH = os.getenv("TRACE_PATH", "")
+    # how many traces can be waiting to be written before new ones get dropped
+    QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "1000"))
+    # so that one runaway request can't write a novel
+    MAX_SPANS = 500
+    HEADER = 'X-Request-ID'
+    # what we'll take from an incoming X-Request-ID, so nobody can put
+    # anything odd in our logs with it
+    INCOMING_ID = re.compile(r'[A-Za-z0-9._-]{8,64}')
+
+    _trace = contextvars.ContextVar('trace', default=None)
+    # every request has one of these, traced or not, for log() to use
+    _trace_id = contextvars.ContextVar('trace_id', default=None)
+    _span = contextvars.ContextVar('span', default=None)
+    _no_span = NoSpan()
+
+    _queue = None
+    _writer = None
+    _pid = None
+    _lock = threading.Lock()
+    _output = None
+    _output_pid = None
+    _write_lock = threading.Lock()
+    dropped = 0
+
+    @classmethod
+    def install(cls, app) -> None:
+        """GIVES EVERY REQUEST app ANSWERS A TRACE ID, AND TRACES THE ONES THAT MIGHT GET WRITTEN"""
+        app.wsgi_app = cls.traced(app.wsgi_app)
+
+    @classmethod
+    def traced(cls, wsgi_app):
+        def app(environ, start_response):
+            incoming = environ.get('HTTP_X_REQUEST_ID', '')
+            trace_id = incoming if cls.INCOMING_ID.fullmatch(incoming) else os.urandom(8).hex()
+            environ['tracing.trace_id'] = trace_id
+            trace_id_token = cls._trace_id.set(trace_id)
+            try:
+                return traced_request(environ, start_response, trace_id)
+            finally:
+                cls._trace_id.reset(trace_id_token)
+
+        def traced_request(environ, start_response, trace_id):
+            def add_header(status, headers, *args):
+                span.set(status=int(status.split(' ', 1)[0]))
+                return start_response(status, headers + [(cls.HEADER, trace_id)], *args)
+
+            sampled = random.random() < cls.SAMPLE_RATE
+            if not (sampled or cls.SLOW_SECONDS > 0):
+                # it can't end up being written, so there's no point keeping spans
+                # (anything log()ged still carries its id)
+                span = cls._no_span
+                return wsgi_app(environ, add_header)
+            trace = Trace(trace_id, sampled)
+            trace_token = cls._trace.set(trace)
+            # no query string, since ours can have authorization codes and admin tokens in them
+            span = Span(trace, 'request', {
+                'method': environ.get('REQUEST_METHOD', ''),
+                'path': environ.get('PATH_INFO', ''),
+            })
+            try:
+                with span:
+                    try:
+                        return wsgi_app(environ, add_header)
+                    finally:
+                        span.set(route=environ.get('metrics.route', 'unmatched'))
+            finally:
+                cls._trace.reset(trace_token)
+                cls.finish(trace)
+        return app
+
+    @classmethod
+    def span(cls, name, **attributes):
+        """
+        A span for some work done as part of the current request, to be
+        used as a context manager -- or something that only looks like one
+        if the request isn't being traced.
+        """
+        trace = cls._trace.get()
+        if trace is None or trace.finished:
+            return cls._no_span
+        return Span(trace, name, attributes)
+
+    @classmethod
+    def carry(cls, func):
+        """
+        func wrapped to run as part of the caller's trace, under the span
+        that's open now, for handing to another thread.
+        """
+        trace = cls._trace.get()
+        trace_id = cls._trace_id.get()
+        if trace is None and trace_id is None:
+            return func
+        parent = cls._span.get()
+
+        def carried(*args, **kwargs):
+            trace_token = cls._trace.set(trace)
+            trace_id_token = cls._trace_id.set(trace_id)
+            span_token = cls._span.set(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                cls._span.reset(span_token)
+                cls._trace_id.reset(trace_id_token)
+                cls._trace.reset(trace_token)
+        return carried
+
+    @classmethod
+    def current_trace_id(cls):
+        """THE ID OF THE REQUEST WE'RE PART OF, IF ANY, FOR WORK THAT WILL BE DONE LATER ON ITS BEHALF"""
+        return cls._trace_id.get()
+
+    @classmethod
+    @contextmanager
+    def on_behalf_of(cls, trace_id):
+        """LOGS INSIDE CARRY trace_id, FOR WORK DONE LATER FOR A REQUEST THAT'S LONG GONE (LIKE THE WRITE QUEUE'S)"""
+        token = cls._trace_id.set(trace_id)
+        try:
+            yield
+        finally:
+            cls._trace_id.reset(token)
+
+    @classmethod
+    def log(cls, event, level='error', error=None, **fields) -> None:
+        """
+        Writes one structured log record straight away: event (a short name
+        for what happened), the trace id and span it happened under, the
+        error if there was one, and any other fields that say more.
+        """
+        trace = cls._trace.get()
+        record = {
+            'time': round(time.time(), 6),
+            'level': level,
+            'event': event,
+            'trace_id': cls._trace_id.get(),
+            'span_id': cls._span.get(),
+            **fields,
+        }
+        if error is not None:
+            record['error'] = repr(error)
+        if trace is not None and level == 'error':
+            trace.errored = True
+        try:
+            cls.write([record])
+        except Exception as failure:
+            print("couldn't write a log record", repr(failure), record)
+
+    @classmethod
+    def write(cls, records) -> None:
+        """WRITES RECORDS OUT AS JSON LINES, ALL TOGETHER, TO TRACE_PATH OR STDOUT"""
+        text = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        with cls._write_lock:
+            if cls._output is None or cls._output_pid != os.getpid():
+                cls._output = open(cls.PATH, 'a', buffering=1) if cls.PATH else sys.stdout
+                cls._output_pid = os.getpid()
+            cls._output.write(text)
+
+    @classmethod
+    def finish(cls, trace) -> None:
+        """HANDS A FINISHED TRACE TO THE WRITER IF IT'S ONE WE WANT, WITHOUT WAITING ON IT"""
+        trace.finished = True
+        request_span = next(span for span in reversed(trace.spans) if span['parent_id'] is None)
+        slow = cls.SLOW_SECONDS > 0 and request_span['ms'] >= cls.SLOW_SECONDS * 1000
+        if not (trace.sampled or slow or trace.errored):
+            return
+        request_span['kept'] = 'sampled' if trace.sampled else 'error' if trace.errored else 'slow'
+        if len(trace.spans) >= cls.MAX_SPANS:
+            request_span['truncated'] = True
+        cls.ensure_writer()
+        try:
+            cls._queue.put_nowait(trace.spans)
+        except queue.Full:
+            cls.dropped += 1
+
+    @classmethod
+    def ensure_writer(cls) -> None:
+        """STARTS THIS PROCESS'S WRITING THREAD IF IT ISN'T ALREADY RUNNING"""
+        if cls._pid == os.getpid() and cls._writer.is_alive():
+            return
+        with cls._lock:
+            if cls._pid == os.getpid() and cls._writer.is_alive():
+                return
+            cls._queue = queue.Queue(maxsize=cls.QUEUE_SIZE)
+            cls._writer = threading.Thread(target=cls.write_forever, name='traces', daemon=True)
+            cls._pid = os.getpid()
+            cls._writer.start()
+
+    @classmethod
+    def write_forever(cls) -> None:
+        """THE BACKGROUND THREAD: WRITES EACH TRACE OUT AS IT COMES IN, A LINE PER SPAN"""
+        traces = cls._queue
+        while True:
+            spans = traces.get()
+            try:
+                cls.write(spans)
+            except Exception as error:
+                print("couldn't write a trace", repr(error))
+
+
+class TracedPool(ThreadPoolExecutor):
+    """A THREAD POOL WHOSE TASKS ARE TRACED AS PART OF WHATEVER REQUEST SUBMITTED THEM"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(Tracer.carry(fn), *args, **kwargs)
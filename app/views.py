@@ -1,13 +1,46 @@
+import hmac
 import os
-import requests
 
-from . import app, neoncrm, timezones
-from flask import render_template, session, request, redirect, url_for, abort
+from . import app, neoncrm, timezones, writequeue
+from .breaker import CircuitBreaker
+from .metrics import Metrics
+from .mirror import Mirror, Reports
+from .ratelimit import RateLimiter
+from .warmup import WarmUp
+from flask import render_template, session, request, redirect, url_for, abort, jsonify
 from datetime import datetime
 
 redirect_uri = os.getenv("REDIRECT_URI")
 # logout_url = os.getenv("LOGOUT_URL")
 
+# the user groups a constituent can check in to
+CHECK_IN_OPTIONS = [
+    "Atlas Demo Day",
+    "SheCodesTulsa",
+    "Tulsa Web Devs",
+    "Tulsa UX",
+    "Tulsa Game Developers",
+    "Tulsa Developers Association",
+    "Tulsa Agile Practitioners",
+    "Tulsa Area Techlahoma",
+    "OKC-Sharp",
+    "OKC LUGnuts",
+    "Oklahoma Game Developers",
+    "Oklahoma City Java Users",
+    "Oklahoma City Techlahoma",
+    "UX Connect OKC",
+    "OKC WebDevs",
+    "OKC Open Source Hardware",
+    "Pythonistas",
+    "Salesforce Meetup Group",
+    "SheCodesOKC",
+]
+
+@app.before_request
+def keep_write_queue_draining():
+    """every worker helps drain the write queue, even ones nobody has checked in on yet"""
+    writequeue.WriteQueue.ensure_worker()
+
 @app.errorhandler(404) # in case of a 404 error
 def page_not_found(e):
     return error(
@@ -42,149 +75,33 @@ def authorize():
     neoncrm.API.get_session_access(request.args.get('code'))
 
     # ---------------- API User Authentication --------------------------
-    # Now, let's authenticate ourselves as an API user and get
-    # the userSessionId we need to actually pull info from NeonCRM
-    # about our constituent (and, to send new info to NeonCRM about them!
+    # Now we need the API userSessionId to actually pull info from NeonCRM
+    # about our constituent (and, to send new info to NeonCRM about them!)
+    # We don't log in for it ourselves anymore: everybody shares the same
+    # one and neoncrm.SessionBroker keeps it fresh for us.
     # -------------------------------------------------------------------
-    # Next, we use the 'requests' library to send the GET request to the API
-    api_response = requests.get(
-        neoncrm.API.API_LOGIN_URL.format(
-            os.getenv("API_KEY"),
-            os.getenv("ORG_ID")
-        )
-    )
-    # print("about the print the reponse we got from authenticating as an API user")
-    # print(api_response.text)
-    # print("just printed the reponse we got from authenticating as an API user")
-    #
-    # Then we can check the content of the response to our request
-    if api_response.status_code == 200:
-        # if the request itself (Note: distinct from the login attempt!) was
-        # successful, we'll parse the response's JSON data
-        # print("about the print the json of the reponse we got from authenticating as an API user")
-        api_response_data = api_response.json()
-        # print(api_response_data)
-        # print("just finished printing the json of the reponse we got from authenticating as an API user")
-        #
-        # before checking to see if the login attempt worked.
-        #
-        # For context, a successful loginResponse would look something like:
-        # "loginResponse": {
-        #     "operationResult": "SUCCESS",
-        #     "responseMessage": "User logged in.",
-        #     "responseDateTime": "2012-12-25T21:26:41.981-06:00",
-        #     "userSessionId": "T1356492402097"
-        # }
-        #
-        login_response = api_response_data.get('loginResponse', {})
-        operation_result = login_response['operationResult']
-        # we'll also make a dictionary of error code descriptions taken from
-        # the NeonCRM API documentation
-        error_code_descriptions = {
-            '1': "An unknown system error. Often, these are generated due to a badly formed API request or a problem in NeonCRM.",
-            '2': "Indicates a temporary problem with NeonCRM's servers.",
-            '3': "A user session ID must be included with the request. Retrieve a session ID using the Login method.",
-            '4': "The provided user session ID is invalid.",
-            '5': "The user account associated with this API key does not have sufficient permissions to perform the desired operation."
-        }
-
-        if operation_result == 'SUCCESS':
-            # if the api login WAS a success, we'll grab the userSessionId
-            user_session_id = login_response.get('userSessionId')
-            # print("about to print the user_session_id we got back")
-            # print(user_session_id)
-            # print("about to print the user_session_id we got back")
-            if user_session_id:
-                # and print it out for logging/debugging purposes
-                # print('Great news! Login worked. User session ID is: ', user_session_id)
-                ###! FOR MOCKUP ONLY: And store it in the session (remember, it only lasts 10 minutes)
-                session['user_session_id'] = user_session_id
-
-                #######################################################################
-                # ------------ Get the Consituent's Information --------------------- #
-                # first, construct and make the API call
-                constituent_info_response = requests.get(
-                    neoncrm.API.CONSTITUENT_INFO_URL.format(
-                        session['user_session_id'],
-                        session['access_token']
-                    )
-                )
-                # then, check to see if the API call was successful
-                if constituent_info_response.status_code == 200:
-                    # if it was, parse it as JSON
-                    constituent_data = constituent_info_response.json()
-                    # print the response for debugging
-                    # print("about to print the consituent account data we got back")
-                    # print(constituent_data)
-                    # print("that concludes the printing of the account data")
-                    # then grab the data about the account
-                    constituent_account_data = constituent_data['retrieveIndividualAccountResponse']['individualAccount']
-                    # try to grab the preferred name, but failing that, get the first name
-                    constituent_name = constituent_account_data['primaryContact'].get('preferredName', constituent_account_data['primaryContact'].get('firstName'))
-                    # print the name for debugging
-                    # print(f"the constituent's name (preferred name if included) is: {constituent_name}")
-                    # and save the user's name to the session
-                    session['constituent_name'] = constituent_name
-                    ### Deal with the exception later
-                    # Now let's get the points records
-                    points_records = neoncrm.Constituent.retrieve_user_point_records(session['user_session_id'], session['access_token'])
-                    # print("now we are about to print the points records for the constituent")
-                    # print(points_records)
-                    # print("and that concludes the points records for the constituent")
-                    # print(points_records["listCustomObjectRecordsResponse"]["searchResults"]["nameValuePairs"])
-            else:
-                
-                print("login failed. No user session ID received.")
-                abort(500)
-        else:
-            # if the login was not a success, we will print out our terrible news
-            print("I am mortified to admit that the api login failed. Maybe someone canceled the atlas user account? The system replied: ", operation_result)
-            # if there are specific errors provided, we'll print them out too
-            if 'errors' in login_response:
-                errors_list = login_response['errors']['error']
-                for error in errors_list:
-                    error_code = str(error['errorCode'])
-                    error_message = error['errorMessage']
-                    error_description = error_code_descriptions.get(error_code, "No description available.")
-                    print(f"Error code: {error_code}, Message: {error_message}. Description: {error_description}")
-            abort(500)
-    else:
-        # if the HTTP request itself to the API failed to connect,
-        # we'll admit our problem and print our the status code:
-        print('Sadly, could not even connect to the api...', api_response.status_code)
+    try:
+        user_session_id = neoncrm.API.retrieve_user_session_id()
+    except ConnectionError:
         abort(500)
 
-    points_dict = neoncrm.Constituent.retrieve_user_point_records_dictionary(session['user_session_id'], session['access_token'])
-
-    session['points_dict'] = points_dict
+    #######################################################################
+    # ------------ Get the Consituent's Information --------------------- #
+    # Their name, their points records and the incentives catalog can all
+    # be fetched at the same time, so we let neoncrm do that for us and
+    # hand back everything in one go
+    login_bundle = neoncrm.Constituent.retrieve_login_bundle(user_session_id, session['access_token'])
+    constituent_name = login_bundle['constituent_name']
+    # save the user's name to the session
+    session['constituent_name'] = constituent_name
+    points_dict = login_bundle['points_dict']
 
-    check_in_options = [
-    "Atlas Demo Day",
-    "SheCodesTulsa",
-    "Tulsa Web Devs",
-    "Tulsa UX",
-    "Tulsa Game Developers",
-    "Tulsa Developers Association",
-    "Tulsa Agile Practitioners",
-    "Tulsa Area Techlahoma",
-    "OKC-Sharp",
-    "OKC LUGnuts",
-    "Oklahoma Game Developers",
-    "Oklahoma City Java Users",
-    "Oklahoma City Techlahoma",
-    "UX Connect OKC",
-    "OKC WebDevs",
-    "OKC Open Source Hardware",
-    "Pythonistas",
-    "Salesforce Meetup Group",
-    "SheCodesOKC",
-]
     if points_dict['eligible_for_checkin'] == True:
         return render_template(
         'check_in.html',
         # logout_url=os.getenv("LOGOUT_URL"),
         name=constituent_name,
-        check_in_options=check_in_options
+        check_in_options=CHECK_IN_OPTIONS
     )
     else:
         return redirect(url_for('dashboard'))
@@ -192,114 +109,83 @@ def authorize():
 
 @app.route('/dashboard', methods=['POST', 'GET'])
 def dashboard():
-    # grab all possible incentives and store them in the session
-    incentives_list_of_tuples = neoncrm.Constituent.get_incentives(session["user_session_id"])
-    session["all_incentives"] = incentives_list_of_tuples
-    formatted_date = timezones.Eastern.tznow().strftime("%m/%d/%y")
-    points_dict = session['points_dict']
+    # grab all possible incentives (they live in the shared store, not the session)
+    try:
+        user_session_id = neoncrm.API.retrieve_user_session_id()
+    except ConnectionError:
+        abort(500)
+    incentives_list_of_tuples = neoncrm.Constituent.get_incentives(user_session_id)
+    points_dict = current_points_dict(user_session_id)
     if request.method == 'POST':
-        # now let's get ready to post their new checkin event
-        selected_group = request.form.get('selected_group')
-        if selected_group:
-            if points_dict['eligible_for_checkin'] == True:
-                # print("about to print the group they selected")
-                # print(selected_group)
-                # print("that was the group they selected")
-                # First, let's create the new Points record in NeonCRM
-                # we begin by creating our API request
-                # Note ---- we need to double-check that it's okay ------ WE HAVE NOT CODED THAT PART YET
-                user_session_id = session['user_session_id']
-                access_token = session['access_token']
-                # and to include today's date in the name of the record, we'll need to get it
-                #today = datetime.today()
-                #formatted_date = today.strftime("%m/%d/%y")
-                # print(f"about to make a checkin record for {formatted_date}")
-                checkin_record_name = f'check-in: {selected_group} - {formatted_date}'
-                # print(f"we will call the record {checkin_record_name}")
-                # and format and send the API request
-                checkin_response = requests.post(neoncrm.API.EVENT_CHECKIN_URL.format(user_session_id, access_token, selected_group, checkin_record_name))
-                #print the raw response for debugging
-                # print("just submitted the post request to check in to the event. About to print the response code.")
-                # print(checkin_response)
-                # print("that was the response code")
-                # then, check to see if checkin api call was successful
-                if checkin_response.status_code == 200:
-                    # if it was, parse it as JSON
-                    checkin_data = checkin_response.json()
-                    # print it for debugging
-                    # print("about to print the json of the reponse we got back")
-                    # print(checkin_data)
-                    # print("that was the json of the reponse we got back")
-                    # and let's grab an updated points_dict
-                    points_dict = neoncrm.Constituent.retrieve_user_point_records_dictionary(user_session_id, access_token)
-                    # and update the points_dict in the session
-                    session['points_dict'] = points_dict
-                else:
-                    print("whoops")
-                    abort(500)
-                    ##! Fix this later, add error handling
-        linkedin = request.form.get('linkedin')
-        if linkedin:
-            if points_dict['eligible_for_data_update'] == True:
-                # print("about to print the linkedin url they gave")
-                # print(linkedin)
-                # print("that was the linkedin profile they shared")
-                # First, let's create the new Points record in NeonCRM
-                # we begin by creating our API request
-                # Note ---- we need to double-check that it's okay ------ WE HAVE NOT CODED THAT PART YET
-                user_session_id = session['user_session_id']
-                access_token = session['access_token']
-                # and to include today's date in the name of the record, we'll need to get it
-                #today = datetime.today()
-                #formatted_date = today.strftime("%m/%d/%y")
-                # print(f"about to make a data update Points record for {formatted_date}")
-                points_record_name = f'data update: linkedin - {formatted_date}'
-                # print(f"we will call the record {points_record_name}")
-                data_update_subtype = "linkedin"
-                # and format and send the API request
-                data_update_points_response = requests.post(neoncrm.API.DATA_UPDATE_POINTS_OBJECT_URL.format(user_session_id, access_token, data_update_subtype, points_record_name))
-                #print the raw response for debugging
-                # print("just submitted the post request to check in to the event. About to print the response code.")
-                # print(data_update_points_response)
-                # print("that was the response code")
-                # then, check to see if checkin api call was successful
-                if data_update_points_response.status_code == 200:
-                    # if it was, parse it as JSON
-                    data_update_points_response_data = data_update_points_response.json()
-                    # print it for debugging
-                    # print("about to print the json of the reponse we got back")
-                    # print(data_update_points_response_data)
-                    # print("that was the json of the reponse we got back")
-                    # and let's grab an updated points_dict
-                    points_dict = neoncrm.Constituent.retrieve_user_point_records_dictionary(user_session_id, access_token)
-                    # and update the points_dict in the session
-                    session['points_dict'] = points_dict
-                    # and now let's push the actual information to the Neon CRM server in the form of a 'data update' object
-                    data_update_data_update_record_response = requests.post(neoncrm.API.DATA_UPDATE_DATA_UPDATE_RECORD_CREATION_LINKEDIN_URL.format(user_session_id, access_token, linkedin, points_record_name, data_update_subtype))
-                    # print("just submitted the post request to add the 'data update' custom object record. About to print the response code.")
-                    # print(data_update_data_update_record_response)
-                    # print("that was the response code")
-                    # then, check to see if data update object creation api call was successful
-                    if data_update_data_update_record_response.status_code == 200:
-                        # if it was, parse it as JSON
-                        data_update_data_update_record_response_data = data_update_data_update_record_response.json()
-                        # print it for debugging
-                        # print("about to print the json of the reponse we got back")
-                        # print(data_update_data_update_record_response_data)
-                        # print("that was the json of the reponse we got back")
-                        # and let's grab an updated points_dict
-                    else:
-                        print("data update record creation failed")
-                        abort(500)
-                        ##! Fix this later, add error handling
-                else:
-                    print("whoops")
-                    abort(500)
-                    ##! Fix this later, add error handling
+        points_dict = record_submission(points_dict, incentives_list_of_tuples)
+
+    return render_dashboard(points_dict, incentives_list_of_tuples)
+
+def current_points_dict(user_session_id):
+    """
+    The logged in constituent's points dictionary, out of the shared points
+    cache (or from NeonCRM if it isn't in there)
+    """
+    return neoncrm.Constituent.get_points_dict(user_session_id, session['access_token'])
+
+def record_submission(points_dict, incentives):
+    """
+    Records whatever the dashboard form was submitted with -- a check-in, or
+    a LinkedIn profile for a data update. We don't wait on NeonCRM for any of
+    it: the points dictionary is updated right away as if the records had
+    already been created, and the records themselves go on the write queue,
+    which sends them in the background (and keeps retrying if NeonCRM has
+    trouble) and checks the points against NeonCRM once they're in.
+    """
+    access_token = session['access_token']
+    formatted_date = timezones.Eastern.tznow().strftime("%m/%d/%y")
+    # now let's get ready to post their new checkin event
+    selected_group = request.form.get('selected_group')
+    if selected_group:
+        if points_dict['eligible_for_checkin'] == True:
+            neoncrm.Constituent.apply_event(points_dict, neoncrm.PointsEvent(
+                stamp=neoncrm.PointsEvent.now(),
+                type='check-in',
+                subtype=selected_group,
+                awarded=neoncrm.Constituent.CHECKIN_POINTS,
+            ), incentives)
+            neoncrm.PointsCache.record_write(access_token, points_dict)
+            # to include today's date in the name of the record we use formatted_date
+            checkin_record_name = f'check-in: {selected_group} - {formatted_date}'
+            writequeue.WriteQueue.enqueue(
+                'checkin_create', 'EVENT_CHECKIN_URL',
+                access_token, selected_group, checkin_record_name,
+                account=access_token
+            )
+    linkedin = request.form.get('linkedin')
+    if linkedin:
+        if points_dict['eligible_for_data_update'] == True:
+            points_record_name = f'data update: linkedin - {formatted_date}'
+            data_update_subtype = "linkedin"
+            neoncrm.Constituent.apply_event(points_dict, neoncrm.PointsEvent(
+                stamp=neoncrm.PointsEvent.now(),
+                type='data update',
+                subtype=data_update_subtype,
+                awarded=neoncrm.Constituent.data_update_points(data_update_subtype),
+            ), incentives)
+            neoncrm.PointsCache.record_write(access_token, points_dict)
+            # first the Points record for the data update
+            writequeue.WriteQueue.enqueue(
+                'data_update_create', 'DATA_UPDATE_POINTS_OBJECT_URL',
+                access_token, data_update_subtype, points_record_name,
+                account=access_token
+            )
+            # and then the actual information in the form of a 'data update' object
+            writequeue.WriteQueue.enqueue(
+                'data_update_create', 'DATA_UPDATE_DATA_UPDATE_RECORD_CREATION_LINKEDIN_URL',
+                access_token, linkedin, points_record_name, data_update_subtype
+            )
+    return points_dict
 
+def render_dashboard(points_dict, incentives):
+    """Renders the dashboard for whoever is logged in from their points dictionary"""
     constituent_name = session['constituent_name']
-    incentives = session['list_of_incentives']
-    all_incentives_as_a_list_of_tuples_with_points_value_and_name = sorted(incentives)
+    all_incentives_as_a_list_of_tuples_with_points_value_and_name = list(neoncrm.RewardLadder.of(incentives).rewards)
     # logout_url=os.getenv("LOGOUT_URL")
 
     return render_template(
@@ -317,6 +203,8 @@ def dashboard():
         next_data_update_points_value = points_dict['next_data_update_points_value'],
         array_of_earned_rewards = points_dict['earned_rewards'],
         array_of_checkin_records = points_dict['events'],
+        # NeonCRM couldn't give us current points or incentives, so these are the last we had
+        stale = points_dict.get('stale', False) or getattr(incentives, 'stale', False),
     )
 
 
@@ -339,8 +227,12 @@ def logout():
 
 @app.route('/my-points')
 def account_details():
+    try:
+        user_session_id = neoncrm.API.retrieve_user_session_id()
+    except ConnectionError:
+        abort(500)
     return render_template('account_details.html',
-    points_dict=session['points_dict'],
+    points_dict=current_points_dict(user_session_id),
     name=session['constituent_name'],
     )
 
@@ -348,5 +240,96 @@ def account_details():
 def linkedin_form():
     return render_template('linkedin.html')
 
+def admin_authorized():
+    """
+    Checks the request for our ADMIN_TOKEN, either as a bearer token or as a
+    'token' query parameter (for webhooks that can't set headers). If no
+    token has been configured, nobody gets in.
+    """
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        return False
+    given = request.args.get('token', "")
+    authorization = request.headers.get('Authorization', "")
+    if authorization.startswith('Bearer '):
+        given = authorization[len('Bearer '):]
+    return hmac.compare_digest(given.encode(), admin_token.encode())
+
+# Staff (or a NeonCRM webhook) hit this after editing the incentives catalog
+@app.route('/admin/incentives/invalidate', methods=['POST'])
+def invalidate_incentives():
+    if not admin_authorized():
+        abort(403)
+    neoncrm.IncentivesCache.invalidate()
+    return jsonify(invalidated=True)
+
+# How the queues in front of NeonCRM are doing, for keeping an eye on an event
+# (the rate limits and breakers are this worker's own)
+@app.route('/admin/status')
+def status():
+    if not admin_authorized():
+        abort(403)
+    return jsonify(
+        write_queue=writequeue.WriteQueue.depth(),
+        rate_limits=RateLimiter.stats(),
+        circuit_breakers=CircuitBreaker.stats(),
+        mirror=Mirror.status(),
+    )
+
+# Staff questions answered out of the local mirror (see mirror.py), like
+# /admin/reports/attendance?group=Pythonistas&since=2026-07-01; only as fresh
+# as its last sync, which comes back with the answer
+@app.route('/admin/reports/<report>')
+def staff_report(report):
+    if not admin_authorized():
+        abort(403)
+    if report not in Reports.NAMES or not Mirror.enabled():
+        abort(404)
+    try:
+        since, until = (
+            datetime.strptime(request.args[name], "%Y-%m-%d").date() if request.args.get(name) else None
+            for name in ('since', 'until')
+        )
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        abort(400)
+    if report == 'attendance':
+        rows = Reports.attendance(since, until, request.args.get('group'))
+    elif report == 'data-updates':
+        rows = Reports.data_updates(since, until)
+    else:
+        try:
+            user_session_id = neoncrm.API.retrieve_user_session_id()
+        except ConnectionError:
+            abort(500)
+        rows = Reports.rewards(neoncrm.Constituent.get_incentives(user_session_id), since, until, limit)
+    return jsonify(report=report, mirror=Mirror.status(), rows=rows)
+
+# for Prometheus, which can send ADMIN_TOKEN as a bearer token; every worker's
+# numbers added up, whichever one answers
+@app.route('/metrics')
+def metrics():
+    if not admin_authorized():
+        abort(403)
+    depth = writequeue.WriteQueue.depth()
+    body = Metrics.exposition({
+        'neon_write_queue_depth': (
+            "NeonCRM writes in the queue, pending, waiting to be retried, or given up on.",
+            [({'queue': queue}, length) for queue, length in depth.items()]
+        ),
+    })
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Hit this (or run 'flask warm-up') a few minutes before an event starts;
+# outside the event window it won't do anything unless told to with ?force=1
+@app.route('/admin/warm-up', methods=['POST'])
+def warm_up():
+    if not admin_authorized():
+        abort(403)
+    if not (WarmUp.in_window() or request.args.get('force') == '1'):
+        return jsonify(warmed=False, window=[str(edge) for edge in WarmUp.window() or ()]), 409
+    report = WarmUp.run()
+    return jsonify(warmed=all(step['ok'] for step in report), steps=report)
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,157 @@
+"""
+Getting the app ready for the rush before an event starts.
+
+Every meetup goes the same way: nothing for hours, then everybody scans the
+QR code within a couple of minutes of the announcement slide. Left alone,
+the first people through would pay for everything that's cold: logging in
+as the API user, fetching the incentives catalog, connecting to NeonCRM and
+to the session store, and compiling the templates. Warming up does all of
+that ahead of time, a few minutes before EVENT_START.
+
+Some of it is shared by every worker (the API userSessionId, the incentives
+catalog, the secret keys), and some of it belongs to the process that does
+the warming up (its connections and compiled templates). 'flask warm-up'
+takes care of the shared part; POST /admin/warm-up does both for whichever
+worker answers it.
+"""
+
+import os
+import time
+
+from . import app, neoncrm, store, timezones
+from .keyring import KeyRing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+
+class WarmUp:
+
+    # when the next event starts, like 2026-10-20T18:30 (Eastern, like the
+    # rest of the app, unless it says otherwise)
+    EVENT_START = os.getenv("EVENT_START", "")
+    # how long before the start to warm up
+    LEAD = timedelta(minutes=float(os.getenv("WARMUP_LEAD_MINUTES", "5")))
+    # and how long after it there's still any point
+    WINDOW = timedelta(minutes=float(os.getenv("EVENT_WINDOW_MINUTES", "120")))
+    TEMPLATES = ('check_in.html', 'dashboard.html', 'account_details.html')
+
+    @classmethod
+    def event_start(cls):
+        """THE CONFIGURED EVENT_START AS AN AWARE DATETIME, OR None"""
+        if not cls.EVENT_START:
+            return None
+        start = datetime.fromisoformat(cls.EVENT_START)
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezones.Eastern)
+        return start
+
+    @classmethod
+    def window(cls):
+        """(when warming up starts making sense, when the event's over), or None"""
+        start = cls.event_start()
+        if start is None:
+            return None
+        return (start - cls.LEAD, start + cls.WINDOW)
+
+    @classmethod
+    def in_window(cls, now=None) -> bool:
+        window = cls.window()
+        if window is None:
+            return False
+        now = now or timezones.Eastern.tznow()
+        return window[0] <= now <= window[1]
+
+    @classmethod
+    def wait_for_window(cls) -> None:
+        """SLEEPS UNTIL IT'S TIME TO WARM UP (RIGHT AWAY IF IT ALREADY IS)"""
+        window = cls.window()
+        if window is None:
+            return
+        seconds = (window[0] - timezones.Eastern.tznow()).total_seconds()
+        if seconds > 0:
+            time.sleep(seconds)
+
+    @classmethod
+    def run(cls, local=True) -> list:
+        """
+        Warms everything up, one step at a time, and reports how each went
+        as a list of {'step', 'seconds', 'ok', 'detail'}. A step failing
+        doesn't stop the rest. local=False skips the steps that would only
+        warm up this process.
+        """
+        steps = [
+            ('session_store', cls.session_store),
+            ('api_session', cls.api_session),
+            ('incentives', cls.incentives),
+            ('check_in_options', cls.check_in_options),
+        ]
+        if local:
+            steps += [
+                ('neon_connections', cls.neon_connections),
+                ('templates', cls.templates),
+            ]
+        report = []
+        for name, step in steps:
+            started = time.perf_counter()
+            try:
+                detail, ok = step(), True
+            except Exception as error:
+                detail, ok = repr(error), False
+            report.append({
+                'step': name,
+                'seconds': round(time.perf_counter() - started, 4),
+                'ok': ok,
+                'detail': detail,
+            })
+        return report
+
+    @staticmethod
+    def session_store():
+        """connects to the session store and loads the signing keys"""
+        redis = store.redis()
+        redis.ping()
+        return f"{len(KeyRing.keys())} signing key(s)"
+
+    @staticmethod
+    def api_session():
+        """gets the shared userSessionId, logging in for it if need be"""
+        neoncrm.API.retrieve_user_session_id()
+        return "userSessionId ready"
+
+    @staticmethod
+    def incentives():
+        """loads the incentives catalog into the shared cache, and its reward ladder"""
+        incentives = neoncrm.Constituent.get_incentives(neoncrm.API.retrieve_user_session_id())
+        neoncrm.RewardLadder.of(incentives)
+        return f"{len(incentives)} incentives"
+
+    @staticmethod
+    def check_in_options():
+        """the user groups people will be choosing from"""
+        from .views import CHECK_IN_OPTIONS
+        return f"{len(CHECK_IN_OPTIONS)} check-in options"
+
+    @staticmethod
+    def neon_connections():
+        """
+        Fills this process's pool with open connections to NeonCRM by
+        making enough requests at once that each needs its own connection.
+        What they get back doesn't matter, just that the handshakes are done.
+        """
+        api = urlsplit(neoncrm.API.API_LOGIN_URL)
+        oauth = urlsplit(neoncrm.API.ACCESS_TOKEN_URL)
+        urls = [f"{api.scheme}://{api.netloc}/"] * neoncrm.Client.POOL_SIZE
+        urls.append(f"{oauth.scheme}://{oauth.netloc}/")
+        with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+            statuses = list(pool.map(
+                lambda url: neoncrm.Client.request('warmup', 'HEAD', url).status_code, urls
+            ))
+        return f"{len(statuses)} connections opened"
+
+    @classmethod
+    def templates(cls):
+        """compiles the templates the rush will be rendering, so Jinja has them cached"""
+        for name in cls.TEMPLATES:
+            app.jinja_env.get_template(name)
+        return f"{len(cls.TEMPLATES)} templates compiled"
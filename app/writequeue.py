@@ -0,0 +1,294 @@
+"""
+Write-behind queue for the records we create in NeonCRM.
+
+When somebody checks in or shares their LinkedIn, we don't make them wait on
+NeonCRM anymore. The record we need to create goes onto a list in the shared
+Redis store, the dashboard renders straight away, and a background thread in
+every worker process drains the list to NeonCRM, retrying with backoff when
+NeonCRM is slow or unhappy (and, before each retry, making sure the attempt
+that looked like it failed didn't create the record after all). Nothing is
+lost if NeonCRM is down for a while, or even if a worker dies halfway
+through sending something: each worker moves what it's working on to its
+own 'processing' list first, and anything left on the list of a worker that
+stopped checking in gets put back.
+
+Until a record has been sent, the constituent's cached points dictionary
+only has our optimistic guess at it. Once the last record we queued for
+somebody has been sent (or given up on), the worker fetches their points
+from NeonCRM again in the background and puts the result in the shared
+points cache, so anything we guessed wrong gets put right.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import requests
+
+from . import neoncrm, store
+from .export import CustomObjectPages
+from .tracing import Tracer
+
+
+class WriteQueue:
+
+    PENDING_KEY = 'neoncrm:writes'
+    RETRY_KEY = 'neoncrm:writes:retry'
+    DEAD_KEY = 'neoncrm:writes:dead'
+    PROCESSING_KEY = 'neoncrm:writes:processing:{}'
+    HEARTBEAT_KEY = 'neoncrm:writes:worker:{}'
+    # per constituent: how many of their Points records are still queued
+    OUTSTANDING_KEY = 'neoncrm:writes:outstanding:{}'
+
+    MAX_ATTEMPTS = int(os.getenv("NEON_WRITE_MAX_ATTEMPTS", "8"))
+    # seconds to wait before the first retry; doubles after each failure
+    RETRY_BACKOFF = float(os.getenv("NEON_WRITE_RETRY_BACKOFF", "2"))
+    MAX_RETRY_BACKOFF = float(os.getenv("NEON_WRITE_MAX_RETRY_BACKOFF", "300"))
+    # after a send that may have got there (it timed out waiting for the
+    # answer), how long to give NeonCRM to finish creating it before we look
+    SETTLE_SECONDS = float(os.getenv("NEON_WRITE_SETTLE_SECONDS", "30"))
+    # a worker that hasn't been heard from in this long is presumed dead; it
+    # has to comfortably outlast the slowest send (login plus timeouts)
+    HEARTBEAT_TTL = 120
+    # the longest the worker blocks waiting for new work; it wakes up sooner
+    # if a retry comes due before then
+    BLOCK_SECONDS = 5
+
+    # for each creation url: the object it creates, and which of its args are
+    # the constituent and the record's name -- which, since a record's name
+    # has the day in it and nobody can do the same thing twice in a day, is
+    # enough to find the record an earlier attempt may have made after all
+    CREATES = {
+        'EVENT_CHECKIN_URL': ('Points_c', 0, 2),
+        'DATA_UPDATE_POINTS_OBJECT_URL': ('Points_c', 0, 2),
+        'DATA_UPDATE_DATA_UPDATE_RECORD_CREATION_LINKEDIN_URL': ('Data_Updates_c', 0, 2),
+    }
+
+    _worker = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def enqueue(cls, operation, url_name, *args, account=None) -> dict:
+        """
+        Queues up a record to be created in NeonCRM. url_name is the name of
+        one of the creation urls in neoncrm.API, and args are everything it
+        needs formatted into it after the userSessionId -- which we look up
+        when the record is actually sent, so it's never a stale one. Records
+        that change somebody's points should say whose with account, so their
+        points get reconciled once it's been sent.
+        """
+        job = {
+            'id': uuid.uuid4().hex,
+            'operation': operation,
+            'url': url_name,
+            'args': list(args),
+            'account': account,
+            'attempts': 0,
+            'enqueued_at': time.time(),
+            'trace_id': Tracer.current_trace_id(),
+        }
+        pipe = store.redis().pipeline()
+        if account is not None:
+            pipe.incr(cls.OUTSTANDING_KEY.format(account))
+        pipe.lpush(cls.PENDING_KEY, json.dumps(job))
+        pipe.execute()
+        cls.ensure_worker()
+        return job
+
+    @classmethod
+    def ensure_worker(cls) -> None:
+        """STARTS THIS PROCESS'S DRAINING THREAD IF IT ISN'T ALREADY RUNNING"""
+        if cls._pid == os.getpid() and cls._worker.is_alive():
+            return
+        with cls._lock:
+            if cls._pid == os.getpid() and cls._worker.is_alive():
+                return
+            cls._worker = threading.Thread(
+                target=cls.drain_forever,
+                name='neoncrm-writes',
+                daemon=True
+            )
+            cls._pid = os.getpid()
+            cls._worker.start()
+
+    @staticmethod
+    def worker_id() -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    @classmethod
+    def drain_forever(cls) -> None:
+        """THE BACKGROUND THREAD: SEND EVERYTHING THAT COMES IN, FOREVER"""
+        processing_key = cls.PROCESSING_KEY.format(cls.worker_id())
+        next_housekeeping = 0
+        while True:
+            try:
+                if time.time() >= next_housekeeping:
+                    cls.heartbeat()
+                    cls.recover_abandoned()
+                    next_housekeeping = time.time() + cls.HEARTBEAT_TTL / 4
+                cls.promote_due_retries()
+                raw = store.redis().blmove(
+                    cls.PENDING_KEY, processing_key, cls.wait_for_work(), 'RIGHT', 'LEFT'
+                )
+                if raw is not None:
+                    cls.process(raw, processing_key)
+            except Exception as error:
+                # the queue itself is in Redis, so the worst a hiccup can do
+                # is delay things; we never want this thread to die
+                Tracer.log('write_queue_snag', error=error)
+                time.sleep(1)
+
+    @classmethod
+    def process(cls, raw, processing_key) -> None:
+        """TRIES TO SEND ONE QUEUED RECORD, RESCHEDULING IT IF THAT FAILS"""
+        job = json.loads(raw)
+        # anything logged while sending it goes with the request that queued it
+        with Tracer.on_behalf_of(job.get('trace_id')):
+            try:
+                # an earlier attempt that timed out may have created it anyway, and
+                # sending it again would give somebody their points twice
+                succeeded = (job['attempts'] > 0 and cls.already_created(job)) or cls.send(job)
+            except Exception as error:
+                Tracer.log(
+                    'queued_record_failed', level='warning', error=error,
+                    job=job['id'], attempt=job['attempts'] + 1
+                )
+                succeeded = False
+                # anything that went wrong after the request went out, it may
+                # still be creating the record
+                maybe_sent = isinstance(error, requests.RequestException) and not isinstance(
+                    error, (requests.ConnectTimeout, requests.exceptions.InvalidURL)
+                )
+            else:
+                maybe_sent = False
+            finished = True
+            pipe = store.redis().pipeline()
+            pipe.lrem(processing_key, 1, raw)
+            if not succeeded:
+                job['attempts'] += 1
+                if job['attempts'] >= cls.MAX_ATTEMPTS:
+                    Tracer.log('queued_record_dead', job=job['id'], attempts=job['attempts'])
+                    pipe.lpush(cls.DEAD_KEY, json.dumps(job))
+                else:
+                    delay = cls.backoff(job['attempts'])
+                    if maybe_sent:
+                        delay = max(delay, cls.SETTLE_SECONDS)
+                    pipe.zadd(cls.RETRY_KEY, {json.dumps(job): time.time() + delay})
+                    finished = False
+            pipe.execute()
+            if finished and job.get('account') is not None:
+                cls.settle(job['account'])
+
+    @classmethod
+    def settle(cls, account) -> None:
+        """
+        Counts one of a constituent's queued records as done with, and if it
+        was the last one, reconciles their points with NeonCRM.
+        """
+        if store.redis().decr(cls.OUTSTANDING_KEY.format(account)) > 0:
+            return
+        store.redis().delete(cls.OUTSTANDING_KEY.format(account))
+        version = neoncrm.PointsCache.version(account)
+        try:
+            points_dict = neoncrm.Constituent.retrieve_user_point_records_dictionary(
+                neoncrm.API.retrieve_user_session_id(), account
+            )
+        except Exception as error:
+            # no harm done, they just keep seeing our guess for now
+            Tracer.log('points_reconcile_failed', error=error, account=neoncrm.Constituent.fingerprint(account))
+            return
+        # if they queued something else up while we were fetching, what we
+        # fetched is already out of date and the cache won't take it; the
+        # next settle will try again
+        neoncrm.PointsCache.put(account, points_dict, version)
+
+    @staticmethod
+    def send(job) -> bool:
+        """
+        Creates the record in NeonCRM, raising OperationFailed if NeonCRM
+        says it didn't. If that's because it's forgotten our userSessionId,
+        the next attempt logs in again instead of trying the same one.
+        """
+        user_session_id = neoncrm.API.retrieve_user_session_id()
+        url = getattr(neoncrm.API, job['url']).format(user_session_id, *job['args'])
+        neoncrm.API.result(
+            neoncrm.Client.post(job['operation'], url),
+            'createCustomObjectRecordResponse', f"creating queued record {job['id']}", user_session_id
+        )
+        return True
+
+    @classmethod
+    def already_created(cls, job) -> bool:
+        """
+        Whether NeonCRM already has the record a job is for, from an attempt
+        we never heard back from. If we can't find out, that's a failed
+        attempt like any other -- better late than twice.
+        """
+        if job['url'] not in cls.CREATES:
+            return False
+        object_name, account_arg, name_arg = cls.CREATES[job['url']]
+        lookup = CustomObjectPages(object_name, ('id',), (
+            ('Constituent_c', 'EQUAL', str(job['args'][account_arg])),
+            ('name', 'EQUAL', job['args'][name_arg]),
+        ), page_size=1, operation='write_lookup', retries=0)
+        records, _ = lookup.fetch(1)
+        if records:
+            Tracer.log('queued_record_already_created', level='info', job=job['id'])
+        return bool(records)
+
+    @classmethod
+    def backoff(cls, attempts) -> float:
+        return min(cls.RETRY_BACKOFF * 2 ** (attempts - 1), cls.MAX_RETRY_BACKOFF)
+
+    @classmethod
+    def promote_due_retries(cls) -> None:
+        """MOVES RETRIES WHOSE BACKOFF HAS RUN OUT BACK ONTO THE PENDING LIST"""
+        redis = store.redis()
+        for raw in redis.zrangebyscore(cls.RETRY_KEY, 0, time.time(), start=0, num=100):
+            # whoever manages to remove it from the retry set gets to requeue it
+            if redis.zrem(cls.RETRY_KEY, raw):
+                redis.lpush(cls.PENDING_KEY, raw)
+
+    @classmethod
+    def wait_for_work(cls) -> float:
+        """HOW LONG TO BLOCK ON THE PENDING LIST: BLOCK_SECONDS, OR UNTIL THE NEXT RETRY IS DUE"""
+        soonest = store.redis().zrange(cls.RETRY_KEY, 0, 0, withscores=True)
+        if not soonest:
+            return cls.BLOCK_SECONDS
+        # never 0, which would mean waiting forever
+        return min(cls.BLOCK_SECONDS, max(0.01, soonest[0][1] - time.time()))
+
+    @classmethod
+    def heartbeat(cls) -> None:
+        store.redis().set(
+            cls.HEARTBEAT_KEY.format(cls.worker_id()), 1, ex=cls.HEARTBEAT_TTL
+        )
+
+    @classmethod
+    def recover_abandoned(cls) -> None:
+        """
+        Puts back anything sitting on the processing list of a worker whose
+        heartbeat has run out -- it died before it could finish sending it.
+        """
+        redis = store.redis()
+        prefix = cls.PROCESSING_KEY.format('')
+        for key in redis.scan_iter(match=prefix + '*', count=100):
+            worker = key.decode()[len(prefix):]
+            if redis.exists(cls.HEARTBEAT_KEY.format(worker)):
+                continue
+            while redis.lmove(key, cls.PENDING_KEY, 'RIGHT', 'LEFT') is not None:
+                pass
+
+    @classmethod
+    def depth(cls) -> dict:
+        """HOW MUCH IS WAITING, FOR KEEPING AN EYE ON THINGS"""
+        redis = store.redis()
+        return {
+            'pending': redis.llen(cls.PENDING_KEY),
+            'retrying': redis.zcard(cls.RETRY_KEY),
+            'dead': redis.llen(cls.DEAD_KEY),
+        }
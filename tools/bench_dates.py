@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+"""
+Benchmarks what it costs to handle one Points_c record's createTime.
+
+The old pipeline parsed createTime with strptime, formatted it back into an
+"%m/%d/%y" string, and then parsed that string with strptime again to sort
+on it. Now it's parsed once into a PointsEvent stamp. This times both, per
+record, over a made-up history, with the stamp parser's cache both empty
+(every timestamp new to it) and warm.
+
+Run it from the root of the repo:
+
+    python3 -m tools.bench_dates [number of records]
+"""
+
+import random
+import sys
+import timeit
+
+from datetime import datetime, timedelta
+
+from app.neoncrm import PointsEvent
+
+
+def make_timestamps(count):
+    """COUNT createTime VALUES SPREAD OVER A FEW YEARS, SOME REPEATED"""
+    rng = random.Random(405)
+    start = datetime(2022, 1, 1)
+    stamps = []
+    for _ in range(count):
+        if stamps and rng.random() < 0.2:
+            # records created in bulk share a timestamp
+            stamps.append(stamps[-1])
+        else:
+            moment = start + timedelta(seconds=rng.randrange(3 * 365 * 86400))
+            stamps.append(moment.strftime("%m/%d/%Y %H:%M:%S"))
+    return stamps
+
+
+def old_pipeline(timestamps):
+    dates = [
+        datetime.strptime(value, "%m/%d/%Y %H:%M:%S").strftime("%m/%d/%y")
+        for value in timestamps
+    ]
+    dates.sort(key=lambda value: datetime.strptime(value, "%m/%d/%y"), reverse=True)
+    return dates
+
+
+def new_pipeline(timestamps):
+    stamps = [PointsEvent.parse_timestamp(value) for value in timestamps]
+    stamps.sort(reverse=True)
+    return stamps
+
+
+def per_record(func, timestamps, cold=False, repeat=5):
+    """BEST OF repeat RUNS, IN MICROSECONDS PER RECORD"""
+    def run():
+        if cold:
+            PointsEvent.parse_timestamp.cache_clear()
+            PointsEvent.day_ordinal.cache_clear()
+        func(timestamps)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / len(timestamps) * 1e6
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    timestamps = make_timestamps(count)
+    old = per_record(old_pipeline, timestamps)
+    cold = per_record(new_pipeline, timestamps, cold=True)
+    warm = per_record(new_pipeline, timestamps)
+    print(f"{count} records")
+    print(f"  strptime -> strftime -> strptime:  {old:7.2f} us/record")
+    print(f"  single parse, cold cache:          {cold:7.2f} us/record  ({old / cold:4.1f}x)")
+    print(f"  single parse, warm cache:          {warm:7.2f} us/record  ({old / warm:4.1f}x)")
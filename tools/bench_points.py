@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+"""
+Benchmarks turning a member's Points_c records into their points dictionary,
+one stage at a time, and fails if any stage has got slower or hungrier.
+
+Everything between NeonCRM's response and the points cache is pure
+computation, split up in neoncrm.Constituent so each piece can be run on
+its own. For made-up listCustomObjectRecordsResponse payloads of 10, 200,
+2,000 and 20,000 records, shaped like example_data/constituent, it times:
+
+    decode     the JSON text into dicts, like response.json()
+    parse      the nameValuePair lists into PointsEvents (timestamp caches empty)
+    sort       the events newest first
+    scan       adding up the points and working out what they're eligible for
+    rewards    building the reward ladder and finding their rewards
+    history    packing the events into a PointsHistory
+    cache      dumping the points dictionary to JSON for the points cache
+
+and measures the peak memory each stage allocates (with tracemalloc, in a
+separate run, since tracing slows everything down).
+
+The results are compared with the baseline stored in tools/bench_points.json,
+and it exits with 1 if a stage takes more than --tolerance longer, or
+allocates more than --memory-tolerance more, than it did then. Timings only
+mean anything on the machine that made the baseline, so after changing the
+pipeline on purpose (or moving to a new machine), store a new one with --save.
+
+Run it from the root of the repo:
+
+    python3 -m tools.bench_points
+    python3 -m tools.bench_points --sizes 200,2000 --save
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+from app.neoncrm import Constituent, PointsCache, PointsEvent, PointsHistory, RewardLadder
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'bench_points.json')
+SIZES = (10, 200, 2000, 20000)
+STAGES = ('decode', 'parse', 'sort', 'scan', 'rewards', 'history', 'cache')
+# the day the made-up histories end on, so eligibility comes out the same every run
+TODAY = datetime(2025, 10, 14, 19, 0, 0)
+GROUPS = (
+    'Tulsa Web Devs', 'OKC Python', 'Techlahoma Foundation', 'OKC Coffee and Code',
+    'Tulsa Game Developers', 'Norman Rust', 'OKC WiTNet', 'Tulsa Data Science',
+)
+INCENTIVES = [
+    (points_needed, f"Reward {number}")
+    for number, points_needed in enumerate((25, 50, 75, 100, 150, 200, 300, 500, 750, 1000, 2500, 5000))
+]
+
+
+def make_payload(count) -> str:
+    """
+    The JSON text of a listCustomObjectRecordsResponse with count Points_c
+    records, like NeonCRM sends: mostly check-ins at random groups over a
+    few years, a few data updates, one check-in today, and now and again
+    several records created in the same second.
+    """
+    rng = random.Random(405 + count)
+    moments = []
+    for _ in range(count - 1):
+        if moments and rng.random() < 0.1:
+            moments.append(moments[-1])
+        else:
+            moments.append(TODAY - timedelta(seconds=rng.randrange(86400, 4 * 365 * 86400)))
+    moments.append(TODAY)
+    records = []
+    for number, moment in enumerate(moments, start=1):
+        if rng.random() < 0.05:
+            point_type, point_subtype, awarded = 'data-update', rng.choice(('linkedin', 'employment', 'cell')), 5
+        else:
+            point_type, point_subtype, awarded = 'check-in', rng.choice(GROUPS), 10
+        records.append({"nameValuePair": [
+            {"name": "id", "value": str(number)},
+            {"name": "name", "value": f"{point_type}: {point_subtype} - {moment:%m/%d/%y}"},
+            {"name": "createTime", "value": moment.strftime("%m/%d/%Y %H:%M:%S")},
+            {"name": "point_type_c", "value": point_type},
+            {"name": "point_subtype_c", "value": point_subtype},
+            {"name": "Points_Awarded_c", "value": str(awarded)},
+        ]})
+    return json.dumps({"listCustomObjectRecordsResponse": {
+        "operationResult": "SUCCESS",
+        "responseDateTime": TODAY.strftime("%Y-%m-%dT%H:%M:%S.000-05:00"),
+        "page": {"currentPage": 1, "pageSize": count, "totalPage": 1, "totalResults": count},
+        "searchResults": {"nameValuePairs": records},
+    }})
+
+
+def parse(page) -> list:
+    PointsEvent.parse_timestamp.cache_clear()
+    PointsEvent.day_ordinal.cache_clear()
+    return list(Constituent.parse_point_records(page))
+
+
+def rewards(total_points) -> dict:
+    RewardLadder._of.cache_clear()
+    return RewardLadder.of(INCENTIVES).rewards_for(total_points)
+
+
+def stages_for(payload) -> dict:
+    """
+    Each stage as a function of no arguments, with its input made ahead of
+    time from the output of the stages before it.
+    """
+    page = json.loads(payload)["listCustomObjectRecordsResponse"]
+    events = Constituent.sort_events(parse(page))
+    points_dict = Constituent.scan_events(events, TODAY.toordinal())
+    points_dict['events'] = PointsHistory(events)
+    points_dict.update(rewards(points_dict['points']))
+    unsorted = list(reversed(events))
+    return {
+        'decode': lambda: json.loads(payload),
+        'parse': lambda: parse(page),
+        'sort': lambda: Constituent.sort_events(unsorted),
+        'scan': lambda: Constituent.scan_events(events, TODAY.toordinal()),
+        'rewards': lambda: rewards(points_dict['points']),
+        'history': lambda: PointsHistory(events),
+        'cache': lambda: json.dumps(PointsCache.dump(points_dict)),
+    }
+
+
+def best_time(func, repeat) -> float:
+    """
+    The best of repeat runs, in milliseconds per call, where each run calls
+    func enough times to take 20 milliseconds or so, so small inputs aren't
+    lost in the timer's noise.
+    """
+    started = time.perf_counter()
+    func()
+    once = time.perf_counter() - started
+    number = max(1, min(1000, int(0.02 / once) if once else 1000))
+    best = None
+    # like timeit, keep the garbage collector from going off in the middle
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                func()
+            elapsed = (time.perf_counter() - started) / number
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    return best * 1000
+
+
+def peak_memory(func) -> float:
+    """HOW MANY KILOBYTES func HAS ALLOCATED AT ONCE, AT MOST"""
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak / 1024
+
+
+def run(sizes, repeat, only=None) -> dict:
+    results = {}
+    for size in sizes:
+        stages = stages_for(make_payload(size))
+        results[str(size)] = {
+            name: {
+                'ms': round(best_time(stage, repeat), 4),
+                'peak_kb': round(peak_memory(stage), 1),
+            }
+            for name, stage in stages.items()
+            if not only or name in only
+        }
+    return results
+
+
+def compare(results, baseline, tolerance, memory_tolerance, floor_ms) -> list:
+    """
+    Every stage that's regressed against the baseline, as lines to print.
+    Differences under floor_ms, or under 16kB, are put down to noise.
+    """
+    regressions = []
+    for size, stages in results.items():
+        for name, now in stages.items():
+            then = baseline.get(size, {}).get(name)
+            if then is None:
+                continue
+            if now['ms'] > then['ms'] * (1 + tolerance) and now['ms'] - then['ms'] > floor_ms:
+                regressions.append(
+                    f"{name} at {size} records: {now['ms']:.3f}ms, was {then['ms']:.3f}ms"
+                )
+            if now['peak_kb'] > then['peak_kb'] * (1 + memory_tolerance) and now['peak_kb'] - then['peak_kb'] > 16:
+                regressions.append(
+                    f"{name} at {size} records: peak {now['peak_kb']:.1f}kB, was {then['peak_kb']:.1f}kB"
+                )
+    return regressions
+
+
+def report(results, baseline) -> None:
+    print(f"{'records':>8}  {'stage':<8}{'ms':>11}{'baseline':>11}{'peak kB':>11}{'baseline':>11}")
+    for size, stages in results.items():
+        for name, now in stages.items():
+            then = baseline.get(size, {}).get(name, {})
+            print(
+                f"{size:>8}  {name:<8}{now['ms']:>11.3f}{then.get('ms', float('nan')):>11.3f}"
+                f"{now['peak_kb']:>11.1f}{then.get('peak_kb', float('nan')):>11.1f}"
+            )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the points pipeline stage by stage.")
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help="how many records in each payload, comma separated")
+    parser.add_argument('--stage', action='append', choices=STAGES,
+                        help="only run this stage (can be given more than once)")
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help="store these results as the new baseline instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="how much slower a stage can get before it's a regression")
+    parser.add_argument('--memory-tolerance', type=float, default=0.1,
+                        help="how much more memory a stage can take before it's a regression")
+    parser.add_argument('--floor-ms', type=float, default=0.05,
+                        help="slowdowns smaller than this are never a regression")
+    options = parser.parse_args(argv)
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = run(sizes, options.repeat, options.stage)
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    report(results, baseline.get('sizes', {}))
+
+    if options.save:
+        stored = baseline.get('sizes', {})
+        for size, stages in results.items():
+            stored.setdefault(size, {}).update(stages)
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump({
+                'saved_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'sizes': stored,
+            }, baseline_file, indent=2)
+        print("saved the baseline to", options.baseline)
+        return 0
+
+    if not baseline:
+        print("no baseline at", options.baseline, "to compare with; store one with --save")
+        return 0
+    regressions = compare(
+        results, baseline['sizes'], options.tolerance, options.memory_tolerance, options.floor_ms
+    )
+    for line in regressions:
+        print("REGRESSION:", line)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,465 @@
+#!/usr/bin/python3
+"""
+A fake NeonCRM to test the app against, so nothing we try out lands on the
+real api.neoncrm.com (or on our real members' records).
+
+It answers the handful of calls the app makes, the way NeonCRM answers them:
+
+    POST /np/oauth/token                                       the OAuth code exchange
+    GET  /neonws/services/api/common/login                     the API user's login
+    GET  /neonws/services/api/account/retrieveIndividualAccount
+    GET  /neonws/services/api/customObjectRecord/listCustomObjectRecords   (paged)
+    GET  /neonws/services/api/customObjectRecord/createCustomObjectRecord
+
+Members are made up from a seed, each with a Points_c history of one of the
+sizes given with --history. The OAuth code for a member is just their
+account id (1000 is the first one), so a load test can "log in" as anybody
+with /authorize?code=1000. Any other code gets hashed to a member.
+
+To make things realistically unpleasant it can add latency to each call
+(--latency), fail calls with NeonCRM's error codes 1-5 (--error), expire
+userSessionIds (--session-lifetime), and throttle everybody to a number of
+calls per second with 429s (--throttle).
+
+GET /_fake/stats tells you how many calls of each kind it has answered,
+and POST /_fake/reset starts the counts over.
+
+Run it from the root of the repo, then point the app at it:
+
+    python3 -m tools.fakeneon --members 500 --history 10,200,2000 --latency list:Points_c=lognormal:120:0.6
+    NEON_API_BASE=http://127.0.0.1:8765 NEON_OAUTH_BASE=http://127.0.0.1:8765 flask --app app run
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+API_PREFIX = '/neonws/services/api/'
+TIME_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+FIRST_NAMES = (
+    "Ada", "Grace", "Linus", "Guido", "Barbara", "Ken", "Margaret", "Dennis",
+    "Radia", "Alan", "Frances", "Donald", "Hedy", "Tim", "Katherine", "Bjarne",
+)
+LAST_NAMES = (
+    "Lovelace", "Hopper", "Torvalds", "van Rossum", "Liskov", "Thompson",
+    "Hamilton", "Ritchie", "Perlman", "Turing", "Allen", "Knuth",
+)
+USER_GROUPS = (
+    "Pythonistas", "OKC WebDevs", "Tulsa Web Devs", "Tulsa UX", "OKC-Sharp",
+    "SheCodesOKC", "SheCodesTulsa", "Oklahoma City Java Users", "OKC LUGnuts",
+)
+INCENTIVES = (
+    ("Sticker", 50), ("T-shirt", 200), ("Hoodie", 500), ("Backpack", 1000),
+    ("Conference ticket", 2500),
+)
+# what NeonCRM's workflow fills Points_Awarded_c in with for new records
+AWARDED = {'check-in': 10, 'data update': 5}
+ERROR_MESSAGES = {
+    1: "System error.",
+    2: "Temporary error, please try again.",
+    3: "User session ID is required.",
+    4: "User session ID is invalid.",
+    5: "Permission denied.",
+}
+
+
+class Latency:
+    """
+    A latency distribution, from a spec like 'fixed:50', 'uniform:20:200'
+    or 'lognormal:120:0.6' (a median in milliseconds and a sigma).
+    """
+
+    def __init__(self, spec):
+        kind, *numbers = spec.split(':')
+        self.kind = kind
+        self.numbers = [float(number) for number in numbers]
+        if kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f"unknown latency distribution {spec!r}")
+
+    def sample(self, rng) -> float:
+        """ONE DELAY, IN SECONDS"""
+        if self.kind == 'fixed':
+            milliseconds = self.numbers[0]
+        elif self.kind == 'uniform':
+            milliseconds = rng.uniform(*self.numbers)
+        else:
+            median, sigma = self.numbers
+            milliseconds = rng.lognormvariate(math.log(median), sigma)
+        return milliseconds / 1000
+
+
+class Neon:
+    """Everything the fake NeonCRM knows, and how it answers each call."""
+
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.latency = {}
+        for spec in options.latency:
+            operation, _, distribution = spec.rpartition('=')
+            self.latency[operation or '*'] = Latency(distribution)
+        self.errors = {}
+        for spec in options.error:
+            code, _, rate = spec.partition('=')
+            self.errors[int(code)] = float(rate)
+        self.sessions = {}
+        self.calls = Counter()
+        self.tokens = options.throttle_burst
+        self.refilled_at = time.monotonic()
+        self.seed()
+
+    # ---------------- made-up members and their records ----------------
+
+    def seed(self) -> None:
+        rng = random.Random(self.options.seed)
+        sizes = [int(size) for size in self.options.history.split(',')]
+        now = datetime.now().replace(microsecond=0)
+        self.members = {}
+        self.records = {'Points_c': [], 'Data_Updates_c': [], 'Incentives_c': []}
+        # (object, Constituent_c) -> records, since that's what almost every search is by
+        self.by_member = {}
+        self.next_id = 1
+        for name, points_needed in INCENTIVES:
+            self.add('Incentives_c', {'name': name, 'Points_Needed_c': str(points_needed)}, now)
+        for index in range(self.options.members):
+            account = 1000 + index
+            self.members[account] = {
+                'firstName': rng.choice(FIRST_NAMES),
+                'lastName': rng.choice(LAST_NAMES),
+            }
+            history = sizes[index % len(sizes)]
+            # oldest first, none of it today, so everybody can still check in
+            moments = sorted(
+                now - timedelta(days=1, seconds=rng.randrange(3 * 365 * 86400))
+                for _ in range(history)
+            )
+            for moment in moments:
+                if rng.random() < 0.05:
+                    point_type, subtype = 'data update', 'linkedin'
+                else:
+                    point_type, subtype = 'check-in', rng.choice(USER_GROUPS)
+                self.add('Points_c', {
+                    'name': f"{point_type} {moment:%m/%d/%y}",
+                    'Constituent_c': str(account),
+                    'point_type_c': point_type,
+                    'point_subtype_c': subtype,
+                    'Points_Awarded_c': str(AWARDED[point_type]),
+                }, moment)
+
+    def add(self, object_name, fields, created) -> dict:
+        record = dict(fields, id=str(self.next_id), createTime=created.strftime(TIME_FORMAT))
+        record['_created'] = created
+        self.next_id += 1
+        self.records[object_name].append(record)
+        if 'Constituent_c' in fields:
+            self.by_member.setdefault((object_name, fields['Constituent_c']), []).append(record)
+        return record
+
+    def member_for_code(self, code) -> int:
+        if code and code.isdigit() and int(code) in self.members:
+            return int(code)
+        return 1000 + zlib.crc32((code or '').encode()) % len(self.members)
+
+    # ---------------- the calls ----------------
+
+    def token(self, form):
+        return 200, {
+            'access_token': str(self.member_for_code(form.get('code'))),
+            'token_type': 'bearer',
+        }
+
+    def login(self, query):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = time.monotonic() + self.options.session_lifetime
+        return 200, {'loginResponse': {
+            'operationResult': 'SUCCESS',
+            'responseMessage': 'User logged in.',
+            'responseDateTime': datetime.now().isoformat(),
+            'userSessionId': session_id,
+        }}
+
+    def retrieve_individual_account(self, query):
+        account = int(query.get('accountId', '0') or 0)
+        member = self.members.get(account)
+        if member is None:
+            return self.failure('retrieveIndividualAccountResponse', 1, "Account not found.")
+        return 200, {'retrieveIndividualAccountResponse': {
+            'operationResult': 'SUCCESS',
+            'responseDateTime': datetime.now().isoformat(),
+            'individualAccount': {
+                'accountId': account,
+                'primaryContact': {
+                    'contactId': account + 500,
+                    'firstName': member['firstName'],
+                    'lastName': member['lastName'],
+                },
+            },
+        }}
+
+    def list_custom_object_records(self, query, lists):
+        object_name = query.get('objectApiName')
+        if object_name not in self.records:
+            return self.failure('listCustomObjectRecordsResponse', 1, "Unknown object.")
+        prefix = 'customObjectSearchCriteriaList.customObjectSearchCriteria.'
+        criteria = list(zip(
+            lists.get(prefix + 'criteriaField', []),
+            lists.get(prefix + 'operator', []),
+            lists.get(prefix + 'value', []),
+        ))
+        columns = lists.get('customObjectOutputFieldList.customObjectOutputField.columnName') or ['name']
+        with self.lock:
+            candidates = self.records[object_name]
+            for field, operator, value in criteria:
+                if field == 'Constituent_c' and operator == 'EQUAL':
+                    candidates = self.by_member.get((object_name, value), [])
+            matching = [
+                record for record in candidates
+                if all(self.matches(record, *criterion) for criterion in criteria)
+            ]
+        page_size = max(1, int(query.get('page.pageSize', '10')))
+        current_page = max(1, int(query.get('page.currentPage', '1')))
+        total_pages = max(1, math.ceil(len(matching) / page_size))
+        chunk = matching[(current_page - 1) * page_size:current_page * page_size]
+        return 200, {'listCustomObjectRecordsResponse': {
+            'operationResult': 'SUCCESS',
+            'responseDateTime': datetime.now().isoformat(),
+            'page': {
+                'currentPage': current_page,
+                'pageSize': page_size,
+                'totalPage': total_pages,
+                'totalResults': len(matching),
+            },
+            'searchResults': {'nameValuePairs': [
+                {'nameValuePair': [{'name': column, 'value': record.get(column, '')} for column in columns]}
+                for record in chunk
+            ]},
+        }}
+
+    @staticmethod
+    def matches(record, field, operator, value) -> bool:
+        if field == 'createTime':
+            have, want = record['_created'], datetime.strptime(value, TIME_FORMAT)
+        else:
+            have, want = record.get(field, ''), value
+        return {
+            'EQUAL': have == want,
+            'NOT_EQUAL': have != want,
+            'GREATER_THAN': have > want,
+            'GREATER_AND_EQUAL': have >= want,
+            'LESS_THAN': have < want,
+            'LESS_AND_EQUAL': have <= want,
+        }.get(operator, False)
+
+    def create_custom_object_record(self, query, lists):
+        object_name = query.get('customObjectRecord.objectApiName')
+        if object_name not in ('Points_c', 'Data_Updates_c'):
+            return self.failure('createCustomObjectRecordResponse', 1, "Unknown object.")
+        prefix = 'customObjectRecord.customObjectRecordDataList.customObjectRecordData.'
+        fields = dict(zip(lists.get(prefix + 'name', []), lists.get(prefix + 'value', [])))
+        if object_name == 'Points_c':
+            # NeonCRM's workflow fills these in from what the app sends
+            point_type = fields.get('type_for_api_c', '')
+            fields['point_type_c'] = point_type
+            fields['point_subtype_c'] = fields.get('subtype_for_api_c', '')
+            fields['Points_Awarded_c'] = str(AWARDED.get(point_type, 0))
+        with self.lock:
+            record = self.add(object_name, fields, datetime.now().replace(microsecond=0))
+        return 200, {'createCustomObjectRecordResponse': {
+            'operationResult': 'SUCCESS',
+            'responseDateTime': datetime.now().isoformat(),
+            'id': record['id'],
+        }}
+
+    @staticmethod
+    def failure(response_name, code, message=None):
+        return 200, {response_name: {
+            'operationResult': 'FAIL',
+            'responseDateTime': datetime.now().isoformat(),
+            'errors': {'error': [{
+                'errorCode': str(code),
+                'errorMessage': message or ERROR_MESSAGES[code],
+            }]},
+        }}
+
+    # ---------------- what every call goes through ----------------
+
+    OPERATIONS = {
+        'common/login': ('api_login', 'loginResponse'),
+        'account/retrieveIndividualAccount': ('account_info', 'retrieveIndividualAccountResponse'),
+        'customObjectRecord/listCustomObjectRecords': ('list', 'listCustomObjectRecordsResponse'),
+        'customObjectRecord/createCustomObjectRecord': ('create', 'createCustomObjectRecordResponse'),
+    }
+
+    def throttled(self) -> bool:
+        """A TOKEN BUCKET OVER EVERY CALL, IF --throttle WAS GIVEN"""
+        if not self.options.throttle:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.options.throttle_burst,
+                self.tokens + (now - self.refilled_at) * self.options.throttle
+            )
+            self.refilled_at = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+    def answer(self, method, path, query, lists, form):
+        """(status, body) FOR ONE CALL, AFTER ITS LATENCY"""
+        if path == '/np/oauth/token':
+            operation = 'token'
+        elif path.startswith(API_PREFIX) and path[len(API_PREFIX):] in self.OPERATIONS:
+            operation, response_name = self.OPERATIONS[path[len(API_PREFIX):]]
+            if operation in ('list', 'create'):
+                object_name = query.get('objectApiName') or query.get('customObjectRecord.objectApiName')
+                operation = f"{operation}:{object_name}"
+        else:
+            return 404, {'error': 'not found'}
+        with self.lock:
+            self.calls[operation] += 1
+            delay = (self.latency.get(operation) or self.latency.get(operation.split(':')[0])
+                     or self.latency.get('*'))
+            delay = delay.sample(self.rng) if delay else 0
+        if self.throttled():
+            with self.lock:
+                self.calls['throttled'] += 1
+            return 429, {'error': 'Too many requests'}
+        time.sleep(delay)
+        if operation == 'token':
+            return self.token(form)
+        if operation == 'api_login':
+            return self.login(query)
+        # NeonCRM checks the session before anything else
+        session_id = query.get('userSessionId')
+        if not session_id:
+            return self.failure(response_name, 3)
+        with self.lock:
+            expires = self.sessions.get(session_id)
+        if expires is None or expires < time.monotonic():
+            return self.failure(response_name, 4)
+        for code, rate in self.errors.items():
+            if self.rng.random() < rate:
+                with self.lock:
+                    self.calls[f"error_{code}"] += 1
+                return self.failure(response_name, code)
+        if operation == 'account_info':
+            return self.retrieve_individual_account(query)
+        if operation.startswith('list'):
+            return self.list_custom_object_records(query, lists)
+        return self.create_custom_object_record(query, lists)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'members': len(self.members),
+                'records': {name: len(records) for name, records in self.records.items()},
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    # keep-alive, so the app's connection pool behaves like it does for real
+    protocol_version = 'HTTP/1.1'
+    neon = None
+
+    def log_message(self, format, *args):
+        if self.neon.options.verbose:
+            super().log_message(format, *args)
+
+    def respond(self, status, body) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def handle_call(self, form) -> None:
+        parts = urlsplit(self.path)
+        lists = parse_qs(parts.query, keep_blank_values=True)
+        query = {name: values[-1] for name, values in lists.items()}
+        if parts.path == '/_fake/stats':
+            return self.respond(200, self.neon.stats())
+        if parts.path == '/_fake/reset' and self.command == 'POST':
+            with self.neon.lock:
+                self.neon.calls.clear()
+            return self.respond(200, {'reset': True})
+        self.respond(*self.neon.answer(self.command, parts.path, query, lists, form))
+
+    def do_GET(self):
+        self.handle_call({})
+
+    def do_HEAD(self):
+        self.handle_call({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+        form = {name: values[-1] for name, values in parse_qs(body).items()}
+        self.handle_call(form)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="A fake NeonCRM to test against.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=405)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--history', default='10,50,200',
+                        help="Points_c records per member, handed out in turn (e.g. 10,200,2000)")
+    parser.add_argument('--latency', action='append', default=[],
+                        help="[operation=]fixed:MS | uniform:MIN:MAX | lognormal:MEDIAN:SIGMA; "
+                             "operations are token, api_login, account_info, list, create, "
+                             "or list:Points_c and the like")
+    parser.add_argument('--error', action='append', default=[],
+                        help="CODE=RATE, failing that fraction of API calls with error code 1-5")
+    parser.add_argument('--session-lifetime', type=float, default=600,
+                        help="seconds before a userSessionId stops working (error code 4)")
+    parser.add_argument('--throttle', type=float, default=0,
+                        help="calls per second before answering 429 (0 for no limit)")
+    parser.add_argument('--throttle-burst', type=float, default=20)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def serve(options) -> ThreadingHTTPServer:
+    """STARTS A FAKE NEONCRM ON A BACKGROUND THREAD AND RETURNS ITS SERVER"""
+    handler = type('FakeNeonHandler', (Handler,), {'neon': Neon(options)})
+    server = ThreadingHTTPServer((options.host, options.port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fakeneon', daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    server = serve(options)
+    neon = server.RequestHandlerClass.neon
+    print(
+        f"fake NeonCRM on http://{options.host}:{server.server_address[1]}"
+        f" with {len(neon.members)} members and {len(neon.records['Points_c'])} Points_c records"
+    )
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""
+A load test that plays a room full of attendees arriving at once.
+
+Each simulated attendee does what a real one does, with their own cookies:
+
+    GET  /                      the landing page
+    GET  /authorize?code=...    back from logging in with NeonCRM
+    POST /dashboard             checking in to a user group
+    GET  /my-points             looking at their points
+
+--attendees of them go through it, --concurrency at a time. At the end it
+reports the throughput, the p50/p95/p99 latency and error rate of each
+route, and how many calls NeonCRM got per login, and writes all of it to
+--out as JSON so one run can be compared with the next.
+
+It needs a NeonCRM to talk to that isn't the real one. With --spawn it
+starts the fake one from tools/fakeneon.py and the app itself, in this
+process, both pointed at each other (handy and repeatable, but the app is
+sharing a CPU with the attendees). Without --spawn it drives an app that's
+already running at --app-url, which should be pointed at a fake NeonCRM
+running at --neon-url:
+
+    python3 -m tools.loadtest --spawn --attendees 200 --concurrency 50 --out before.json
+    python3 -m tools.loadtest --app-url http://127.0.0.1:8000 --neon-url http://127.0.0.1:8765
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROUTES = ('/', '/authorize', '/dashboard (check-in)', '/my-points')
+
+
+def percentile(ordered, fraction):
+    """NEAREST-RANK PERCENTILE OF AN ALREADY SORTED LIST"""
+    if not ordered:
+        return None
+    rank = max(1, round(fraction * len(ordered) + 0.5))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class Attendee:
+    """One person going through the flow, timing every step."""
+
+    def __init__(self, app_url, account, group, timeout):
+        self.app_url = app_url.rstrip('/')
+        self.account = account
+        self.group = group
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.results = []
+
+    def step(self, route, method, path, **kwargs) -> bool:
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.app_url + path, timeout=self.timeout, **kwargs)
+            status = response.status_code
+        except requests.RequestException as error:
+            status = type(error).__name__
+        self.results.append((route, time.perf_counter() - started, status))
+        return isinstance(status, int) and status < 400
+
+    def run(self) -> list:
+        (
+            self.step('/', 'GET', '/')
+            and self.step('/authorize', 'GET', f'/authorize?code={self.account}')
+            and self.step('/dashboard (check-in)', 'POST', '/dashboard', data={'selected_group': self.group})
+            and self.step('/my-points', 'GET', '/my-points')
+        )
+        return self.results
+
+
+def neon_calls(neon_url):
+    """WHAT THE FAKE NEONCRM HAS ANSWERED SO FAR, OR None IF IT ISN'T ONE"""
+    try:
+        return Counter(requests.get(neon_url.rstrip('/') + '/_fake/stats', timeout=5).json()['calls'])
+    except (requests.RequestException, ValueError, KeyError):
+        return None
+
+
+def spawn(options):
+    """
+    Starts the fake NeonCRM and the app in this process, each on a port of
+    its own, and returns (app url, neon url).
+    """
+    from tools import fakeneon
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    fake_options = fakeneon.parse_args([
+        '--port', '0', '--members', str(options.members), '--history', options.history,
+        *[argument for spec in options.latency for argument in ('--latency', spec)],
+        *[argument for spec in options.error for argument in ('--error', spec)],
+    ])
+    neon = fakeneon.serve(fake_options)
+    neon_url = f"http://127.0.0.1:{neon.server_address[1]}"
+    # the app reads these when it's imported
+    os.environ['NEON_API_BASE'] = neon_url
+    os.environ['NEON_OAUTH_BASE'] = neon_url
+    from app import app, store
+    if not options.warm:
+        store.redis().flushdb()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='loadtest-app', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", neon_url
+
+
+def summarize(results, duration, logins, calls_before, calls_after) -> dict:
+    routes = {}
+    for route in ROUTES:
+        timings = sorted(seconds for name, seconds, _ in results if name == route)
+        statuses = Counter(str(status) for name, _, status in results if name == route)
+        errors = sum(
+            count for status, count in statuses.items()
+            if not (status.isdigit() and int(status) < 400)
+        )
+        routes[route] = {
+            'count': len(timings),
+            'errors': errors,
+            'error_rate': errors / len(timings) if timings else None,
+            'statuses': dict(statuses),
+            'p50_ms': milliseconds(percentile(timings, 0.50)),
+            'p95_ms': milliseconds(percentile(timings, 0.95)),
+            'p99_ms': milliseconds(percentile(timings, 0.99)),
+            'max_ms': milliseconds(timings[-1] if timings else None),
+        }
+    neon = None
+    if calls_before is not None and calls_after is not None:
+        calls = calls_after - calls_before
+        answered = sum(count for name, count in calls.items()
+                       if name != 'throttled' and not name.startswith('error_'))
+        neon = {
+            'calls': dict(calls),
+            'total': answered,
+            'per_login': answered / logins if logins else None,
+        }
+    return {
+        'duration_seconds': duration,
+        'requests': len(results),
+        'throughput_rps': len(results) / duration if duration else None,
+        'logins': logins,
+        'logins_per_second': logins / duration if duration else None,
+        'routes': routes,
+        'neon': neon,
+    }
+
+
+def report(summary) -> None:
+    print(
+        f"{summary['requests']} requests in {summary['duration_seconds']:.2f}s"
+        f" = {summary['throughput_rps']:.1f} req/s, {summary['logins_per_second']:.1f} logins/s"
+    )
+    print(f"{'route':<24}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, numbers in summary['routes'].items():
+        if not numbers['count']:
+            continue
+        print(
+            f"{route:<24}{numbers['count']:>7}{numbers['errors']:>8}"
+            f"{numbers['p50_ms']:>10.1f}{numbers['p95_ms']:>10.1f}{numbers['p99_ms']:>10.1f}"
+        )
+    if summary['neon']:
+        print(f"NeonCRM calls per login: {summary['neon']['per_login']:.2f}  {summary['neon']['calls']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Simulate a room full of attendees checking in.")
+    parser.add_argument('--attendees', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=25)
+    parser.add_argument('--app-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--neon-url', default='http://127.0.0.1:8765')
+    parser.add_argument('--spawn', action='store_true',
+                        help="start the fake NeonCRM and the app in this process")
+    parser.add_argument('--warm', action='store_true',
+                        help="with --spawn, keep whatever is already in the shared store")
+    parser.add_argument('--members', type=int, default=500, help="with --spawn, how many members to seed")
+    parser.add_argument('--history', default='10,50,200', help="with --spawn, Points_c records per member")
+    parser.add_argument('--latency', action='append', default=[], help="with --spawn, passed to fakeneon")
+    parser.add_argument('--error', action='append', default=[], help="with --spawn, passed to fakeneon")
+    parser.add_argument('--group', default='Pythonistas', help="the user group everybody checks in to")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--label', default='', help="a note to keep with the results")
+    parser.add_argument('--out', help="write the results here as JSON")
+    options = parser.parse_args(argv)
+
+    app_url, neon_url = options.app_url, options.neon_url
+    if options.spawn:
+        app_url, neon_url = spawn(options)
+        options.app_url, options.neon_url = app_url, neon_url
+    calls_before = neon_calls(neon_url)
+
+    attendees = [
+        Attendee(app_url, 1000 + index % options.members, options.group, options.timeout)
+        for index in range(options.attendees)
+    ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+        results = [result for steps in pool.map(Attendee.run, attendees) for result in steps]
+    duration = time.perf_counter() - started
+
+    logins = sum(1 for route, _, _ in results if route == '/authorize')
+    summary = summarize(results, duration, logins, calls_before, neon_calls(neon_url))
+    summary = {
+        'label': options.label,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'options': {
+            name: value for name, value in vars(options).items()
+            if name not in ('out', 'label')
+        },
+        **summary,
+    }
+    report(summary)
+    if options.out:
+        with open(options.out, 'w') as results_file:
+            json.dump(summary, results_file, indent=2)
+    failed = sum(numbers['errors'] for numbers in summary['routes'].values())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())